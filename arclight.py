@@ -1,10 +1,10 @@
 
 import atexit
 import argparse
-import boto3
 import datetime
 import dateutil
 import docker
+import hashlib
 import math
 import multiprocessing
 import json
@@ -14,11 +14,26 @@ import platform
 import pprint
 import psutil
 import re
+import shutil
 import subprocess
 import sys
 import time
 
 import util.aws
+import util.awscalls
+import util.bootstrap
+import util.cost
+import util.delta
+import util.fingerprint
+import util.history
+import util.logphases
+import util.mirror
+import util.p4view
+import util.prof
+import util.resource_profile
+import util.warm
+import util.wincontainer_version
+from util.prof import annotate
 from util.prof import prof
 from util.prof import Context
 from util.simple_utc import simple_utc
@@ -47,12 +62,25 @@ def main() -> None:
     smb = parser.add_argument_group('smb mount configuration (required for non-AWS modes)')
     smb.add_argument("--smb_username", help="Username for SMB mounting")
     smb.add_argument("--smb_password", help="Password for SMB mounting")
+    smb.add_argument("--smb_stage", help="Copy the workspace onto the container's own disk before running and copy changes back afterwards, instead of building over SMB (much faster with `--warm`, which keeps the copy between runs)", action="store_true")
+    smb.add_argument("--smb_stage_workers", help="Number of files to copy at once while staging", type=int)
 
     aws = parser.add_argument_group('aws configuration')
     aws.add_argument("--aws_allow_new_ami", help="Allow creating a new AMI", action="store_true")
+    aws.add_argument("--aws_mirror", help="Pull images on AWS instances through a registry mirror inside the VPC, starting one if necessary", action="store_true")
+    aws.add_argument("--aws_delta", help="Download the output as a binary delta against the last output of this stream and script, if we have it cached", action="store_true")
 
+    preflight = parser.add_argument_group('network preflight configuration')
+    preflight.add_argument("--preflight_min_mbps", help="Minimum acceptable throughput to S3, in megabits/sec; slower networks fail the run early (or switch to the proxy)", type=float)
+    preflight.add_argument("--preflight_proxy", help="HTTP(S) proxy for the container to switch to if throughput is below the minimum")
+
+    parser.add_argument("--mirror", help="Pull base images through the registry mirror at this address (a mirror is started if it's on localhost and not running)")
     parser.add_argument("--working", help="Working directory to use (required for `managed`)")
     parser.add_argument("--memory", help="Maximum memory to use (in gigabytes)", type=int)
+    parser.add_argument("--cpus", help="Maximum CPUs to use", type=int)
+    parser.add_argument("--container_name", help="Name the local container this, so whatever started us can find it again (scheduler.py uses it to clean up cancelled jobs)")
+    parser.add_argument("--warm", help="Keep the container running after the run, with p4 and mounts already set up, and run in it next time instead of starting a new one (`inplace` only)", action="store_true")
+    parser.add_argument("--warm_idle_minutes", help="Shut a warm container down after this long without a run", type=float, default=30)
     parser.add_argument("script", help="Name of the script to run")
     parser.add_argument("script_args", help="Options to be fed to the script verbatim", nargs=argparse.REMAINDER)
 
@@ -94,16 +122,24 @@ def main() -> None:
             ] + args.script_args,
             cwd = str(pathlib.Path(__file__).parent.joinpath("script"))))
     imagename = scriptsettings["image"]
+    
+    # Scripts can ask for a narrower client view than the whole stream, which can make syncs a lot smaller
+    p4view = util.p4view.normalize(scriptsettings.get("view"))
+    p4viewhash = util.p4view.view_hash(p4view)
+    if util.p4view.is_narrowed(p4view):
+        print(f"Script requested narrowed view {p4viewhash}: include {p4view['include']}, exclude {p4view['exclude']}")
 
     # Get paths and variables
     arclightdir = pathlib.Path(__file__).parent
     rootdir = arclightdir.parent
     imagebuilddir = arclightdir.joinpath(f'image/{imagename}').resolve()
-    containername = f"arclight:{imagename}_{buildid}" # This *should* be chosen based on the branch and image changelist, if there are no patches yet
     outputprefix = "arclight_output" # this is here just so it's centralized, I don't expect it'll get changed
     
+    # the whole run's timeline lands next to its output, for loading into a trace viewer
+    util.prof.trace_path = f"{outputprefix}.trace.json"
+    annotate(script = args.script, image = imagename, build = buildid)
+    
     # AWS variables
-    awscontainername = None # filled out by the AWS systems
     awscredentials = None # filled out by the AWS systems
     awsregion = "us-east-1"
     # I ran this once without explicitly specifying an availability zone and it ended up in us-east-1e which was literally the only availability zone without the instance type we needed
@@ -114,7 +150,6 @@ def main() -> None:
     # mountingMode = "docker" or "aws" or "smb"
     # targetdir = [directory]
     if args.inplace or args.managed:
-        import util.wincontainer_version
         containersettings = util.wincontainer_version.local()
         
         if containersettings["runisolation"] == "hyperv":
@@ -124,7 +159,6 @@ def main() -> None:
             mountingMode = "docker"
         
     elif args.aws:
-        import util.wincontainer_version
         containersettings = util.wincontainer_version.aws_2019()
         
         mountingMode = "aws"
@@ -155,6 +189,14 @@ def main() -> None:
     else:
         raise Exception("no valid runtime mode?")
     
+    if args.warm and not args.inplace:
+        # managed mode makes (and deletes) a fresh workspace every run, so there's nothing to keep warm
+        raise Exception("`--warm` is only supported with `--inplace`")
+    
+    if (args.preflight_min_mbps is not None or args.preflight_proxy is not None) and not args.aws:
+        # the only throughput probe is the S3 sample, and only AWS runs get one, so locally there'd be nothing to compare against
+        raise Exception("`--preflight_min_mbps` and `--preflight_proxy` are only supported with `--aws`")
+    
     if args.p4_sync_from is not None:
         if not args.p4_sync_from.isdigit():
             raise Exception(f"{args.p4_sync_from} is not a valid changelist for `--p4_sync_from` (must be numeric)")
@@ -237,35 +279,102 @@ def main() -> None:
 
                 raise Exception("no SMB share")
 
-    # Build the docker image
-    with Context("docker build"):
-        subprocess.check_call([
-                'python', 'build.py',
-                '--name', containername,
-                '--baseimage', containersettings["baseimage"],
-                '--dllsrcimage', containersettings["dllsrcimage"],
-                '--isolation', containersettings["buildisolation"],
-            ], cwd=imagebuilddir)
-
-    # Upload docker image if we're going to AWS
+    # The image is named after a hash of everything that goes into building it, so if nothing's changed, we don't have to build it at all
+    # (bootstrap and its helpers are handed to the container when it starts, so they don't count.)
+    with Context("image fingerprint"):
+        imagefingerprint = util.fingerprint.compute(
+            str(imagebuilddir),
+            exclude = util.fingerprint.generated + util.bootstrap.fingerprint_exclude,
+            extra_data = {
+                "baseimage": containersettings["baseimage"],
+                "dllsrcimage": containersettings["dllsrcimage"],
+                "isolation": containersettings["buildisolation"],
+            })
+    containername = f"arclight:{imagename}_{imagefingerprint}"
+    print(f"Image fingerprint: {imagefingerprint}")
+    
     if args.aws:
         aws = util.aws.Aws(
             region = awsregion,
             zone = awsavailabilityzone,
             aws_access_key_id = awscredentials["aws_access_key_id"],
             aws_secret_access_key = awscredentials["aws_secret_access_key"])
+    
+    # Image pulls can go through a pull-through mirror rather than the Internet; the AWS one lives in the VPC, so only instances can see it
+    if args.mirror is not None:
+        host = args.mirror.rpartition(":")[0]
+        if host in ["localhost", "127.0.0.1"]:
+            util.mirror.start_local(args.mirror, os.path.join("arclight_cache", "mirror"), os.path.join("arclight_cache", "mirror.log"))
+    
+    instancemirror = None
+    if args.aws and args.aws_mirror:
+        instancemirror = aws.ensure_mirror()
+    
+    def instance_pull(instance, image: str) -> None:
+        # Through the VPC mirror if we have one; if it isn't up yet (or is broken), just go direct
+        if instancemirror is not None:
+            try:
+                instance.use_mirror(instancemirror)
+                for command in util.mirror.pull_commands(instancemirror, image):
+                    instance.ssh(command)
+                stats = json.loads(instance.ssh(['curl.exe', '-s', f'http://{instancemirror}{util.mirror.stats_path}']))
+                print(f"MIRROR: {util.mirror.describe_stats(stats)}")
+                return
+            except Exception as ex:
+                print(f"MIRROR: pull through {instancemirror} failed ({ex}), pulling directly")
+        
+        instance.ssh([
+            'docker', 'pull',
+            image,
+        ])
+    
+    try:
+        dockerenv.images.get(containername)
+        imagelocal = True
+    except docker.errors.ImageNotFound:
+        imagelocal = False
+    
+    # AWS only ever needs the copy in ECR, so if that's there, we can skip the local build entirely
+    imageremote = args.aws and aws.has_container(containername)
+    
+    if imagelocal:
+        print(f"Image {containername} already built, skipping build")
+    elif imageremote:
+        print(f"Image {containername} already in ECR, skipping build")
+    else:
+        # The base images are pinned and huge, so fetch them through the mirror if we have one; docker build uses local copies when they exist
+        if args.mirror is not None:
+            with Context("mirror pull"):
+                util.mirror.pull(args.mirror, f"mcr.microsoft.com/windows/servercore:{containersettings['baseimage']}")
+                util.mirror.pull(args.mirror, f"mcr.microsoft.com/windows:{containersettings['dllsrcimage']}")
+            print(f"MIRROR: {util.mirror.describe_stats(util.mirror.fetch_stats(args.mirror))}")
+        
+        # Build the docker image
+        with Context("docker build", image = containername):
+            subprocess.check_call([
+                    'python', 'build.py',
+                    '--name', containername,
+                    '--baseimage', containersettings["baseimage"],
+                    '--dllsrcimage', containersettings["dllsrcimage"],
+                    '--isolation', containersettings["buildisolation"],
+                ], cwd=imagebuilddir)
 
-        # Push our container and get our fully-specified container name
-        fullcontainername = aws.push_container(containername)
+    # Upload docker image if we're going to AWS
+    if args.aws:
+        if imageremote:
+            fullcontainername = aws.full_container_name(containername)
+        else:
+            # Push our container and get our fully-specified container name
+            fullcontainername = aws.push_container(containername)
         
-        # Long-term, this is going to be the unique ID for locally-built test images, and the branch/type/cl triple - same as the tag - for long-term images
-        # This is because the unique ID may not even be available when we're doing the build.
-        # Right now it's just the unique ID though because it's always available.
-        dockerimageid = subprocess.check_output([
-                "docker",
-                "images", fullcontainername,
-                "--format", "{{.ID}}",
-            ]).decode("utf-8").strip()
+        # so ECR cleanup knows this stream still wants this image
+        aws.record_build(args.p4_stream, containername, buildid)
+    
+    # bootstrap itself travels separately from the image, so editing it doesn't mean a new image, push or AMI
+    bootstrapbundle = util.bootstrap.Bundle(imagebuilddir, arclightdir)
+    print(f"Bootstrap bundle: {bootstrapbundle.hash[:12]}")
+    if args.aws:
+        bootstrapkey = aws.push_bootstrap(bootstrapbundle)
             
     # figure out all the args we need for bootstrap.py
     bootstrap_args = [
@@ -275,6 +384,41 @@ def main() -> None:
         "--script", args.script,
         "--output", outputDir,
     ]
+    
+    # Delta downloads; we keep the last output for each (stream, script, args) around and the container sends us only what changed
+    deltacachedir = None
+    if args.aws_delta:
+        if not args.aws:
+            raise Exception("`--aws_delta` is only supported with `--aws`; local modes write their output in place anyway")
+        
+        deltakey = hashlib.sha256(json.dumps([args.p4_stream, p4viewhash, args.script] + args.script_args).encode("utf-8")).hexdigest()[:16]
+        deltacachedir = os.path.join("arclight_cache", "delta", deltakey)
+        deltabase = util.delta.base_id(deltacachedir)
+        print(f"DELTA: key {deltakey}, cached base {deltabase}")
+        
+        bootstrap_args += [
+            "--output_delta_key", deltakey,
+        ]
+        if deltabase is not None:
+            bootstrap_args += [
+                "--output_delta_base", deltabase,
+            ]
+    
+    # Scripts can pick how their output gets packaged; bootstrap owns the actual codecs
+    if "packaging" in scriptsettings:
+        bootstrap_args += [
+            "--output_packaging", scriptsettings["packaging"],
+        ]
+
+    if args.preflight_min_mbps is not None:
+        bootstrap_args += [
+            "--preflight_min_mbps", str(args.preflight_min_mbps),
+        ]
+    
+    if args.preflight_proxy is not None:
+        bootstrap_args += [
+            "--preflight_proxy", args.preflight_proxy,
+        ]
 
     if mountingMode == "smb":
         bootstrap_args += [
@@ -282,6 +426,18 @@ def main() -> None:
             "--smb_password", args.smb_password,
             "--smb_share", smb_share,
         ]
+        
+        if args.smb_stage:
+            # any container-local directory will do, as long as it's not on the share's drive
+            bootstrap_args += [
+                "--smb_stage", "c:\\arclight_stage",
+            ]
+            if args.smb_stage_workers is not None:
+                bootstrap_args += [
+                    "--smb_stage_workers", str(args.smb_stage_workers),
+                ]
+    elif args.smb_stage:
+        print("Not using SMB mounting on this machine, so there's nothing to stage; ignoring `--smb_stage`")
 
     with Context("p4 setup"):
         # Connect to p4 and gather necessary info
@@ -317,6 +473,8 @@ def main() -> None:
             args.p4_sync = p4.run("counter", "change")[0]["value"]
             print(f"P4: Resolved p4_sync to {args.p4_sync}")
         
+        annotate(cl = args.p4_sync)
+        
         bootstrap_args += [
             "--p4_username", args.p4_username,
             "--p4_password", args.p4_password,
@@ -354,6 +512,8 @@ def main() -> None:
                 client = p4.run_client("-S", f"//depot/{args.p4_stream}", "-o", workspaceName)
                 client[0]["Root"] = targetDir
                 client[0]["Host"] = p4host  # we'll use P4HOST to fake this
+                for path in util.p4view.apply(client[0], p4view):
+                    print(f"P4: WARNING: the script asked for `{path}`, but nothing in //depot/{args.p4_stream} maps there")
                 p4.save_client(client[0])
                 print(f"P4: created workspace {workspaceName}")
                 
@@ -393,6 +553,10 @@ def main() -> None:
             
             client = p4.run_client("-o", args.p4_workspace)
             
+            # We don't own this workspace, so we're not going to go rewriting its view out from under the user
+            if util.p4view.is_narrowed(p4view):
+                print(f"P4: ignoring narrowed view for in-place workspace {args.p4_workspace}")
+            
             # We can just yank the root out here and use it
             args.working = client[0]["Root"]
             
@@ -407,7 +571,7 @@ def main() -> None:
         ]
 
     if args.aws:
-        ec2 = boto3.client('ec2',
+        ec2 = util.aws.client('ec2',
             region_name = awsregion,
             aws_access_key_id = awscredentials["aws_access_key_id"],
             aws_secret_access_key = awscredentials["aws_secret_access_key"])
@@ -433,8 +597,13 @@ def main() -> None:
             "u-6tb1.112xlarge": (448, 6144, 100, 75.208),
         }
         
+        # Everything we spin up from here on gets charged to the cost ledger, which reports at exit (even if we fail)
+        util.cost.instance_hourly.update({name: spec[3] for name, spec in instanceTypes.items()})
+        util.cost.path = f"{outputprefix}.cost.json"
+        
         # We're going to try to find, and perhaps even make, an AMI for ourselves
-        aminame = f"arclight-{dockerimageid}"
+        # AMIs are named after the image they have cached; the fingerprint identifies that image whether or not we have it locally
+        aminame = f"arclight-{imagefingerprint}"
         amis = ec2.describe_images(Filters = [{'Name':'tag:Name', 'Values':[aminame]}])["Images"]
         if len(amis) == 1:
             ami = amis[0]["ImageId"]
@@ -468,6 +637,7 @@ def main() -> None:
                 with aws.run_instance_prepped(
                         ami = baseami,
                         instanceType = "m5a.large", # 8gb RAM, 10gbit network; we don't care about much else here
+                        purpose = "ami bake",
                         blockDeviceMappings = [
                             # primary drive is not big enough
                             {
@@ -486,10 +656,7 @@ def main() -> None:
                 
                     # Pull the image
                     with Context("docker pull"):
-                        instance.ssh([
-                            'docker', 'pull',
-                            fullcontainername,
-                        ])
+                        instance_pull(instance, fullcontainername)
                     
                     # Get all the current known images
                     knownimages = instance.ssh([
@@ -511,6 +678,10 @@ def main() -> None:
                             'docker', 'image', 'prune', '-f',
                         ])
                     
+                    # Don't bake the mirror into the AMI; instances made from it trust whichever mirror they pull through
+                    if instancemirror is not None:
+                        instance.forget_mirror()
+                    
                     # Stop so we can snapshot it
                     ec2.stop_instances(InstanceIds = [instance.instanceid])
                     
@@ -530,22 +701,26 @@ def main() -> None:
                     
                     # Make an AMI off it
                     print("AMI: building . . .")
+                    imageTags = [{"Key": "arclight-image", "Value": containername.split(":", 1)[1]}]
                     ami = ec2.create_image(
                         InstanceId = instance.instanceid,
                         Name = aminame,
                         TagSpecifications = [
                             {
                                 "ResourceType": "image",
-                                "Tags": aws.generate_tags(name = aminame, owner = "arclight-core", timeout = datetime.timedelta(days = 7)),
+                                "Tags": aws.generate_tags(name = aminame, owner = "arclight-core", timeout = datetime.timedelta(days = 7)) + imageTags,
                             },
                             {
                                 "ResourceType": "snapshot",
-                                "Tags": aws.generate_tags(name = aminame, owner = "arclight-core", timeout = datetime.timedelta(days = 7)),
+                                "Tags": aws.generate_tags(name = aminame, owner = "arclight-core", timeout = datetime.timedelta(days = 7)) + imageTags,
                             },
                         ]
                     )["ImageId"]
                     
                     print(f"AMI: building ({ami})")
+                    
+                    # the AMI is a snapshot of the root drive, kept as long as the AMI is; it's a good deal less than the full 50GB in practice
+                    util.cost.ledger.snapshot("ami bake", ami, 50, 7)
                 
                 # Deallocate the instance, now just wait for it to be finished building (this takes a while . . .)
                 with Context("ami finish"):
@@ -570,9 +745,11 @@ def main() -> None:
         # but if we have something specified, cut it down
         if args.memory:
             memory = min(memory, int(args.memory))
+        if args.cpus:
+            cpus = min(cpus, int(args.cpus))
         
-        # s3 filename that we'll be writing to
-        s3filename = f"arclight-{aws.owner}.{(datetime.datetime.now() + datetime.timedelta(days = 1)).replace(tzinfo=simple_utc()).isoformat()}.7z"
+        # s3 filename that we'll be writing to; bootstrap appends the extension for whatever packaging it used
+        s3filename = f"arclight-{aws.owner}.{(datetime.datetime.now() + datetime.timedelta(days = 1)).replace(tzinfo=simple_utc()).isoformat()}"
         
         # Find our working volume . . .
         # There's honestly a lot of race conditions in here. Right now I'm hoping we just don't run into trouble, but this ideally should be fixed one way or another.
@@ -580,6 +757,7 @@ def main() -> None:
         volumeInit = False # assume for now we'll find something sensible!
         volumePreserveOnSuccess = args.p4_patch is None or args.p4_patch_allow_preserve_DO_NOT_USE # we don't want to save this if we have a patch, because that might result in a weird unexpected state
         volume = None   # we'll fill this one way or another!
+        snapshot = None # and if all goes well, we'll snapshot it for next time
         
         # first, look for something appropriate in volume form; if we find it, we'll just use that
         # ugh, python, why don't you have manual scoping allowed
@@ -593,6 +771,10 @@ def main() -> None:
                     { 'Name': 'status', 'Values': ["available"] },
                 ])["Volumes"]
             
+            # And it has to have been synced with the same view, or we'll end up with missing (or extra) files
+            # Volumes from before view tagging are all full-view, so treat a missing tag as that
+            volumes = [volume for volume in volumes if (util.aws.get_tag(volume["Tags"], "arclight-sig-view") or util.p4view.full) == p4viewhash]
+            
             # Find the largest changelist that isn't larger than our sync target (Price is Right rules)
             volumeObj = max([volume for volume in volumes if int(util.aws.get_tag(volume["Tags"], "arclight-sig-cl")) <= int(args.p4_sync)], key = lambda volume: int(util.aws.get_tag(volume["Tags"], "arclight-sig-cl")), default = None)
             
@@ -602,7 +784,7 @@ def main() -> None:
                 # Set our syncfrom info
                 args.p4_sync_from = util.aws.get_tag(volumeObj["Tags"], "arclight-sig-cl")
                 
-                print(f"VOLUME: Reusing live volume {volume}@{args.p4_sync_from}")
+                print(f"VOLUME: Reusing live volume {volume}@{args.p4_sync_from} (view {p4viewhash})")
                 
                 # Strip out the tags to reduce the chance of someone trying to use it out from under us
                 ec2.delete_tags(
@@ -610,6 +792,7 @@ def main() -> None:
                     Tags = [
                         { 'Key': 'arclight-sig-stream' },
                         { 'Key': 'arclight-sig-cl' },
+                        { 'Key': 'arclight-sig-view' },
                     ]
                 )
                 
@@ -627,6 +810,9 @@ def main() -> None:
                     { 'Name': 'status', 'Values': ["completed"] },
                 ])["Snapshots"]
             
+            # Same view rules as volumes
+            snapshots = [snapshot for snapshot in snapshots if (util.aws.get_tag(snapshot["Tags"], "arclight-sig-view") or util.p4view.full) == p4viewhash]
+            
             snapshotObj = max([snapshot for snapshot in snapshots if (int(util.aws.get_tag(snapshot["Tags"], "arclight-sig-cl")) <= int(args.p4_sync))], key = lambda snapshot: int(util.aws.get_tag(snapshot["Tags"], "arclight-sig-cl")), default = None)
             
             if snapshotObj is not None:
@@ -705,30 +891,40 @@ def main() -> None:
                 
                 # Pull the image
                 print("BUILD: pulling image")
-                instance.ssh([
-                    'docker', 'pull',
-                    fullcontainername,
-                ])
+                with Context("docker pull"):
+                    instance_pull(instance, fullcontainername)
                 
                 bootstrap_args += [
                     "--output_compress", # makes it easier and faster (and cheaper) to download
                     "--output_s3", s3filename,
                     "--aws_access_key_id", awscredentials["aws_access_key_id"],
                     "--aws_secret_access_key", awscredentials["aws_secret_access_key"],
+                    "--preflight_ecr", aws.repo,
+                    "--preflight_s3_sample", util.aws.preflight_sample_key,
+                    "--cpus", str(cpus),
+                    "--memory", str(memory),
                 ]
                 
                 # Run the build script!
                 print("BUILD: starting image")
-                with Context("run"):
-                    instance.ssh([
-                        'docker', 'run',
-                        '-v', f'd:\:{targetDir}',
-                        f"--cpus={cpus}",
-                        f"--memory={memory}GB",
-                        f"--isolation={containersettings['runisolation']}",
-                        # image name
-                        fullcontainername,
-                    ] + bootstrap_args + ["--"] + args.script_args)
+                with Context("run", instance_type = instanceType, cpus = cpus, memory = memory) as runspan:
+                    # picks the phases out of the output as it goes by
+                    loganalyser = util.logphases.analyser(scriptsettings, runspan.prof)
+                    with loganalyser:
+                        instance.ssh([
+                            'docker', 'run',
+                            '-v', f'd:\:{targetDir}',
+                            '-e', f'ARCLIGHT_BOOTSTRAP_SHA256={bootstrapbundle.hash}',
+                            '-e', f'ARCLIGHT_BOOTSTRAP_S3={bootstrapkey}',
+                            '-e', f'{util.prof.trace_env}={util.prof.propagate()}',
+                            f"--cpus={cpus}",
+                            f"--memory={memory}GB",
+                            f"--isolation={containersettings['runisolation']}",
+                            # image name
+                            fullcontainername,
+                        ] + bootstrap_args + ["--"] + args.script_args, out_stream = loganalyser)
+                for line in loganalyser.describe():
+                    print(f"LOG: {line}")
                 
                 # Success!
                 if volumePreserveOnSuccess:
@@ -753,9 +949,13 @@ def main() -> None:
                     
                     # Put together the tags we'll be attaching to stuff
                     imageName = f"{util.aws.label}-{args.p4_stream}-{args.p4_sync}"
+                    if p4viewhash != util.p4view.full:
+                        imageName += f"-{p4viewhash}"
                     extraTags = [
                         {"Key": "arclight-sig-stream", "Value": args.p4_stream},
                         {"Key": "arclight-sig-cl", "Value": args.p4_sync},
+                        {"Key": "arclight-sig-view", "Value": p4viewhash},
+                        {"Key": "arclight-image", "Value": containername.split(":", 1)[1]},
                     ]
                     
                     # Snapshot
@@ -783,13 +983,59 @@ def main() -> None:
         # Instance and volume terminate here
             
         print("BUILD: downloading result")
-        with Context("download"):
-            s3 = boto3.client('s3',
+        with Context("download") as download:
+            s3 = util.aws.client('s3',
                 aws_access_key_id = awscredentials["aws_access_key_id"],
                 aws_secret_access_key = awscredentials["aws_secret_access_key"])
-            with open("arclight_output.7z", "wb") as f:
-                s3.download_fileobj("arclight", s3filename, f)
-            s3.delete_object(Bucket = "arclight", Key = s3filename)
+            
+            # there should be exactly one output here, with the packaging's extension on the end, plus bootstrap's reports
+            s3keys = [obj["Key"] for obj in s3.list_objects_v2(Bucket = "arclight", Prefix = s3filename).get("Contents", [])]
+            outputkeys = [key for key in s3keys if key not in [f"{s3filename}{extension}" for extension in util.bootstrap.report_extensions]]
+            if len(outputkeys) != 1:
+                raise Exception(f"expected exactly one output in s3 for {s3filename}, found {len(outputkeys)}")
+            
+            downloadedbytes = 0
+            for s3key in s3keys:
+                extension = s3key[len(s3filename):]
+                with open(f"{outputprefix}{extension}", "wb") as f:
+                    s3.download_fileobj("arclight", s3key, f)
+                s3.delete_object(Bucket = "arclight", Key = s3key)
+                print(f"BUILD: downloaded {outputprefix}{extension}")
+                downloadedbytes += os.path.getsize(f"{outputprefix}{extension}")
+            download.set(bytes = downloadedbytes)
+            util.cost.ledger.transfer("build", s3filename, downloadedbytes)
+            
+            extension = outputkeys[0][len(s3filename):]
+        
+        # Snapshots are incremental, so ours only costs what's changed since the one it came from; bootstrap's metrics let us guess how much that was
+        if snapshot is not None:
+            volumesize = volumeHandle.volumeInfo["Size"]
+            snapshotgb = volumesize
+            if os.path.isfile(f"{outputprefix}.metrics.json"):
+                with open(f"{outputprefix}.metrics.json", "r") as f:
+                    resources = json.load(f).get("resources")
+                if resources is not None and resources["samples"] > 0:
+                    if volumeInit:
+                        # everything on it is new
+                        snapshotgb = volumesize - resources["free_space"]["end_gb"]
+                    else:
+                        # at most, everything we wrote (rewriting the same blocks only counts once, so this is on the high side)
+                        snapshotgb = min(resources["disk"]["write_gb"], volumesize)
+            util.cost.ledger.snapshot("build", snapshot, snapshotgb, 7)
+        
+        if extension == util.delta.extension:
+            with Context("delta apply"):
+                artifact = f"{outputprefix}{extension}"
+                if os.path.isdir(outputprefix):
+                    shutil.rmtree(outputprefix)
+                
+                # the artifact says which base it needs (if any), and this checks we've got it
+                manifest = util.delta.apply(artifact, deltacachedir if util.delta.base_id(deltacachedir) is not None else None, outputprefix)
+                print(f"DELTA: reconstructed {outputprefix} ({len(manifest['files'])} files, {'against ' + manifest['base'] if manifest['base'] is not None else 'full'})")
+                
+                # and now this is the base for next time
+                util.delta.store_base(outputprefix, deltacachedir)
+                os.remove(artifact)
         
     elif args.inplace or args.managed:
         # Local Docker execution
@@ -803,21 +1049,50 @@ def main() -> None:
         # but if we have something specified, cut it down
         if args.memory:
             memory = min(memory, int(args.memory))
-            
-        print(f"Using {memory}GB of RAM")
+        
+        # and if we were given a budget (say, by scheduler.py), stick to it
+        if args.cpus:
+            cpus = min(cpus, int(args.cpus))
+        
+        # If we've run this exact script before, size ourselves based on what it actually used
+        profilekey = util.resource_profile.profile_key(args.script, args.script_args)
+        profiled = util.resource_profile.size(profilekey, cpus, memory)
+        if args.warm:
+            # A warm container's size is fixed for its lifetime and it'll run all sorts of things, so give it the whole budget;
+            # resizing it every time the history shifted would mean throwing it away every time
+            profiled = None
+        if profiled is not None:
+            cpus, memory = profiled
+            print(f"Using {memory}GB of RAM and {cpus} CPUs, based on previous runs")
+        else:
+            print(f"Using {memory}GB of RAM")
 
-        # chop off 8gb, then assume 2gb per CPU
-        # on a 64gb machine, this uses 48gb and gets 20 threads, which works
-        # on a 32gb machine, this uses 24gb and gets 8 threads, which doesn't work
-        # some further adjustments might be needed?
-        max_cpus = math.floor((memory - 8) / 2)
+            # No history, so guess: chop off 8gb, then assume 2gb per CPU
+            # on a 64gb machine, this uses 48gb and gets 20 threads, which works
+            # on a 32gb machine, this uses 24gb and gets 8 threads, which doesn't work
+            # some further adjustments might be needed?
+            max_cpus = math.floor((memory - 8) / 2)
 
-        if cpus > max_cpus:
-            print(f"Reducing CPU count to deal with limited memory; maxing out at {max_cpus} CPUs")
-            cpus = max_cpus
+            if cpus > max_cpus:
+                print(f"Reducing CPU count to deal with limited memory; maxing out at {max_cpus} CPUs")
+                cpus = max_cpus
+        
+        # named so we can find it again to watch its resource usage
+        localcontainername = args.container_name or re.sub(r'[^a-zA-Z0-9_.-]', '_', f"arclight-{buildid}")
+        
+        warmready = False
+        if args.warm:
+            localcontainername = util.warm.container_name(args.p4_workspace)
+            warmkey = util.warm.setup_key([containername, bootstrapbundle.hash, cpus, memory, containersettings['runisolation'], mountingMode, args.working], bootstrap_args)
+            warmready = util.warm.reuse(dockerenv, localcontainername, warmkey)
 
+        # The container's spans belong under this, so it needs to exist before the container does
+        runspan = Context("run", cpus = cpus, memory = memory, warm = args.warm)
+        
+        # Create the container first so we can copy bootstrap into it before it starts
+        # (a bind mount would be simpler, but those don't work with hyperv isolation)
         command = [
-            'docker', 'run',
+            'docker', 'create',
             
             # This used to be needed to solve a networking error
             # See https://forums.docker.com/t/dns-mechanism-with-windows-containers/104542
@@ -831,7 +1106,17 @@ def main() -> None:
                 '-v', f'{args.working}:{targetDir}',
             ]
          
+        if args.warm:
+            # `--rm` so it cleans up after itself when it's been idle long enough
+            command += [
+                "--rm",
+                "--label", f"{util.warm.label}={warmkey}",
+            ]
+        
         command += [
+            "--name", localcontainername,
+            "-e", f"ARCLIGHT_BOOTSTRAP_SHA256={bootstrapbundle.hash}",
+            "-e", f"{util.prof.trace_env}={util.prof.propagate(runspan.prof)}",
             f"--cpus={cpus}",
             f"--memory={memory}GB",
             f"--isolation={containersettings['runisolation']}",
@@ -839,8 +1124,13 @@ def main() -> None:
         ]
         
         command += bootstrap_args
-        command += ["--"]
-        command += args.script_args
+        command += ["--cpus", str(cpus), "--memory", str(memory)]
+        if args.warm:
+            # just the setup; the run itself gets exec'd in below
+            command += ["--warm_serve", str(args.warm_idle_minutes)]
+        else:
+            command += ["--"]
+            command += args.script_args
 
         # see https://stackoverflow.com/questions/11516258/what-is-the-equivalent-of-unbuffer-program-on-windows/44531837#44531837
         # for now, we just permit gnarly buffered output
@@ -848,10 +1138,96 @@ def main() -> None:
         #print("Please run the following command:")
         #print(' '.join(quote(c) for c in command))
 
-        # cwd doesn't really matter here
-        with Context("run"):
-            subprocess.check_call(command)
+        if not args.warm:
+            # the name has to be free, and a run that died (or another job that happened to get the same build number) might have left one behind
+            subprocess.call(['docker', 'rm', '-f', localcontainername], stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+        
+        try:
+            if not warmready:
+                subprocess.check_call(command)
+                subprocess.check_call([
+                    'docker', 'cp',
+                    bootstrapbundle.stage(os.path.join("arclight_cache", "bootstrap")),
+                    f"{localcontainername}:{util.bootstrap.containerdir}",
+                ])
+        
+            if args.warm and not warmready:
+                with Context("warm setup"):
+                    subprocess.check_call(['docker', 'start', localcontainername])
+                    util.warm.wait_ready(localcontainername)
+
+            # cwd doesn't really matter here
+            with runspan:
+                # picks the phases out of the output as it goes by
+                loganalyser = util.logphases.analyser(scriptsettings, runspan.prof)
+                with util.resource_profile.ContainerSampler(dockerenv, localcontainername) as sampler, loganalyser:
+                    if args.warm:
+                        # through the entrypoint, so the bundle gets verified same as always
+                        util.logphases.run([
+                            'docker', 'exec',
+                            "-e", f"ARCLIGHT_BOOTSTRAP_SHA256={bootstrapbundle.hash}",
+                            "-e", f"{util.prof.trace_env}={util.prof.propagate()}",
+                            localcontainername,
+                            'python', '-u', util.warm.entrypoint,
+                            '--warm_exec',
+                        ] + bootstrap_args + ["--cpus", str(cpus), "--memory", str(memory), "--"] + args.script_args, loganalyser)
+                        print(f"WARM: {localcontainername} stays up until it's been idle for {args.warm_idle_minutes:g} minutes")
+                    else:
+                        # `-a` streams the output and hands back the container's exit code, same as `docker run`
+                        util.logphases.run(['docker', 'start', '-a', localcontainername], loganalyser)
+        finally:
+            # a warm container is meant to outlive the run; anything else is done with once the sampler's let go of it
+            if not args.warm:
+                subprocess.call(['docker', 'rm', '-f', localcontainername], stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+        
+        for line in loganalyser.describe():
+            print(f"LOG: {line}")
+        
+        # only successful runs count; a run that died partway through tells us nothing about what a full one needs
+        util.resource_profile.record(profilekey, args.script, cpus, memory, sampler)
 
+    # bootstrap's reports land next to the output: downloaded into the current directory on AWS, or in the working directory locally
+    if args.aws:
+        reportprefix = outputprefix
+    elif mountingMode == "smb":
+        reportprefix = os.path.join(rootdir, outputprefix)
+    else:
+        reportprefix = os.path.join(args.working, outputprefix)
+    metricspath = f"{reportprefix}.metrics.json"
+    
+    # the full samples stay next to the output (see resource_sampler.py to read them); the summary's all we need here
+    if os.path.isfile(metricspath):
+        with open(metricspath, "r") as f:
+            resources = json.load(f).get("resources")
+        if resources is not None and resources["samples"] > 0:
+            print(f"RESOURCES: cpu {resources['cpu']['average_percent']:0.0f}% average ({resources['cpu']['saturated_percent']:0.0f}% of the time saturated), memory peak {resources['memory']['peak_percent']:0.0f}%, disk {resources['disk']['read_gb']:0.1f}GB read and {resources['disk']['write_gb']:0.1f}GB written, {resources['free_space']['min_gb']:0.1f}GB free at lowest")
+    
+    # What we asked AWS for goes in alongside what bootstrap measured (the same table prints at exit, including anything after this)
+    awscalls = util.awscalls.summary()
+    if len(awscalls) > 0 and os.path.isfile(metricspath):
+        with open(metricspath, "r") as f:
+            metrics = json.load(f)
+        metrics["aws_calls"] = awscalls
+        with open(metricspath, "w") as f:
+            json.dump(metrics, f, indent = 2)
+    
+    # One timeline for the whole job: bootstrap's trace already has the script's merged into it
+    if util.prof.merge(f"{reportprefix}.bootstrap.trace.json"):
+        os.remove(f"{reportprefix}.bootstrap.trace.json")
+    
+    # Keep the numbers, so we can tell when something's gotten slower (see history.py)
+    try:
+        util.history.record(util.prof.current(), metricspath,
+            build = buildid,
+            script = args.script,
+            stream = args.p4_stream,
+            workspace = args.p4_workspace,
+            mode = "aws" if args.aws else "managed" if args.managed else "inplace",
+            image = imagefingerprint)
+    except Exception as ex:
+        # the run itself worked, so this isn't worth failing it over
+        print(f"HISTORY: couldn't record this run ({type(ex).__name__}: {ex})")
+    
     print("SUCCESS!")
 
 if __name__ == "__main__":
@@ -0,0 +1,269 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from typing import Dict
+from typing import List
+
+# Offline orchestration benchmark.
+# Runs arclight's `--aws` and `--managed` flows with no network at all: AWS is moto, and p4, docker, SSH and the build script are the stand-ins in util/standins.py.
+# Every stand-in takes a fixed, configurable amount of time, so whatever else the run takes is orchestration: API calls, polling waits, and our own code.
+# Each flow runs in its own process (arclight keeps a fair bit of module-level state), in a scratch directory that's thrown away afterwards.
+#
+#   pipenv run python benchmark.py [--flow aws] [--latency aws=0.1] [--latency script=5]
+#   pipenv run python benchmark.py --save baseline.json
+#   pipenv run python benchmark.py --compare baseline.json   (exits 1 if anything got slower than --tolerance allows)
+#
+# Needs moto (it's in the Pipfile's dev-packages), but not Windows, Docker, p4 or AWS credentials.
+
+credentials = {
+    "aws_access_key_id": "benchmark",
+    "aws_secret_access_key": "benchmark",
+}
+
+p4_args = [
+    "--p4_username", "benchmark",
+    "--p4_password", "benchmark",
+    "--p4_server", "ssl:p4.invalid:1666",
+    "--p4_stream", "Benchmark_Mainline",
+]
+
+script_args = ["stub", "--message", "benchmark"]
+
+def flow_args(flow: str, scratch: str) -> List[str]:
+    if flow == "aws":
+        return ["--aws"] + p4_args + ["--p4_sync", "head"] + script_args
+    elif flow == "managed":
+        return ["--managed"] + p4_args + ["--p4_sync", "1000", "--p4_sync_from", "900", "--working", os.path.join(scratch, "work")] + script_args
+    raise Exception(f"unknown flow {flow}")
+
+flows = ["aws", "managed"]
+
+def critical_path(block, depth: int = 0) -> List[Dict]:
+    # The chain of spans the run actually waited on: starting from the end, the child that finished last, then whichever finished last before that one started, and so on.
+    # Anything off this chain could have been faster without the run finishing any sooner.
+    # Each entry's "self" is the time inside it that none of its own critical children account for, which is where untracked orchestration time shows up.
+    children = [child for child in list(block.children) if child.end is not None]
+    chain = []
+    cursor = block.end
+    while True:
+        candidates = [child for child in children if child.end <= cursor and child not in chain]
+        if len(candidates) == 0:
+            break
+        child = max(candidates, key = lambda child: child.end)
+        chain.append(child)
+        cursor = child.start
+    chain.reverse()
+
+    entries = [{
+        "span": block.label,
+        "depth": depth,
+        "seconds": block.end - block.start,
+        "self": (block.end - block.start) - sum(child.end - child.start for child in chain),
+    }]
+    for child in chain:
+        entries += critical_path(child, depth + 1)
+    return entries
+
+def run_child(flow: str, reportpath: str, latencies: Dict) -> None:
+    # Runs one flow in this process, in the current directory, and writes its report
+    scratch = os.getcwd()
+    os.makedirs("config", exist_ok = True)
+    with open(os.path.join("config", "credentials.json"), "w") as f:
+        json.dump(credentials, f)
+    os.makedirs("work", exist_ok = True)
+
+    os.environ["AWS_ACCESS_KEY_ID"] = credentials["aws_access_key_id"]
+    os.environ["AWS_SECRET_ACCESS_KEY"] = credentials["aws_secret_access_key"]
+    os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
+    os.environ.pop("BUILD-NUMBER", None)
+
+    # The stand-ins have to be in place before arclight (and util.aws) import the things they replace
+    import util.standins
+    util.standins.latency.update(latencies)
+    util.standins.install()
+
+    import platform
+    platform.system = lambda: "Windows"
+    os.getlogin = lambda: "benchmark"
+
+    import requests
+    realget = requests.get
+    class CheckIp:
+        content = b"203.0.113.1\n"
+    requests.get = lambda url, *args, **kwargs: CheckIp() if "checkip" in url else realget(url, *args, **kwargs)
+
+    import boto3
+    import moto
+
+    import arclight
+    import util.prof
+    import util.wincontainer_version
+
+    # Local runs would otherwise be hyperv, which means SMB, which means pywin32
+    util.wincontainer_version.local = util.wincontainer_version.aws_2019
+
+    # Polling waits are the serial waits we most want to see; counted by where they happen
+    waits = {}
+    realsleep = time.sleep
+    def sleep(seconds: float) -> None:
+        caller = sys._getframe(1)
+        site = f"{os.path.basename(caller.f_code.co_filename)}:{caller.f_lineno}"
+        waits.setdefault(site, {"count": 0, "seconds": 0})
+        waits[site]["count"] += 1
+        waits[site]["seconds"] += seconds
+        realsleep(seconds)
+    time.sleep = sleep
+
+    apicalls = {}
+    def before_call(model, **kwargs) -> None:
+        operation = f"{model.service_model.service_name}.{model.name}"
+        apicalls[operation] = apicalls.get(operation, 0) + 1
+        util.standins.simulate("aws", operation)
+
+    with moto.mock_aws():
+        # arclight's clients all come from the default session, so that's the one we count; ours come from a session of their own
+        boto3.setup_default_session(region_name = "us-east-1")
+        boto3.DEFAULT_SESSION.events.register("before-call", before_call)
+        harness = boto3.session.Session(region_name = "us-east-1")
+
+        # arclight needs something tagged arclight-* to base AMIs on (see ARCHITECTURE.md); we use it as the "slightly-old" AMI
+        ec2 = harness.client("ec2")
+        baseimage = ec2.describe_images(Owners = ["amazon"])["Images"][0]["ImageId"]
+        instance = ec2.run_instances(ImageId = baseimage, InstanceType = "m5a.large", MinCount = 1, MaxCount = 1)["Instances"][0]["InstanceId"]
+        ami = ec2.create_image(InstanceId = instance, Name = "arclight-base")["ImageId"]
+        ec2.create_tags(Resources = [ami], Tags = [{"Key": "Name", "Value": "arclight-benchmark"}, {"Key": "arclight-version", "Value": "2"}])
+        ec2.terminate_instances(InstanceIds = [instance])
+
+        # What bootstrap would leave in S3 when the container finishes
+        def remote_run(command: List[str]) -> None:
+            s3 = harness.client("s3")
+            s3filename = command[command.index("--output_s3") + 1]
+            s3.put_object(Bucket = "arclight", Key = f"{s3filename}.7z", Body = b"benchmark output")
+        util.standins.on_remote_run = remote_run
+
+        sys.argv = ["arclight.py"] + flow_args(flow, scratch)
+        start = time.perf_counter()
+        arclight.main()
+        wall = time.perf_counter() - start
+
+    time.sleep = realsleep
+
+    mainblock = [block for block in util.prof.root.children if block.label == "main"][-1]
+    with open(reportpath, "w") as f:
+        json.dump({
+            "flow": flow,
+            "wall_seconds": wall,
+            "simulated_seconds": sum(util.standins.simulated.values()),
+            "api_calls": apicalls,
+            "standins": util.standins.summary(),
+            "waits": waits,
+            "critical_path": critical_path(mainblock),
+        }, f, indent = 2)
+
+def describe(report: Dict) -> List[str]:
+    lines = []
+    simulated = report["simulated_seconds"]
+    lines.append(f"{report['flow']}: {report['wall_seconds']:0.2f}s wall clock, {simulated:0.2f}s of it simulated, {report['wall_seconds'] - simulated:0.2f}s orchestration")
+
+    apitotal = sum(report["api_calls"].values())
+    lines.append(f"  {apitotal} AWS API calls:")
+    for operation, count in sorted(report["api_calls"].items(), key = lambda item: -item[1]):
+        lines.append(f"    {count:4} {operation}")
+
+    lines.append("  stand-in calls:")
+    for what, count in sorted(report["standins"]["calls"].items(), key = lambda item: -item[1]):
+        if what not in report["api_calls"]:
+            lines.append(f"    {count:4} {what}")
+
+    if len(report["waits"]) > 0:
+        lines.append("  polling waits:")
+        for site, wait in sorted(report["waits"].items(), key = lambda item: -item[1]["seconds"]):
+            lines.append(f"    {wait['count']:4} at {site}, {wait['seconds']:0.1f}s")
+
+    lines.append("  critical path:")
+    for entry in report["critical_path"]:
+        lines.append(f"    {'  ' * entry['depth']}{entry['span']}: {entry['seconds']:0.2f}s ({entry['self']:0.2f}s outside child spans)")
+    return lines
+
+def compare(baseline: Dict, current: Dict, tolerance: float) -> List[str]:
+    # Returns what got worse: wall-clock orchestration time, or total API calls
+    problems = []
+    for flow, report in current.items():
+        if flow not in baseline:
+            continue
+        before = baseline[flow]["wall_seconds"] - baseline[flow]["simulated_seconds"]
+        after = report["wall_seconds"] - report["simulated_seconds"]
+        if after > before * (1 + tolerance):
+            problems.append(f"{flow}: orchestration went from {before:0.2f}s to {after:0.2f}s")
+
+        before = sum(baseline[flow]["api_calls"].values())
+        after = sum(report["api_calls"].values())
+        if after > before * (1 + tolerance):
+            problems.append(f"{flow}: AWS API calls went from {before} to {after}")
+    return problems
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--flow", help="Flow to run (default: all of them)", choices = flows, action = "append")
+    parser.add_argument("--latency", help="Simulated seconds for one kind of call, like `aws=0.1` (see util/standins.py for the kinds)", action = "append", default = [])
+    parser.add_argument("--save", help="Write the reports to this file, for --compare later")
+    parser.add_argument("--compare", help="Compare against reports saved with --save, and fail if anything got worse")
+    parser.add_argument("--tolerance", help="How much worse counts as worse, as a fraction", type = float, default = 0.2)
+    parser.add_argument("--verbose", help="Show arclight's own output", action = "store_true")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--report", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    latencies = {}
+    for latency in args.latency:
+        kind, _, seconds = latency.partition("=")
+        latencies[kind] = float(seconds)
+
+    if args.child is not None:
+        run_child(args.child, args.report, latencies)
+        sys.exit(0)
+
+    reports = {}
+    for flow in args.flow or flows:
+        with tempfile.TemporaryDirectory(prefix = f"arclight-benchmark-{flow}-") as scratch:
+            reportpath = os.path.join(scratch, "report.json")
+            logpath = os.path.join(scratch, "arclight.log")
+            command = [sys.executable, os.path.abspath(__file__), "--child", flow, "--report", reportpath] + sum([["--latency", latency] for latency in args.latency], [])
+            print(f"BENCHMARK: running {flow}")
+            if args.verbose:
+                result = subprocess.run(command, cwd = scratch)
+            else:
+                with open(logpath, "w") as log:
+                    result = subprocess.run(command, cwd = scratch, stdout = log, stderr = subprocess.STDOUT)
+            if result.returncode != 0:
+                if not args.verbose:
+                    with open(logpath, "r") as log:
+                        print(log.read())
+                raise Exception(f"{flow} failed")
+
+            with open(reportpath, "r") as f:
+                reports[flow] = json.load(f)
+
+        for line in describe(reports[flow]):
+            print(line)
+        print()
+
+    if args.save is not None:
+        with open(args.save, "w") as f:
+            json.dump(reports, f, indent = 2)
+        print(f"BENCHMARK: saved to {args.save}")
+
+    if args.compare is not None:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+        problems = compare(baseline, reports, args.tolerance)
+        for problem in problems:
+            print(f"BENCHMARK: {problem}")
+        if len(problems) > 0:
+            sys.exit(1)
+        print("BENCHMARK: no regressions")
@@ -1,171 +1,115 @@
 
-import boto3
-import datetime
-import dateutil
-import itertools
+# Cleans up expired arclight resources (see util/cleanup.py).
+#
+#   pipenv run python cleanup.py
+#   pipenv run python cleanup.py --dry_run
+#   pipenv run python cleanup.py --daemon
+
+import argparse
 import json
-import pprint
+import time
 
 import util.aws
-
-from typing import List
-from typing import Optional
-
-from util.simple_utc import simple_utc
+import util.cleanup
+import util.cost
+import util.ecrgc
+
+parser = argparse.ArgumentParser(prog = "Arclight cleanup")
+parser.add_argument("--dry_run", help="Just show what would be cleaned up, and in what order", action="store_true")
+parser.add_argument("--workers", help="Number of deletions to run at once", type=int, default=util.cleanup.default_workers)
+parser.add_argument("--ecr_keep_builds", help="Keep the images used by this many of the most recent builds on each stream", type=int, default=util.ecrgc.keep_builds)
+parser.add_argument("--daemon", help="Keep running, and clean each thing up as soon as its timeout passes", action="store_true")
+parser.add_argument("--refresh_seconds", help="With --daemon, how often to re-list one kind of resource (they're done in turn)", type=float, default=util.cleanup.default_refresh_seconds)
+args = parser.parse_args()
 
 with open("config/credentials.json", "r") as f:
     awscredentials = json.load(f)
 
 awsregion = "us-east-1"
-cleanup_version = 1
-current_version = 2
 
-ec2 = boto3.client('ec2',
+ec2 = util.aws.client('ec2',
     region_name=awsregion,
     aws_access_key_id = awscredentials["aws_access_key_id"],
-    aws_secret_access_key = awscredentials["aws_secret_access_key"])
+    aws_secret_access_key = awscredentials["aws_secret_access_key"],
+    config = util.cleanup.retry_config)
 
-def is_expired(taglist: List) -> bool:
-    version = util.aws.get_tag(taglist, "arclight-version")
-    if version is None:
-        return True
-    
-    if int(version) <= cleanup_version:
-        return True
-    
-    timestamp = util.aws.get_tag(taglist, "arclight-timeout")
-    if timestamp is None:
-        return False    # never expires
-    
-    timestamp = dateutil.parser.parse(timestamp)
-    if timestamp < datetime.datetime.now().replace(tzinfo=simple_utc()):
-        return True
+if args.daemon:
+    util.cleanup.daemon(ec2, args.refresh_seconds, args.workers, args.dry_run)
 
-def cleanup(category: str, extract = None, category_id: str = None, delete_name: str = None, destroy = None):
-    print()
-    print(f"{category}:")
-    
-    # set up defaults
-    # category is "internet_gateways"
-    category_singular = category[:-1] # internet_gateway
-    category_cap = "".join([word.capitalize() for word in category.split("_")]) # InternetGateways
-    category_cap_singular = category_cap[:-1] # InternetGateway
-    if category_id is None:
-        category_id = f"{category_cap_singular}Id" # InternetGatewayId
-    
-    if extract is None:
-        extract = lambda result: result[category_cap]
+start = time.time()
+found = util.cleanup.inventory(ec2, args.workers)
+resources = util.cleanup.plan(found)
 
-    if delete_name is None:
-        delete_name = f'delete_{category_singular}'
-    
-    # get functions
-    descr = getattr(ec2, f'describe_{category}')
-    if destroy is None: # otherwise we'll just be using destroy anyway
-        delete = getattr(ec2, delete_name)
-    
-    # list everything
-    # we're not providing a MaxResults so this should get us literally everything
-    results = [descr(Filters = [{'Name':'tag:Name', 'Values':['arclight-*']}])]
-    
-    # extract actual objects
-    items = list(itertools.chain.from_iterable([extract(result) for result in results]))
-    
-    for item in items:
-        name = util.aws.get_tag(item["Tags"], "Name")
-        if name is None:
-            name = item[category_id]
-        else:
-            name = f"{name} {item[category_id]}"
-        
-        if util.aws.get_tag(item["Tags"], "Name") == "arclight-base":
-            print(f"  Skipping {name}")
-            continue
-        
-        if is_expired(item["Tags"]):
-            print(f"  Cleaning up {name}")
-            if destroy is not None:
-                destroy(item[category_id])
-            else:
-                delete(**{category_id: item[category_id]})
+for kind in util.cleanup.kinds.keys():
+    print()
+    print(f"{kind}s:")
+    for resource in resources:
+        if resource.kind != kind:
             continue
+        if resource.state == "planned":
+            print(f"  Cleaning up {resource.name} ({resource.reason})")
+        else:
+            print(f"  Keeping {resource.name} ({resource.reason})")
 
-        print(f"  Keeping {name}")
-
-cleanup("images", delete_name = "deregister_image")
-cleanup("instances",
-    extract = lambda result: itertools.chain.from_iterable([reservation["Instances"] for reservation in result["Reservations"]]),
-    destroy = lambda instid: ec2.terminate_instances(InstanceIds = [instid]))
-cleanup("snapshots")
-cleanup("volumes")
-cleanup("subnets")
-cleanup("security_groups", category_id = "GroupId")
-cleanup("route_tables")
-def igw_cleanup(igwid):
-    ec2.detach_internet_gateway(InternetGatewayId = igwid)
-    ec2.delete_internet_gateway(InternetGatewayId = igwid)
-cleanup("internet_gateways", destroy = igw_cleanup) # must be after route_tables
-cleanup("vpcs") # must be after subnets, security_groups, route_tables, internet_gateways
-
-# Along with just killing straight-up expired snapshots, we want to wipe all snapshots that are older than the oldest complete snapshot in each (version, stream)
+print()
+print("dry run:" if args.dry_run else "cleaning up:")
+counts = util.cleanup.execute(ec2, resources, args.workers, args.dry_run)
+print(f"  {', '.join(f'{count} {state}' for state, count in counts.items())} in {time.time() - start:0.1f}s")
+
+# Whatever survived costs money just by existing, so say how much
+# Prices and assumptions are the same ones arclight's per-run cost breakdown uses (see util/cost.py)
 print("")
-print("obsolete snapshot processing:")
-for v in range(cleanup_version + 1, current_version + 1):
-    snapshots = ec2.describe_snapshots(Filters = [
-            {'Name': 'tag:Name', 'Values': ['arclight-*']},
-            {'Name': 'tag:arclight-version', 'Values': [str(v)]},
-        ])["Snapshots"]
-    
-    streams = {}
-    for snapshot in snapshots:
-        stream = util.aws.get_tag(snapshot["Tags"], "arclight-sig-stream")
-        if stream is None:
-            continue
-        
-        streams[stream] = True
+print("standing cost:")
+standing = {"amis": 0, "snapshots": 0, "volumes": 0}
+
+# what's left is what we listed, minus what we just deleted, so there's no need to ask again
+survivors = util.cleanup.survivors(found, resources)
+images = survivors["image"]
+imagesnapshots = {}
+for image in images:
+    for dev in image["BlockDeviceMappings"]:
+        if "Ebs" in dev and "SnapshotId" in dev["Ebs"]:
+            imagesnapshots[dev["Ebs"]["SnapshotId"]] = image
+
+# AMIs themselves are free; what we pay for is the snapshots behind them, so those get counted under the AMI instead of with the rest
+# Snapshots only store blocks that changed since the last one of the same volume, and we can't see how many that is, so the full size is an upper bound
+for snapshot in survivors["snapshot"]:
+    gb = snapshot["VolumeSize"]
+    if "FullSnapshotSizeInBytes" in snapshot:
+        gb = snapshot["FullSnapshotSizeInBytes"] / (1 << 30)
+    monthly = gb * util.cost.snapshot_gb_month
     
-    for stream in streams.keys():
-        print(f"  Processing v{v}-{stream}")
-        bestcl = 0
-        bestsnapshotid = None
-        
-        consideration = []
-        
-        for snapshot in snapshots:
-            if snapshot["State"] != "completed":
-                continue
-            
-            if util.aws.get_tag(snapshot["Tags"], "arclight-sig-stream") != stream:
-                continue
-            
-            thiscl = int(util.aws.get_tag(snapshot["Tags"], "arclight-sig-cl"))
-            if thiscl > bestcl:
-                bestcl = thiscl
-                bestsnapshotid = snapshot["SnapshotId"]
-
-        for snapshot in snapshots:
-            if util.aws.get_tag(snapshot["Tags"], "arclight-sig-stream") != stream:
-                continue
-            
-            sid = snapshot['SnapshotId']
-            if sid == bestsnapshotid:
-                print(f"    Keeping {sid} (@{bestcl} and complete)")
-                continue
-            
-            thiscl = int(util.aws.get_tag(snapshot["Tags"], "arclight-sig-cl"))
-            if thiscl > bestcl:
-                print(f"    Keeping {sid} (@{thiscl} > @{bestcl})")
-                continue
-                
-            if thiscl == bestcl:
-                print(f"    Cleaning up {sid} (@{thiscl} == @{bestcl} but not chosen)")
-            else:
-                print(f"    Cleaning up {sid} (@{thiscl} <= @{bestcl})")
-        
-            ec2.delete_snapshot(SnapshotId = sid)
-
-        print()
-
-# TODO: ecr cleanup
+    name = util.aws.get_tag(snapshot["Tags"], "Name")
+    if snapshot["SnapshotId"] in imagesnapshots:
+        image = imagesnapshots[snapshot["SnapshotId"]]
+        print(f"  AMI {name} {image['ImageId']} ({snapshot['SnapshotId']}, at most {gb:0.0f}GB): ${monthly:0.2f}/month")
+        standing["amis"] += monthly
+    else:
+        print(f"  Snapshot {name} {snapshot['SnapshotId']} (at most {gb:0.0f}GB): ${monthly:0.2f}/month")
+        standing["snapshots"] += monthly
+
+# Volumes cost the same attached or not; "available" ones are working volumes waiting to be reused
+for volume in survivors["volume"]:
+    monthly = util.cost.volume_monthly(volume["Size"], volume.get("Iops"), volume.get("Throughput"))
+    name = util.aws.get_tag(volume["Tags"], "Name")
+    print(f"  Volume {name} {volume['VolumeId']} ({volume['Size']}GB, {volume['State']}): ${monthly:0.2f}/month")
+    standing["volumes"] += monthly
+
+total = sum(standing.values())
+print(f"  AMIs ${standing['amis']:0.2f}, snapshots ${standing['snapshots']:0.2f}, volumes ${standing['volumes']:0.2f}")
+print(f"  Total ${total:0.2f}/month (${total / util.cost.hours_per_month * 24:0.2f}/day)")
+
+print("")
+print("ecr:")
+ecr = util.aws.client('ecr',
+    region_name=awsregion,
+    aws_access_key_id = awscredentials["aws_access_key_id"],
+    aws_secret_access_key = awscredentials["aws_secret_access_key"],
+    config = util.cleanup.retry_config)
+s3 = util.aws.client('s3',
+    aws_access_key_id = awscredentials["aws_access_key_id"],
+    aws_secret_access_key = awscredentials["aws_secret_access_key"])
+util.ecrgc.collect(ecr, s3, survivors, args.ecr_keep_builds, args.dry_run)
+
 # TODO: s3 cleanup
 # TODO: p4 cleanup
\ No newline at end of file
@@ -0,0 +1,73 @@
+
+# Run history (see util/history.py).
+#
+#   pipenv run python history.py trend
+#   pipenv run python history.py trend --by stream --script build --phase run
+#   pipenv run python history.py export
+#
+# `trend` exits with a nonzero status if anything regressed, so it can gate a CI job.
+
+import argparse
+import json
+import platform
+import sys
+
+import util.history
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog = "Arclight history")
+    commands = parser.add_subparsers(dest = "command", required = True)
+
+    trendcmd = commands.add_parser("trend", help="Show how each phase is trending, and flag regressions")
+    trendcmd.add_argument("--by", help="Group runs by script or by stream", choices=["script", "stream"], default="script")
+    trendcmd.add_argument("--script", help="Only runs of this script")
+    trendcmd.add_argument("--stream", help="Only runs on this stream")
+    trendcmd.add_argument("--phase", help="Only phases whose name contains this")
+    trendcmd.add_argument("--window", help="Number of runs before the recent ones to use as the baseline", type=int, default=10)
+    trendcmd.add_argument("--recent", help="Number of most recent runs to compare against the baseline", type=int, default=3)
+    trendcmd.add_argument("--alpha", help="Significance level for flagging a regression", type=float, default=0.05)
+    trendcmd.add_argument("--threshold", help="Minimum slowdown (as a fraction of the baseline) worth flagging", type=float, default=0.1)
+    trendcmd.add_argument("--regressions", help="Only show regressed phases", action="store_true")
+
+    exportcmd = commands.add_parser("export", help="Upload the history database to S3")
+    exportcmd.add_argument("--key", help="S3 key to upload to", default=f"{util.history.s3prefix}/{platform.node()}.sqlite3")
+
+    args = parser.parse_args()
+
+    if args.command == "trend":
+        db = util.history.connect()
+        series = util.history.series(db, args.by, script = args.script, stream = args.stream)
+        db.close()
+
+        regressed = 0
+        for (group, phase), values in sorted(series.items(), key = lambda item: (str(item[0][0]), item[0][1])):
+            if args.phase is not None and args.phase not in phase:
+                continue
+            result = util.history.regression(values, args.window, args.recent, args.alpha, args.threshold)
+            if result is None:
+                if not args.regressions:
+                    print(f"  {group} / {phase}: {len(values)} runs, latest {values[-1]:0.1f}s (not enough history to compare)")
+                continue
+            if result["regressed"]:
+                regressed += 1
+            elif args.regressions:
+                continue
+            flag = "REGRESSED" if result["regressed"] else "ok"
+            print(f"{'*' if result['regressed'] else ' '} {group} / {phase}: {result['baseline']:0.1f}s -> {result['recent']:0.1f}s ({result['change']:+0.0%}, p={result['p']:0.3f}) {flag}")
+
+        print(f"{regressed} regressed phase(s)")
+        if regressed > 0:
+            sys.exit(1)
+    elif args.command == "export":
+        import boto3
+
+        with open("config/credentials.json", "r") as f:
+            awscredentials = json.load(f)
+        s3 = boto3.client('s3',
+            aws_access_key_id = awscredentials["aws_access_key_id"],
+            aws_secret_access_key = awscredentials["aws_secret_access_key"])
+        s3.upload_file(util.history.historypath, "arclight", args.key)
+        print(f"HISTORY: uploaded {util.history.historypath} to s3://arclight/{args.key}")
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,11 @@
-
 import argparse
+import hashlib
+import json
 import os
 import pathlib
 import subprocess
+import sys
+import time
 
 parser = argparse.ArgumentParser()
 required = parser.add_argument_group('required arguments')
@@ -10,59 +13,141 @@ required.add_argument("--name", help=f"Container name used for the final image",
 required.add_argument("--isolation", help=f"Docker build isolation mode (either `process` or `hyperv`)", required=True)
 required.add_argument("--baseimage", help=f"Windows image to use", required=True)
 required.add_argument("--dllsrcimage", help=f"Windows image to copy files from", required=True)
+parser.add_argument("--force", help=f"Rebuild every stage even if its inputs haven't changed", action="store_true")
 args = parser.parse_args()
 
 # Get paths
 rootdir = pathlib.Path(__file__).parent
 ue4dockerdir = rootdir.joinpath('ue4-docker').resolve()
-    
+ue4dockerbuilddir = rootdir.joinpath('ue4-docker-build').resolve()
+
+# Each stage is fingerprinted on its own inputs (plus the fingerprint of whatever stage it builds on), and skipped if its output was built from the same thing.
+# Images remember their fingerprint in a label; stages that don't produce an image remember it in a stamp file next to this script.
+label = 'arclight.stage-fingerprint'
+stampspath = rootdir.joinpath('.arclight-stages.json')
+stamps = json.loads(stampspath.read_text()) if stampspath.is_file() else {}
+timings = []
+
+# bootstrap and its helpers are handed to the container at runtime, so they don't belong to the image
+# (the list lives in arclight's util/bootstrap.py, so adding a helper there is all it takes)
+sys.path.insert(0, str(rootdir.parent.parent))
+import util.bootstrap
+runtimefiles = util.bootstrap.runtime_files
+
+def fingerprint(paths, data):
+    h = hashlib.sha256()
+    for path in paths:
+        path = pathlib.Path(path)
+        files = [path] if path.is_file() else sorted(p for p in path.rglob('*') if p.is_file())
+        for file in files:
+            # build and packaging leftovers would change the fingerprint without changing anything real
+            if any(part in ('__pycache__', 'build', 'dist') or part.endswith('.egg-info') for part in file.relative_to(path).parts[:-1]) or file.suffix == '.pyc' or file.name in runtimefiles:
+                continue
+            h.update(file.relative_to(path.parent).as_posix().encode('utf-8') + b'\0')
+            h.update(hashlib.sha256(file.read_bytes()).hexdigest().encode('utf-8') + b'\0')
+    h.update(json.dumps(data, sort_keys = True).encode('utf-8'))
+    return h.hexdigest()[:20]
+
+def image_fingerprint(image):
+    result = subprocess.run(['docker', 'image', 'inspect', '--format', f'{{{{ index .Config.Labels "{label}" }}}}', image], capture_output = True, text = True)
+    if result.returncode != 0:
+        return None
+    return result.stdout.strip()
+
+def stage(name, fingerprint, current, build):
+    # `current` is the fingerprint the existing output was built from, or None if there is no output
+    start = time.time()
+    if not args.force and current == fingerprint:
+        print(f"STAGE: {name} is up to date ({fingerprint}), skipping")
+        timings.append((name, 'skipped', time.time() - start))
+        return
+    print(f"STAGE: building {name} ({fingerprint})")
+    build()
+    timings.append((name, 'built', time.time() - start))
+
+def save_stamp(name, fingerprint):
+    stamps[name] = fingerprint
+    stampspath.write_text(json.dumps(stamps, indent = 2))
+
+# Fingerprint everything up front, so we know what the final image would be built from before doing any work
+ue4dockersources = [ue4dockerdir.joinpath('setup.py'), ue4dockerdir.joinpath('ue4docker')]
+installfp = fingerprint(ue4dockersources + [ue4dockerdir.joinpath('Pipfile'), ue4dockerdir.joinpath('Pipfile.lock')], {})
+layoutfp = fingerprint([], {'install': installfp, 'isolation': args.isolation})
+setupfp = fingerprint([rootdir.joinpath('setup')], {'baseimage': args.baseimage, 'isolation': args.isolation})
+prerequisitesfp = fingerprint([], {'setup': setupfp, 'layout': layoutfp, 'dllsrcimage': args.dllsrcimage, 'isolation': args.isolation})
+environmentfp = fingerprint([rootdir.joinpath('environment')], {'prerequisites': prerequisitesfp, 'isolation': args.isolation})
+
 # First we need to get ue4-docker up and running and generating output
-# Install pipenv
-subprocess.check_call(['pip', 'install', 'pipenv'])
+def install():
+    # Install pipenv
+    subprocess.check_call(['pip', 'install', 'pipenv'])
 
-# Make the environment
-subprocess.check_call(['pipenv', 'run', 'pip', 'install', '.'], cwd = ue4dockerdir)
+    # Make the environment
+    subprocess.check_call(['pipenv', 'run', 'pip', 'install', '.'], cwd = ue4dockerdir)
+    save_stamp('install', installfp)
 
-# Actually kick off the ue4-docker build-prerequisites Dockerfile generation
-ue4dockerbuilddir = rootdir.joinpath('ue4-docker-build').resolve()
-subprocess.check_call([
-        'pipenv', 'run', 'ue4-docker', 'build',
-        '-layout', ue4dockerbuilddir,
-        '--target', 'build-prerequisites',
-        '-isolation', args.isolation,
-        '-basetag', 'abba', # this is basically ignored, we have to specify it when doing the docker build manually
-    ],
-    cwd = ue4dockerdir)
+def layout():
+    # Actually kick off the ue4-docker build-prerequisites Dockerfile generation
+    # (this wipes and rewrites the whole directory, which is why we avoid it when we can)
+    subprocess.check_call([
+            'pipenv', 'run', 'ue4-docker', 'build',
+            '-layout', ue4dockerbuilddir,
+            '--target', 'build-prerequisites',
+            '-isolation', args.isolation,
+            '-basetag', 'abba', # this is basically ignored, we have to specify it when doing the docker build manually
+        ],
+        cwd = ue4dockerdir)
+    save_stamp('layout', layoutfp)
 
 # Build the setup Dockerfile, which contains things that need to happen before build-prerequisites
-subprocess.check_call([
-        'docker', 'build',
-        '-t', 'airship/setup',
-        'setup',
-        '--build-arg', f'BASEIMAGE=mcr.microsoft.com/windows/servercore:{args.baseimage}',
-        f'--isolation={args.isolation}',
-    ],
-    cwd = rootdir)
+def setup():
+    subprocess.check_call([
+            'docker', 'build',
+            '-t', 'airship/setup',
+            'setup',
+            '--build-arg', f'BASEIMAGE=mcr.microsoft.com/windows/servercore:{args.baseimage}',
+            '--label', f'{label}={setupfp}',
+            f'--isolation={args.isolation}',
+        ],
+        cwd = rootdir)
 
 # Build the build-prerequisites Dockerfile
-print("Building build-prerequisites Dockerfile, this takes forever and there's no easy way to get realtime output in this script, sorry . . .")
-# see https://stackoverflow.com/questions/11516258/what-is-the-equivalent-of-unbuffer-program-on-windows/44531837#44531837
-subprocess.check_call([
-        'docker', 'build',
-        '-t', 'airship/ue4-build-prerequisites',
-        'ue4-docker-build/ue4-build-prerequisites',
-        '--build-arg', f'BASEIMAGE=airship/setup',
-        '--build-arg', f'DLLSRCIMAGE=mcr.microsoft.com/windows:{args.dllsrcimage}',
-        '--build-arg', 'VISUAL_STUDIO_BUILD_NUMBER=16', # VS 2019; 2017 or earlier has a difficult-to-work-around bug in hyperv-isolated builds with debug info (https://github.com/docker/for-win/issues/829)
-        f'--isolation={args.isolation}',
-    ],
-    cwd = rootdir)
+def prerequisites():
+    # the layout is only needed if we're actually building this, and it's the only thing that needs ue4-docker installed
+    stage('ue4-docker install', installfp, stamps.get('install'), install)
+    stage('ue4-docker layout', layoutfp, stamps.get('layout') if ue4dockerbuilddir.is_dir() else None, layout)
+
+    print("Building build-prerequisites Dockerfile, this takes forever and there's no easy way to get realtime output in this script, sorry . . .")
+    # see https://stackoverflow.com/questions/11516258/what-is-the-equivalent-of-unbuffer-program-on-windows/44531837#44531837
+    subprocess.check_call([
+            'docker', 'build',
+            '-t', 'airship/ue4-build-prerequisites',
+            'ue4-docker-build/ue4-build-prerequisites',
+            '--build-arg', f'BASEIMAGE=airship/setup',
+            '--build-arg', f'DLLSRCIMAGE=mcr.microsoft.com/windows:{args.dllsrcimage}',
+            '--build-arg', 'VISUAL_STUDIO_BUILD_NUMBER=16', # VS 2019; 2017 or earlier has a difficult-to-work-around bug in hyperv-isolated builds with debug info (https://github.com/docker/for-win/issues/829)
+            '--label', f'{label}={prerequisitesfp}',
+            f'--isolation={args.isolation}',
+        ],
+        cwd = rootdir)
 
 # Build our arclight environment
-subprocess.check_call([
-        'docker', 'build',
-        '-t', args.name,
-        'environment',
-        f'--isolation={args.isolation}',
-    ],
-    cwd = rootdir)
+# It's also kept under a fixed name, so a later build with a different --name can pick it up instead of rebuilding
+def environment():
+    subprocess.check_call([
+            'docker', 'build',
+            '-t', 'airship/environment',
+            'environment',
+            '--label', f'{label}={environmentfp}',
+            f'--isolation={args.isolation}',
+        ],
+        cwd = rootdir)
+
+stage('setup', setupfp, image_fingerprint('airship/setup'), setup)
+stage('build-prerequisites', prerequisitesfp, image_fingerprint('airship/ue4-build-prerequisites'), prerequisites)
+stage('environment', environmentfp, image_fingerprint('airship/environment'), environment)
+subprocess.check_call(['docker', 'tag', 'airship/environment', args.name])
+
+print("Stage timings:")
+for name, result, seconds in timings:
+    print(f"  {name:<24}{result:<10}{seconds:8.1f}s")
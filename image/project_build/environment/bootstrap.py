@@ -1,21 +1,37 @@
 
 import argparse
+import asyncio
+import atexit
 import boto3
+import json
 import multiprocessing
 import os
 import pathlib
 import pprint
+import psutil
 import re
 import shutil
-import socket
+import ssl
 import subprocess
 import sys
 import time
+import urllib.parse
+import urllib.request
+
+import delta
+import output_packaging
+import prof
+import resource_sampler
+import staging
+
+from prof import Context
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--smb_username", help="Username for SMB mounting")
 parser.add_argument("--smb_password", help="Password for SMB mounting")
 parser.add_argument("--smb_share", help="Share for SMB mounting")
+parser.add_argument("--smb_stage", help="Copy the SMB workdir into this container-local directory, run there, and copy changes back afterwards")
+parser.add_argument("--smb_stage_workers", help="Number of files to copy at once while staging", type=int, default=staging.default_workers)
 
 parser.add_argument("--p4_sync", help=f"Sync via p4 to this changelist")
 parser.add_argument("--p4_patch", help="Comma-separated list of changelists to unshelve after sync (optional, prevents snapshot)")
@@ -27,8 +43,13 @@ required.add_argument("--init-drive", help=f"Whether to initialize the drive fro
 required.add_argument("--workdir", help=f"Working directory to use", required=True)
 required.add_argument("--output", help=f"Output directory to use within workdir", required=True)
 required.add_argument("--output_compress", help=f"Whether to compress the output file", action="store_true")
-required.add_argument("--output_s3", help=f"Path to upload the file to on s3 (requires output_compress, requires aws config)")
+required.add_argument("--output_packaging", help=f"Codec to compress the output file with ({', '.join(output_packaging.codecs.keys())})", default=output_packaging.default)
+required.add_argument("--output_s3", help=f"Path to upload the file to on s3, minus the packaging's file extension (requires output_compress, requires aws config)")
+required.add_argument("--output_delta_key", help=f"Package the output as a delta against the previous output stored under this key on the working volume (requires output_compress)")
+required.add_argument("--output_delta_base", help=f"ID of the previous output the requester already has; if ours doesn't match, we send a full artifact instead")
 required.add_argument("--script", help=f"Target script name to run", required=True)
+required.add_argument("--cpus", help=f"CPU limit the container was started with", type=float)
+required.add_argument("--memory", help=f"Memory limit the container was started with, in gigabytes", type=float)
 
 p4info = parser.add_argument_group('p4 configuration')
 p4info.add_argument("--p4_username", help="Username for p4", required=True)
@@ -41,35 +62,327 @@ awsinfo = parser.add_argument_group('aws configuration')
 awsinfo.add_argument("--aws_access_key_id")
 awsinfo.add_argument("--aws_secret_access_key")
 
+preflight = parser.add_argument_group('network preflight')
+preflight.add_argument("--preflight_ecr", help="ECR registry host to check (optional)")
+preflight.add_argument("--preflight_s3_sample", help="Key of an object in the arclight bucket to sample S3 throughput with (optional, requires aws config)")
+preflight.add_argument("--preflight_sample_bytes", help="Maximum number of bytes to download for each throughput sample", type=int, default=8 << 20)
+preflight.add_argument("--preflight_min_mbps", help="Minimum acceptable throughput in megabits/sec; anything slower fails the run, or switches to the proxy if one is given", type=float, default=0)
+preflight.add_argument("--preflight_proxy", help="HTTP(S) proxy to switch to if throughput is below the minimum")
+
+warmargs = parser.add_argument_group('warm containers (see arclight\'s util/warm.py)')
+warmargs.add_argument("--warm_serve", help="Set up, then wait for runs to be exec'd in; exits after this many minutes without one", type=float)
+warmargs.add_argument("--warm_exec", help="Run in a container that's already been set up with --warm_serve", action="store_true")
+
 args = parser.parse_args()
 
 if args.init_drive:
     print("init_drive specified but not yet supported")
     raise Exception(1)
 
-# Check to see if we have Internet and DNS access - it's apparently common for Docker's networking to throw a cog and I'd rather get a clean error message here
-try:
-	s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-	s.settimeout(3)
-	s.connect(("8.8.8.8", 53)) # using Google's DNS server to check connectivity
-	s.close()
-except socket.error as ex:
-	print(ex)
-	s.close()
-	raise Exception("No Internet access; is your Docker network configured properly?")
-try:
-    socket.getaddrinfo("google.com", 80)
-except socket.error as ex:
-    raise Exception("No DNS access; is your Docker network configured properly?")
-
-if args.smb_username:
-    print(f"Mounting SMB share {args.smb_share} in {args.workdir} . . .")
-    subprocess.check_call([
-            'net', 'use',
-            args.workdir[0:2],
-            args.smb_share,
-            f'/user:{args.smb_username}', args.smb_password,
-        ])
+# Warm containers: `--warm_serve` does everything up to the sync and then idles, and `--warm_exec` runs the rest against what it left behind.
+# Processes can't share a p4 connection, but the trust, login ticket and client root symlink all live on the container's disk, and that's the slow part.
+warmdir = "c:\\arclight_warm"
+warmstate = os.path.join(warmdir, "state.json")
+warmactivity = os.path.join(warmdir, "activity")
+warmbusy = os.path.join(warmdir, "busy")
+warm_ready_marker = "WARM: ready"   # arclight's util/warm.py waits for this
+
+def warm_touch():
+    with open(warmactivity, "w") as f:
+        f.write(str(time.time()))
+
+def warm_busy_owner():
+    # The busy marker holds the pid and start time of the run that made it; returns them, or None if there's no marker or its run is gone
+    # (a run that gets killed never reaches its atexit, and we don't want that to wedge the container until someone removes it by hand)
+    try:
+        with open(warmbusy, "r") as f:
+            owner = f.read()
+    except FileNotFoundError:
+        return None
+
+    try:
+        pid, started = owner.split()
+        if psutil.Process(int(pid)).create_time() == float(started):
+            return owner
+    except psutil.AccessDenied:
+        # it's there, we just aren't allowed to look at it
+        return owner
+    except (ValueError, psutil.NoSuchProcess):
+        pass
+
+    # stale; clear it, unless someone's already replaced it with their own
+    print(f"WARM: clearing busy marker left by a run that's gone ({owner.strip() or 'empty'})")
+    try:
+        with open(warmbusy, "r") as f:
+            if f.read() == owner:
+                os.remove(warmbusy)
+    except FileNotFoundError:
+        pass
+    return None
+
+if args.warm_exec:
+    if not os.path.isfile(warmstate):
+        raise Exception("--warm_exec given, but this container was never set up with --warm_serve")
+    with open(warmstate, "r") as f:
+        warm = json.load(f)
+
+    # one run at a time; they'd be sharing a workspace
+    if warm_busy_owner() is not None:
+        raise Exception("warm container is already running something; wait for it to finish or run without --warm")
+    # written aside and linked into place, so nobody ever sees a half-written marker and takes it for a stale one
+    claim = f"{warmbusy}.{os.getpid()}"
+    with open(claim, "w") as f:
+        f.write(f"{os.getpid()} {psutil.Process().create_time()}")
+    try:
+        os.link(claim, warmbusy)
+    except FileExistsError:
+        raise Exception("warm container is already running something; wait for it to finish or run without --warm")
+    finally:
+        os.remove(claim)
+    warm_touch()
+
+    @atexit.register
+    def warm_release():
+        # touched again on the way out, so the idle timer starts from when we finished
+        warm_touch()
+        os.remove(warmbusy)
+
+# Metrics about this run; written next to the output (and uploaded next to it, if we're uploading) once everything's done
+metrics = {}
+
+# Network preflight.
+# It's apparently common for Docker's networking to throw a cog and I'd rather get a clean error message here.
+# But we also want to know *how good* the network is to everything we depend on; a slow p4 or S3 path otherwise only shows up hours later as a slow build.
+# Everything here runs concurrently, so the whole thing takes about as long as the slowest single probe.
+preflight_timeout = 5
+
+def split_hostport(server: str, defaultport: int):
+    # p4 servers look like `ssl:perforce.example.com:1666`, `perforce.example.com:1666`, or just `1666` for localhost
+    parts = server.split(":")
+    if len(parts) > 1 and not parts[0].isdigit() and parts[0] in ["ssl", "ssl4", "ssl6", "tcp", "tcp4", "tcp6"]:
+        parts = parts[1:]
+    if len(parts) == 1:
+        if parts[0].isdigit():
+            return "localhost", int(parts[0])
+        return parts[0], defaultport
+    return parts[0], int(parts[1])
+
+async def probe_dns(host: str):
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    await asyncio.wait_for(loop.getaddrinfo(host, None), preflight_timeout)
+    return {"host": host, "resolve_ms": (time.perf_counter() - start) * 1000}
+
+async def probe_rtt(host: str, port: int, attempts: int = 3):
+    # TCP connect time is a decent stand-in for RTT and doesn't need any protocol support; take the best of a few so one dropped SYN doesn't ruin it
+    best = None
+    for _ in range(attempts):
+        start = time.perf_counter()
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), preflight_timeout)
+        elapsed = (time.perf_counter() - start) * 1000
+        writer.close()
+        await writer.wait_closed()
+        best = elapsed if best is None else min(best, elapsed)
+    return {"host": host, "port": port, "rtt_ms": best}
+
+async def probe_throughput(url: str, maxbytes: int):
+    # Hand-rolled HTTP GET so we can stop after a fixed number of bytes, without pulling in an async HTTP library
+    parsed = urllib.parse.urlsplit(url)
+    port = parsed.port or (443 if parsed.scheme == "https" else 80)
+    sslcontext = ssl.create_default_context() if parsed.scheme == "https" else None
+    path = parsed.path + (f"?{parsed.query}" if parsed.query else "")
+
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(parsed.hostname, port, ssl = sslcontext), preflight_timeout)
+    try:
+        writer.write((
+            f"GET {path} HTTP/1.1\r\n"
+            f"Host: {parsed.hostname}\r\n"
+            f"Range: bytes=0-{maxbytes - 1}\r\n"
+            f"Connection: close\r\n"
+            f"\r\n").encode("utf-8"))
+        await writer.drain()
+
+        status = await asyncio.wait_for(reader.readline(), preflight_timeout)
+        if b" 200 " not in status and b" 206 " not in status:
+            raise Exception(f"unexpected response {status.decode('utf-8', 'replace').strip()}")
+        await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), preflight_timeout)
+
+        # time only the body, so we're measuring bandwidth rather than latency
+        received = 0
+        start = time.perf_counter()
+        while received < maxbytes:
+            chunk = await asyncio.wait_for(reader.read(1 << 16), preflight_timeout)
+            if not chunk:
+                break
+            received += len(chunk)
+        elapsed = time.perf_counter() - start
+    finally:
+        writer.close()
+
+    return {"bytes": received, "seconds": elapsed, "mbps": received * 8 / 1e6 / max(elapsed, 1e-6)}
+
+def probe_throughput_proxied(url: str, maxbytes: int, proxy: str):
+    # The same measurement through an HTTP(S) proxy; urllib does the CONNECT dance for us, and this only runs once, so it needn't be async
+    opener = urllib.request.build_opener(urllib.request.ProxyHandler({"http": proxy, "https": proxy}))
+    request = urllib.request.Request(url, headers = {"Range": f"bytes=0-{maxbytes - 1}"})
+    with opener.open(request, timeout = preflight_timeout) as response:
+        received = 0
+        start = time.perf_counter()
+        while received < maxbytes:
+            chunk = response.read(1 << 16)
+            if not chunk:
+                break
+            received += len(chunk)
+        elapsed = time.perf_counter() - start
+
+    return {"bytes": received, "seconds": elapsed, "mbps": received * 8 / 1e6 / max(elapsed, 1e-6)}
+
+async def preflight_target(name: str, host: str, port: int, sampleurl = None):
+    result = {"name": name}
+    try:
+        result.update(await probe_rtt(host, port))
+        if sampleurl is not None:
+            result.update(await probe_throughput(sampleurl, args.preflight_sample_bytes))
+    except Exception as ex:
+        result["error"] = f"{type(ex).__name__}: {ex}"
+    return result
+
+async def preflight_dns(hosts):
+    result = {"name": "dns"}
+    try:
+        lookups = await asyncio.gather(*[probe_dns(host) for host in hosts])
+        result["hosts"] = lookups
+        result["resolve_ms"] = max(lookup["resolve_ms"] for lookup in lookups)
+    except Exception as ex:
+        result["error"] = f"{type(ex).__name__}: {ex}"
+    return result
+
+def preflight_sample_url():
+    # None if we've got nothing to measure throughput against
+    if args.preflight_s3_sample is None or args.aws_access_key_id is None:
+        return None
+
+    # presigning doesn't touch the network, so it's fine to do it from the event loop
+    return boto3.client('s3', aws_access_key_id = args.aws_access_key_id, aws_secret_access_key = args.aws_secret_access_key).generate_presigned_url(
+        "get_object", Params = {"Bucket": "arclight", "Key": args.preflight_s3_sample}, ExpiresIn = 600)
+
+async def preflight_all():
+    p4host, p4port = split_hostport(args.p4_server, 1666)
+
+    s3url = preflight_sample_url()
+    s3host = urllib.parse.urlsplit(s3url).hostname if s3url is not None else "arclight.s3.amazonaws.com"
+
+    targets = [
+        preflight_dns([host for host in [p4host, s3host, args.preflight_ecr] if host is not None]),
+        preflight_target("p4", p4host, p4port),
+        preflight_target("s3", s3host, 443, s3url),
+    ]
+    if args.preflight_ecr is not None:
+        # ECR layer downloads are actually served out of S3, so the S3 sample covers its bandwidth
+        targets += [preflight_target("ecr", args.preflight_ecr, 443)]
+
+    return await asyncio.gather(*targets)
+
+def preflight_report(results):
+    for result in results:
+        if "error" in result:
+            print(f"  {result['name']}: FAILED ({result['error']})")
+            continue
+
+        line = f"  {result['name']}:"
+        if "rtt_ms" in result:
+            line += f" rtt {result['rtt_ms']:0.1f}ms"
+        if "resolve_ms" in result:
+            line += f" resolve {result['resolve_ms']:0.1f}ms"
+        if "mbps" in result:
+            line += f", {result['mbps']:0.1f}Mbps over {result['bytes']} bytes"
+        print(line)
+
+if args.warm_exec:
+    # the warm container checked this when it started; if it's gone bad since, p4 will tell us soon enough
+    print("Skipping network preflight in warm container")
+    preflight_results = []
+    metrics["warm"] = True
+    if warm["proxy"] is not None:
+        print(f"Using proxy {warm['proxy']} chosen by the warm container's preflight")
+        os.environ["HTTP_PROXY"] = warm["proxy"]
+        os.environ["HTTPS_PROXY"] = warm["proxy"]
+else:
+    print("Running network preflight . . .")
+    preflight_start = time.perf_counter()
+    with Context("preflight"):
+        preflight_results = asyncio.run(preflight_all())
+    preflight_report(preflight_results)
+    metrics["preflight"] = {
+        "seconds": time.perf_counter() - preflight_start,
+        "targets": preflight_results,
+    }
+
+failed = [result for result in preflight_results if "error" in result]
+if len(failed) > 0:
+    if any(result["name"] == "dns" for result in failed):
+        raise Exception("No DNS access; is your Docker network configured properly?")
+    raise Exception(f"Can't reach {', '.join(result['name'] for result in failed)}; is your Docker network configured properly?")
+
+# Only the S3 sample measures throughput, so without one there's nothing to hold to the minimum
+if args.preflight_min_mbps > 0 and not args.warm_exec and not any("mbps" in result for result in preflight_results):
+    print("WARNING: `--preflight_min_mbps` given, but nothing measured throughput (that needs `--preflight_s3_sample` and AWS credentials); not checking it")
+
+slow = [result for result in preflight_results if "mbps" in result and result["mbps"] < args.preflight_min_mbps]
+if len(slow) > 0:
+    summary = ", ".join(f"{result['name']} at {result['mbps']:0.1f}Mbps" for result in slow)
+    if args.preflight_proxy is None:
+        raise Exception(f"Network too slow ({summary}, minimum {args.preflight_min_mbps}Mbps); aborting before we waste hours on it")
+
+    # Don't take the proxy on faith; it's only worth switching to if it actually gets us over the line
+    print(f"Network too slow ({summary}); trying proxy {args.preflight_proxy}")
+    with Context("preflight proxy"):
+        try:
+            proxied = probe_throughput_proxied(preflight_sample_url(), args.preflight_sample_bytes, args.preflight_proxy)
+        except Exception as ex:
+            proxied = {"error": f"{type(ex).__name__}: {ex}"}
+    metrics["preflight"]["proxy_probe"] = proxied
+    if "error" in proxied:
+        raise Exception(f"Network too slow ({summary}, minimum {args.preflight_min_mbps}Mbps), and proxy {args.preflight_proxy} didn't work either ({proxied['error']})")
+    if proxied["mbps"] < args.preflight_min_mbps:
+        raise Exception(f"Network too slow ({summary}, minimum {args.preflight_min_mbps}Mbps), and only {proxied['mbps']:0.1f}Mbps through proxy {args.preflight_proxy}")
+
+    # boto3 and most of our HTTP tooling honor these; p4 doesn't, but p4 isn't something a web proxy would help with anyway
+    print(f"Proxy {args.preflight_proxy} manages {proxied['mbps']:0.1f}Mbps; switching to it")
+    os.environ["HTTP_PROXY"] = args.preflight_proxy
+    os.environ["HTTPS_PROXY"] = args.preflight_proxy
+    metrics["preflight"]["proxy"] = args.preflight_proxy
+
+# Drive mappings belong to a logon session, and an exec'd process may not get the warm container's, so check rather than assume
+if args.smb_username and not (args.warm_exec and os.path.isdir(args.workdir[0:2])):
+    with Context("smb mount"):
+        print(f"Mounting SMB share {args.smb_share} in {args.workdir} . . .")
+        subprocess.check_call([
+                'net', 'use',
+                args.workdir[0:2],
+                args.smb_share,
+                f'/user:{args.smb_username}', args.smb_password,
+            ])
+
+# Everything from here on (p4 included) works in the stage instead; see staging.py
+# Our reports (metrics and trace) still go next to the output's real location, since they're written after we've copied back
+smbworkdir = None
+reportoutput = args.output
+if args.smb_stage is not None:
+    print(f"Staging {args.workdir} into {args.smb_stage} . . .")
+    with Context("stage in") as span:
+        stats = staging.stage_in(args.workdir, args.smb_stage, args.smb_stage_workers)
+        span.set(bytes = stats["copied_bytes"], files = stats["copied"])
+    print(f"STAGE: in: {staging.describe(stats)}")
+    metrics["staging"] = {"in": stats}
+
+    smbworkdir = args.workdir
+    if os.path.normcase(args.output).startswith(os.path.normcase(args.workdir)):
+        args.output = os.path.join(args.smb_stage, os.path.relpath(args.output, args.workdir))
+    args.workdir = args.smb_stage
+
+    # mostly for script/smb_benchmark.py, which wants to compare against the share
+    os.environ["ARCLIGHT_SMB_WORKDIR"] = smbworkdir
 
 # chop off the -- prefix if we have one
 if args.script_args is not None and len(args.script_args) >= 1 and args.script_args[0] == "--":
@@ -82,124 +395,182 @@ env = os.environ.copy()
 
 # Right now this should always be the case
 if args.p4_username is not None:
-    import P4
-    
-    print(f"Connecting to p4 server {args.p4_server} as {args.p4_username} with {args.p4_workspace}")
-    
-    # Put together the p4 workspace
-    p4 = P4.P4()
-    p4.user = args.p4_username
-    p4.password = args.p4_password
-    p4.port = args.p4_server
-    p4.client = args.p4_workspace
-    
-    pprint.pprint(p4)
-    
-    p4.connect()
-    
-    # Trust up; we got the ID from upstream
-    p4.run_trust("-i", args.p4_fingerprint)
-    
-    # Now we can actually login (normally this is implicit, but trust failures break that pathway)
-    p4.run_login()
-
-    # This is a little gnarly. `args.workdir` tells us where we should expect our data to show up.
-    # Unfortunately, p4 is very opinionated about what directory it's willing to access.
-    # What we actually want to do is map our working directory onto whatever p4 is expecting
-    # This can be done with a combination of subst and symlinks, but it's gnarly no matter what we do
-    # I expect we'll be dealing with new issues here for a while.
-    client = p4.run_client("-o", args.p4_workspace)
-    
-    # Right now, we assume the client root doesn't already exist as a directory.
-    # If you've put your Perforce repo in `c:\windows` and remapped Windows to D:,
-    # all so the Docker container gets confused when the p4 repo conflicts with its system directory, then, uh . . .
-    # . . . don't do that, I guess?
-    # I'm not sure what fix there could be for this.
-    clientrootdir = client[0]["Root"]
-    if clientrootdir != args.workdir:
-        print(f"Client root currently located in {args.workdir}, should be {clientrootdir}; generating symlink")
-        if os.path.isdir(clientrootdir) or os.path.isfile(clientrootdir):
-            raise Exception("Directory {clientrootdir} already exists in Docker! Not sure how to handle this, aborting.")
-
-        drive = clientrootdir[0:2]
-        if not os.path.isdir(drive):
-            print(f"  Creating fake drive {drive}")
-            stubdir = "c:\\mnt"
-            os.mkdir(stubdir)
+    with Context("p4 setup"):
+        import P4
+        
+        print(f"Connecting to p4 server {args.p4_server} as {args.p4_username} with {args.p4_workspace}")
+        
+        # Put together the p4 workspace
+        p4 = P4.P4()
+        p4.user = args.p4_username
+        p4.password = args.p4_password
+        p4.port = args.p4_server
+        p4.client = args.p4_workspace
+        
+        pprint.pprint(p4)
+        
+        p4.connect()
+        
+        if args.warm_exec:
+            # trust and login ticket are already on disk from --warm_serve
+            print("Reusing warm container's p4 trust and login")
+        else:
+            # Trust up; we got the ID from upstream
+            p4.run_trust("-i", args.p4_fingerprint)
+            
+            # Now we can actually login (normally this is implicit, but trust failures break that pathway)
+            p4.run_login()
+
+        # This is a little gnarly. `args.workdir` tells us where we should expect our data to show up.
+        # Unfortunately, p4 is very opinionated about what directory it's willing to access.
+        # What we actually want to do is map our working directory onto whatever p4 is expecting
+        # This can be done with a combination of subst and symlinks, but it's gnarly no matter what we do
+        # I expect we'll be dealing with new issues here for a while.
+        if args.warm_exec:
+            # same shape as the real thing, as far as the code below cares
+            client = [warm["client"]]
+        else:
+            client = p4.run_client("-o", args.p4_workspace)
+        
+        # Right now, we assume the client root doesn't already exist as a directory.
+        # If you've put your Perforce repo in `c:\windows` and remapped Windows to D:,
+        # all so the Docker container gets confused when the p4 repo conflicts with its system directory, then, uh . . .
+        # . . . don't do that, I guess?
+        # I'm not sure what fix there could be for this.
+        clientrootdir = client[0]["Root"]
+        if args.warm_exec and clientrootdir != args.workdir:
+            # the symlink's still there, but a subst'd drive is per-session, same as the SMB mapping
+            drive = clientrootdir[0:2]
+            if not os.path.isdir(drive):
+                print(f"Recreating fake drive {drive}")
+                subprocess.check_call([
+                    'subst', drive, "c:\\mnt",
+                ])
+        elif clientrootdir != args.workdir:
+            print(f"Client root currently located in {args.workdir}, should be {clientrootdir}; generating symlink")
+            if os.path.isdir(clientrootdir) or os.path.isfile(clientrootdir):
+                raise Exception("Directory {clientrootdir} already exists in Docker! Not sure how to handle this, aborting.")
+
+            drive = clientrootdir[0:2]
+            if not os.path.isdir(drive):
+                print(f"  Creating fake drive {drive}")
+                stubdir = "c:\\mnt"
+                os.mkdir(stubdir)
+                subprocess.check_call([
+                    'subst', drive[0:2], stubdir,
+                ])
+            
+            # Make directories up to right before our target
+            clientrootdirparent = str(pathlib.Path(clientrootdir).parent)
+            if not os.path.isdir(clientrootdirparent):
+                os.makedirs(clientrootdirparent)
+
+            print(f"  Making symlink")
+            # not utils.run because we need `shell = True`
             subprocess.check_call([
-                'subst', drive[0:2], stubdir,
-            ])
+                    'mklink', '/d',
+                    clientrootdir,
+                    args.workdir,
+                ], shell = True)
+
+            print("  Directory masquerade successful!")
         
-        # Make directories up to right before our target
-        clientrootdirparent = str(pathlib.Path(clientrootdir).parent)
-        if not os.path.isdir(clientrootdirparent):
-            os.makedirs(clientrootdirparent)
+        # And now we just travel to the workdir and everything is fine, yay
+        args.workdir = clientrootdir
+        os.chdir(args.workdir)
 
-        print(f"  Making symlink")
-        # not utils.run because we need `shell = True`
-        subprocess.check_call([
-                'mklink', '/d',
-                clientrootdir,
-                args.workdir,
-            ], shell = True)
+        # Set up our env variables for child processes; other p4-users will expect these
+        env["P4USER"] = args.p4_username
+        env["P4PASSWORD"] = args.p4_password
+        env["P4PORT"] = args.p4_server
+        env["P4CLIENT"] = args.p4_workspace
+        
+        # Fake this so we can use people's existing clients without requiring them to mess with their host values.
+        # (p4, thank you for having this feature. sincerely, me)
+        # You might ask why we're setting it in three different ways. It's because *something* always breaks unless I do.
+        # (I am less enthused about this feature.)
+        # Not necessary if it doesn't have a Host field, of course!
+        if "Host" in client[0]:
+            p4.set_env("P4HOST", client[0]["Host"])
+            p4.host = client[0]["Host"]
+            
+            # This propagates to children (like the ue4 build script) so they work properly.
+            env["P4HOST"] = client[0]["Host"]
 
-        print("  Directory masquerade successful!")
+if args.warm_serve is not None:
+    # Everything from here on is per-run, so this is as far as a warm container goes by itself
+    os.makedirs(warmdir, exist_ok = True)
+    with open(warmstate, "w") as f:
+        json.dump({
+            "client": {key: client[0][key] for key in ["Root", "Host"] if key in client[0]} if args.p4_username is not None else None,
+            "proxy": metrics["preflight"].get("proxy"),
+        }, f, indent = 2)
+    warm_touch()
+    print(warm_ready_marker, flush = True)
     
-    # And now we just travel to the workdir and everything is fine, yay
-    args.workdir = clientrootdir
-    os.chdir(args.workdir)
-
-    # Set up our env variables for child processes; other p4-users will expect these
-    env["P4USER"] = args.p4_username
-    env["P4PASSWORD"] = args.p4_password
-    env["P4PORT"] = args.p4_server
-    env["P4CLIENT"] = args.p4_workspace
+    while True:
+        time.sleep(15)
+        # a run that's still going doesn't count as idle, no matter how long ago it started
+        if warm_busy_owner() is not None:
+            continue
+        if time.time() - os.path.getmtime(warmactivity) > args.warm_serve * 60:
+            break
     
-    # Fake this so we can use people's existing clients without requiring them to mess with their host values.
-    # (p4, thank you for having this feature. sincerely, me)
-    # You might ask why we're setting it in three different ways. It's because *something* always breaks unless I do.
-    # (I am less enthused about this feature.)
-    # Not necessary if it doesn't have a Host field, of course!
-    if "Host" in client[0]:
-        p4.set_env("P4HOST", client[0]["Host"])
-        p4.host = client[0]["Host"]
-        
-        # This propagates to children (like the ue4 build script) so they work properly.
-        env["P4HOST"] = client[0]["Host"]
+    print(f"WARM: idle for {args.warm_serve:g} minutes, shutting down")
+    sys.exit(0)
+
+# Sample the container's resources for the rest of the run, so we can tell what a slow build was waiting on
+resourceoutput = reportoutput + ".resources.bin"
+sampler = resource_sampler.Sampler(resourceoutput, args.workdir, cpus = args.cpus, memory_gb = args.memory)
+sampler.start()
 
 if args.p4_sync is not None:
-    # Do the big sync! (yes this takes forever)
-    # Sometimes we have minor network hiccups. We "solve" this by retrying up to ten times.
-    # Yes, I know this is ghastly.
-    maxTries = 10
-    for attempt in range(maxTries):
-        print(f"Syncing (try {attempt + 1}) . . .")
-        success = False
-        try:
-            p4.exception_level = 1  # "up-to-date" is a warning for some godforsaken reason
-            p4.run_sync(f"@{args.p4_sync}")
-            success = True
-        except P4.P4Exception as e:
-            print(e)
-        p4.exception_level = 2  # back to warning us about everything, which is generally useful
-        
-        if success:
-            break
-        
-        if attempt == maxTries - 1:
-            print("Failed! Aborting :(")
-            sys.exit(1)
-        
-        print("Waiting ten seconds . . .")
-        time.sleep(10)
-        p4.connect()
+    with Context("p4 sync", cl = args.p4_sync):
+        # Do the big sync! (yes this takes forever)
+        # Sometimes we have minor network hiccups. We "solve" this by retrying up to ten times.
+        # Yes, I know this is ghastly.
+        maxTries = 10
+        for attempt in range(maxTries):
+            print(f"Syncing (try {attempt + 1}) . . .")
+            success = False
+            try:
+                p4.exception_level = 1  # "up-to-date" is a warning for some godforsaken reason
+                p4.run_sync(f"@{args.p4_sync}")
+                success = True
+            except P4.P4Exception as e:
+                print(e)
+            p4.exception_level = 2  # back to warning us about everything, which is generally useful
+            
+            if success:
+                break
+            
+            if attempt == maxTries - 1:
+                print("Failed! Aborting :(")
+                sys.exit(1)
+            
+            print("Waiting ten seconds . . .")
+            time.sleep(10)
+            p4.connect()
 
 # Clean our output directory and output file, just in case
-archiveoutput = args.output + ".7z"
+codec = output_packaging.get(args.output_packaging)
+if args.output_delta_key is not None:
+    # delta artifacts are already compressed internally, so they skip the usual packaging
+    archiveextension = delta.extension
+else:
+    archiveextension = codec.extension
+archiveoutput = args.output + archiveextension
+metricsoutput = reportoutput + ".metrics.json"
+traceoutput = reportoutput + ".bootstrap.trace.json"
+scripttraceoutput = args.output + ".script.trace.json"
 if os.path.isdir(args.output):
     shutil.rmtree(args.output)
-if os.path.isfile(archiveoutput):
-    os.remove(archiveoutput)
+for stale in [archiveoutput, metricsoutput, traceoutput, scripttraceoutput]:
+    if os.path.isfile(stale):
+        os.remove(stale)
+
+# From here on a trace is worth writing even if we fail; it shows how far we got
+prof.trace_path = traceoutput
     
 # Patch up! We do this as late as possible so there's a small surface for us needing to revert the patch
 p4change = None
@@ -209,8 +580,9 @@ if args.p4_patch is not None:
     p4change = re.search(r'Change (\d+) created.', p4change).group(1)
     print(f"Patching into changelist {p4change}")
     
-    for patch in args.p4_patch.split(","):
-        p4.run_unshelve("-s", patch, "-c", p4change)
+    with Context("p4 unshelve", patches = args.p4_patch):
+        for patch in args.p4_patch.split(","):
+            p4.run_unshelve("-s", patch, "-c", p4change)
 
 try:
     # SORRY, CAN'T MAKE THIS PART PUBLIC
@@ -218,32 +590,87 @@ try:
     # Please pull request it once you do, thanks!
     
     # Build the thing (with appropriate data)
-    utils.run([
-            'python',
-            '-u', # unbuffered so we actually get realtime output
-            f'arclight/script/{args.script}.py',
-            '--output', args.output,
-        ] + args.script_args,
-        cwd = args.workdir,
-        env = env)
+    metrics["script_start"] = time.time()
+    with Context("script", script = args.script):
+        # scripts can record their own spans with arclight's util/prof.py, and they'll show up under this one
+        env[prof.trace_env] = prof.propagate()
+        env[prof.trace_file_env] = scripttraceoutput
+        utils.run([
+                'python',
+                '-u', # unbuffered so we actually get realtime output
+                f'arclight/script/{args.script}.py',
+                '--output', args.output,
+            ] + args.script_args,
+            cwd = args.workdir,
+            env = env)
+    metrics["script_end"] = time.time()
 finally:
     if p4change is not None:
         # Revert our changes; this makes it a lot easier to keep iterating on a single image, if we want to
         print(f"Cleaning up p4 patch changelist {p4change}")
         p4.run_revert("-w", "-c", p4change, "...")
         p4.run_change("-d", p4change)
+    
+    # scripts that don't record anything just won't have written one
+    if os.path.isfile(scripttraceoutput):
+        prof.merge(scripttraceoutput)
+        os.remove(scripttraceoutput)
+
+# Only after a successful run; if it failed, the share stays as it was, and the next stage_in puts the stage back to match it
+if smbworkdir is not None:
+    print(f"Copying changes back to {smbworkdir} . . .")
+    with Context("stage out") as span:
+        stats = staging.stage_out(args.smb_stage, smbworkdir, args.smb_stage_workers)
+        span.set(bytes = stats["copied_bytes"], files = stats["copied"])
+    print(f"STAGE: out: {staging.describe(stats)}")
+    metrics["staging"]["out"] = stats
 
-# Compress if requested (here so we can keep 7z in the Docker image)
-if args.output_compress:
-    print(f"Compressing to {archiveoutput}")
-    subprocess.check_call([
-        '7z', 'a',
-        '-bb1',      # detailed logging
-        '-mx1',      # low compression
-        # We'd like to do .zip compression, but 7zip does not do parallel compression into .zip files very well.
-        archiveoutput,
-        args.output,
-    ])
+# Compress if requested (here so we can keep the compressors in the Docker image)
+if args.output_compress and args.output_delta_key is not None:
+    threads = output_packaging.threads(args.cpus)
+    
+    # We keep the last output for each key on the working volume, right next to the intermediates, so it survives along with them
+    basedir = os.path.join(args.workdir, "arclight_delta", args.output_delta_key)
+    storedbase = delta.base_id(basedir)
+    if storedbase is not None and storedbase == args.output_delta_base:
+        print(f"Packaging {archiveoutput} as a delta against {storedbase}")
+        base = basedir
+    else:
+        # either we've never built this before or the requester has a different version cached; either way, they get everything
+        print(f"Packaging {archiveoutput} as a full delta artifact (we have base {storedbase}, requester has {args.output_delta_base})")
+        base = None
+    
+    start = time.perf_counter()
+    with Context("packaging", codec = "delta") as span:
+        stats = delta.create(args.output, archiveoutput, base, threads)
+        span.set(bytes = stats["size"])
+    metrics["packaging"] = {
+        "codec": "delta",
+        "threads": threads,
+        "seconds": time.perf_counter() - start,
+        "size": stats["size"],
+        "raw_size": stats["raw_size"],
+        "delta": stats,
+    }
+    print(f"Packaged {stats['raw_size']} bytes into {stats['size']} ({stats['copy']} unchanged, {stats['delta']} delta, {stats['full']} full) in {metrics['packaging']['seconds']:0.1f} seconds")
+    
+    # This output becomes the base for next time; it's on the same volume, so moving it is basically free
+    delta.store_base(args.output, basedir, move = True)
+    
+elif args.output_compress:
+    threads = output_packaging.threads(args.cpus)
+    print(f"Compressing to {archiveoutput} with {codec.name} ({threads} threads)")
+    start = time.perf_counter()
+    with Context("packaging", codec = codec.name) as span:
+        codec.pack(args.output, archiveoutput, threads)
+        span.set(bytes = os.path.getsize(archiveoutput))
+    metrics["packaging"] = {
+        "codec": codec.name,
+        "threads": threads,
+        "seconds": time.perf_counter() - start,
+        "size": os.path.getsize(archiveoutput),
+    }
+    print(f"Compressed to {metrics['packaging']['size']} bytes in {metrics['packaging']['seconds']:0.1f} seconds")
     
     # And now wipe, because we know where this is and can do it easily
     shutil.rmtree(args.output)
@@ -256,8 +683,31 @@ if args.output_s3 is not None:
         raise Exception("Missing AWS keys!")
     
     s3 = boto3.client('s3', aws_access_key_id = args.aws_access_key_id, aws_secret_access_key = args.aws_secret_access_key)
-    with open(archiveoutput, "rb") as f:
-        s3.upload_fileobj(f, "arclight", args.output_s3)
+    start = time.perf_counter()
+    with Context("upload", bytes = os.path.getsize(archiveoutput)):
+        with open(archiveoutput, "rb") as f:
+            s3.upload_fileobj(f, "arclight", args.output_s3 + archiveextension)
+    metrics["upload"] = {
+        "seconds": time.perf_counter() - start,
+        "size": os.path.getsize(archiveoutput),
+    }
     
     # final cleanup
     os.remove(archiveoutput)
+
+sampler.stop()
+metrics["resources"] = resource_sampler.summary(*resource_sampler.read(resourceoutput))
+for line in resource_sampler.describe(metrics["resources"]):
+    print(f"RESOURCES: {line}")
+
+# Ship our metrics, trace and resource samples out along with the results
+with open(metricsoutput, "w") as f:
+    json.dump(metrics, f, indent = 2)
+prof.write_trace(traceoutput)
+prof.trace_path = None
+
+if args.output_s3 is not None:
+    for report, extension in [(metricsoutput, ".metrics.json"), (traceoutput, ".bootstrap.trace.json"), (resourceoutput, ".resources.bin")]:
+        with open(report, "rb") as f:
+            s3.upload_fileobj(f, "arclight", args.output_s3 + extension)
+        os.remove(report)
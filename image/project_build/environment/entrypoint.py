@@ -0,0 +1,68 @@
+
+# Stable entrypoint for the arclight environment.
+# bootstrap.py and its helpers aren't part of the image; they're either copied into the container before it starts, or fetched from S3 here (see arclight's util/bootstrap.py).
+# Either way we verify them against the hash we were given before running anything.
+# This file should almost never change, since changing it means a new image.
+#
+#   ARCLIGHT_BOOTSTRAP_SHA256   hash of the bundle's manifest (required)
+#   ARCLIGHT_BOOTSTRAP_S3       S3 key prefix to download the bundle from; if unset, it's expected to already be in place
+#
+# All arguments are passed through to bootstrap.py untouched.
+
+import hashlib
+import json
+import os
+import subprocess
+import sys
+
+bootstrapdir = "c:\\arclight_bootstrap"
+manifest_filename = "manifest.json"
+
+def flag_value(flag):
+    # we borrow bootstrap's AWS credentials rather than having them passed twice
+    args = sys.argv[1:]
+    if "--" in args:
+        args = args[:args.index("--")]
+    if flag in args and args.index(flag) + 1 < len(args):
+        return args[args.index(flag) + 1]
+    return None
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+def fetch(prefix):
+    import boto3
+
+    s3 = boto3.client('s3', aws_access_key_id = flag_value("--aws_access_key_id"), aws_secret_access_key = flag_value("--aws_secret_access_key"))
+    os.makedirs(bootstrapdir, exist_ok = True)
+
+    manifest = s3.get_object(Bucket = "arclight", Key = f"{prefix}/{manifest_filename}")["Body"].read()
+    for filename in json.loads(manifest):
+        s3.download_file("arclight", f"{prefix}/{filename}", os.path.join(bootstrapdir, filename))
+
+    # manifest last, same as when it's staged locally
+    with open(os.path.join(bootstrapdir, manifest_filename), "wb") as f:
+        f.write(manifest)
+
+def verify(expected):
+    with open(os.path.join(bootstrapdir, manifest_filename), "rb") as f:
+        manifest = f.read()
+    if sha256(manifest) != expected:
+        raise Exception(f"bootstrap manifest hash is {sha256(manifest)}, expected {expected}")
+
+    for filename, filehash in json.loads(manifest).items():
+        with open(os.path.join(bootstrapdir, filename), "rb") as f:
+            if sha256(f.read()) != filehash:
+                raise Exception(f"bootstrap file {filename} doesn't match its manifest")
+
+expected = os.environ.get("ARCLIGHT_BOOTSTRAP_SHA256")
+if expected is None:
+    raise Exception("no ARCLIGHT_BOOTSTRAP_SHA256 given; this image needs to be run through arclight")
+
+if os.environ.get("ARCLIGHT_BOOTSTRAP_S3") is not None:
+    print(f"ENTRYPOINT: fetching bootstrap {expected[:12]}")
+    fetch(os.environ["ARCLIGHT_BOOTSTRAP_S3"])
+
+verify(expected)
+
+sys.exit(subprocess.call([sys.executable, "-u", os.path.join(bootstrapdir, "bootstrap.py")] + sys.argv[1:]))
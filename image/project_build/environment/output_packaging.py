@@ -0,0 +1,186 @@
+
+# Output packaging for bootstrap.py.
+# Each codec turns an output directory into a single file that's cheap to upload and download.
+# Scripts pick one with `"packaging": "<codec>"` in their `--validate` output; 7z is the default because that's what we've always used.
+#
+# This can also be run standalone to figure out which codec makes sense for a given output and link:
+#   python output_packaging.py benchmark path/to/arclight_output --upload_mbps 1000 --download_mbps 300
+
+import argparse
+import importlib.util
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import time
+
+from typing import Dict
+from typing import List
+from typing import Optional
+
+class Codec:
+    name = None
+    extension = None
+
+    def available(self) -> bool:
+        return True
+
+    def pack(self, src: str, dst: str, threads: int) -> None:
+        raise NotImplementedError()
+
+    def unpack(self, src: str, dst: str, threads: int) -> None:
+        raise NotImplementedError()
+
+class SevenZip(Codec):
+    name = "7z"
+    extension = ".7z"
+
+    def available(self) -> bool:
+        return shutil.which("7z") is not None
+
+    def pack(self, src: str, dst: str, threads: int) -> None:
+        subprocess.check_call([
+            '7z', 'a',
+            '-bb1',      # detailed logging
+            '-mx1',      # low compression
+            f'-mmt{threads}',
+            # We'd like to do .zip compression, but 7zip does not do parallel compression into .zip files very well.
+            dst,
+            src,
+        ])
+
+    def unpack(self, src: str, dst: str, threads: int) -> None:
+        subprocess.check_call(['7z', 'x', '-y', f'-mmt{threads}', f'-o{dst}', src], stdout = subprocess.DEVNULL)
+
+class ZstdTar(Codec):
+    name = "zstd"
+    extension = ".tar.zst"
+
+    # zstd's level 3 default is already faster than 7z -mx1 and compresses better; much higher and we're CPU-bound on big outputs
+    level = 3
+
+    def available(self) -> bool:
+        return importlib.util.find_spec("zstandard") is not None
+
+    def pack(self, src: str, dst: str, threads: int) -> None:
+        import zstandard
+
+        # tar itself is single-threaded but it's just shoveling bytes; zstd does the work on `threads` workers
+        compressor = zstandard.ZstdCompressor(level = self.level, threads = threads)
+        with open(dst, "wb") as f:
+            with compressor.stream_writer(f, closefd = False) as compressed:
+                with tarfile.open(fileobj = compressed, mode = "w|") as tar:
+                    tar.add(src, arcname = os.path.basename(os.path.normpath(src)))
+
+    def unpack(self, src: str, dst: str, threads: int) -> None:
+        import zstandard
+
+        # zstd decompression is single-threaded no matter what, but it's fast enough that it doesn't matter
+        with open(src, "rb") as f:
+            with zstandard.ZstdDecompressor().stream_reader(f) as decompressed:
+                with tarfile.open(fileobj = decompressed, mode = "r|") as tar:
+                    tar.extractall(dst)
+
+class Store(Codec):
+    name = "store"
+    extension = ".tar"
+
+    def pack(self, src: str, dst: str, threads: int) -> None:
+        with tarfile.open(dst, mode = "w") as tar:
+            tar.add(src, arcname = os.path.basename(os.path.normpath(src)))
+
+    def unpack(self, src: str, dst: str, threads: int) -> None:
+        with tarfile.open(src, mode = "r") as tar:
+            tar.extractall(dst)
+
+codecs = {codec.name: codec for codec in [SevenZip(), ZstdTar(), Store()]}
+default = "7z"
+
+def get(name: Optional[str]) -> Codec:
+    if name is None:
+        name = default
+
+    if name not in codecs:
+        raise Exception(f"Unknown packaging `{name}`; valid options are {', '.join(codecs.keys())}")
+
+    return codecs[name]
+
+def threads(cpus: Optional[float]) -> int:
+    # Inside a process-isolated container, cpu_count() reports the whole host, not what `--cpus` gave us.
+    # Oversubscribing doesn't buy anything and just thrashes, so prefer the limit we were actually started with.
+    if cpus is not None:
+        return max(1, int(cpus))
+    return multiprocessing.cpu_count()
+
+def tree_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            total += os.path.getsize(os.path.join(root, file))
+    return total
+
+def benchmark(src: str, codecnames: List[str], threadcount: int, upload_mbps: float, download_mbps: float) -> List[Dict]:
+    rawsize = tree_size(src)
+    print(f"Benchmarking {src} ({rawsize / (1 << 20):0.1f}MB) with {threadcount} threads")
+
+    results = []
+    with tempfile.TemporaryDirectory() as scratch:
+        for name in codecnames:
+            codec = get(name)
+            if not codec.available():
+                print(f"  {name}: not available, skipping")
+                continue
+
+            archive = os.path.join(scratch, f"benchmark{codec.extension}")
+            start = time.perf_counter()
+            codec.pack(src, archive, threadcount)
+            packseconds = time.perf_counter() - start
+            packedsize = os.path.getsize(archive)
+
+            extractdir = os.path.join(scratch, "extract")
+            start = time.perf_counter()
+            codec.unpack(archive, extractdir, threadcount)
+            unpackseconds = time.perf_counter() - start
+
+            # the thing we actually care about: how long until the result is sitting on the requester's disk
+            uploadseconds = packedsize * 8 / 1e6 / upload_mbps
+            downloadseconds = packedsize * 8 / 1e6 / download_mbps
+            results += [{
+                "codec": name,
+                "size": packedsize,
+                "ratio": packedsize / max(rawsize, 1),
+                "pack_seconds": packseconds,
+                "pack_mbps": rawsize * 8 / 1e6 / max(packseconds, 1e-6),
+                "unpack_seconds": unpackseconds,
+                "total_seconds": packseconds + uploadseconds + downloadseconds + unpackseconds,
+            }]
+
+            os.remove(archive)
+            shutil.rmtree(extractdir)
+
+    print()
+    print(f"{'codec':<8}{'size MB':>10}{'ratio':>8}{'pack s':>9}{'pack Mbps':>11}{'unpack s':>10}{'total s':>9}")
+    for result in sorted(results, key = lambda result: result["total_seconds"]):
+        print(f"{result['codec']:<8}{result['size'] / (1 << 20):>10.1f}{result['ratio']:>8.3f}{result['pack_seconds']:>9.1f}{result['pack_mbps']:>11.0f}{result['unpack_seconds']:>10.1f}{result['total_seconds']:>9.1f}")
+    print()
+    print(f"Totals are pack + upload at {upload_mbps}Mbps + download at {download_mbps}Mbps + unpack.")
+
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest = "command", required = True)
+
+    bench = commands.add_parser("benchmark", help="Measure every codec against a sample output tree")
+    bench.add_argument("src", help="Output directory to benchmark against")
+    bench.add_argument("--codecs", help="Comma-separated list of codecs to try", default=",".join(codecs.keys()))
+    bench.add_argument("--cpus", help="CPU count to size thread pools for (defaults to every CPU)", type=float)
+    bench.add_argument("--upload_mbps", help="Upload speed from the build machine, in megabits/sec", type=float, default=1000)
+    bench.add_argument("--download_mbps", help="Download speed to the requester, in megabits/sec", type=float, default=300)
+
+    args = parser.parse_args()
+
+    if args.command == "benchmark":
+        benchmark(args.src, args.codecs.split(","), threads(args.cpus), args.upload_mbps, args.download_mbps)
@@ -0,0 +1,226 @@
+
+# Resource sampling for bootstrap.py.
+# While the run goes, a background thread records CPU, memory, disk I/O, network and free space on the working volume every few seconds,
+# so afterwards we can tell whether a build was CPU-bound, I/O-bound or short on memory.
+# It runs inside the container, so it works the same locally and on AWS.
+#
+# Samples go into a small binary file next to the output: an 8-byte magic, a length-prefixed JSON header, then one fixed-width record of float32s per sample.
+# A day of samples at the default interval is well under a megabyte, and the file is flushed as we go, so it's still readable if the run dies.
+#
+#   python resource_sampler.py summary arclight_output.resources.bin
+#   python resource_sampler.py csv arclight_output.resources.bin > resources.csv
+
+import argparse
+import json
+import struct
+import threading
+import time
+
+from typing import Dict
+from typing import List
+from typing import Optional
+
+magic = b"ARCLRES\x01"
+
+columns = [
+    "seconds",          # since sampling started
+    "cpu_cores",        # cores' worth of CPU in use
+    "memory_gb",
+    "disk_read_mb_s",
+    "disk_write_mb_s",
+    "net_recv_mb_s",
+    "net_sent_mb_s",
+    "free_gb",          # on the working volume
+]
+
+record = struct.Struct("<" + "f" * len(columns))
+
+default_interval = 5
+
+# how close to the limit counts as "at" it, for the saturation percentages
+saturation = 0.9
+
+class Sampler:
+    # `cpus` and `memory_gb` are the container's limits, which is what "saturated" should be measured against;
+    # psutil only knows about the whole host, so without them we fall back to that
+    def __init__(self, path: str, workdir: str, interval: float = default_interval, cpus: Optional[float] = None, memory_gb: Optional[float] = None):
+        self.path = path
+        self.workdir = workdir
+        self.interval = interval
+        self.cpus = cpus
+        self.memory_gb = memory_gb
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopping.set()
+        self.thread.join(timeout = self.interval * 2)
+
+    def run(self) -> None:
+        import psutil
+
+        # cpu_percent is a share of every core the host has, limited or not
+        hostcores = psutil.cpu_count()
+        header = json.dumps({
+            "columns": columns,
+            "interval": self.interval,
+            "start": time.time(),
+            "cores": self.cpus or hostcores,
+            "memory_gb": self.memory_gb or psutil.virtual_memory().total / (1 << 30),
+            "workdir": self.workdir,
+        }).encode("utf-8")
+
+        # Not every counter is available in every container; a missing one reads as zero rather than taking sampling down
+        def counters(function):
+            try:
+                return function()
+            except Exception:
+                return None
+
+        start = time.perf_counter()
+        psutil.cpu_percent()    # the first call just sets the baseline
+        lastdisk, lastnet, lasttime = counters(psutil.disk_io_counters), counters(psutil.net_io_counters), start
+
+        with open(self.path, "wb") as f:
+            f.write(magic)
+            f.write(struct.pack("<I", len(header)))
+            f.write(header)
+            f.flush()
+
+            while not self.stopping.wait(self.interval):
+                now = time.perf_counter()
+                elapsed = max(now - lasttime, 1e-6)
+                disk, net = counters(psutil.disk_io_counters), counters(psutil.net_io_counters)
+
+                def rate(current, last, field: str) -> float:
+                    if current is None or last is None:
+                        return 0
+                    return (getattr(current, field) - getattr(last, field)) / elapsed / (1 << 20)
+
+                usage = counters(lambda: psutil.disk_usage(self.workdir))
+                f.write(record.pack(
+                    now - start,
+                    psutil.cpu_percent() / 100 * hostcores,
+                    psutil.virtual_memory().used / (1 << 30),
+                    rate(disk, lastdisk, "read_bytes"),
+                    rate(disk, lastdisk, "write_bytes"),
+                    rate(net, lastnet, "bytes_recv"),
+                    rate(net, lastnet, "bytes_sent"),
+                    usage.free / (1 << 30) if usage is not None else 0,
+                ))
+                f.flush()
+                lastdisk, lastnet, lasttime = disk, net, now
+
+def read(path: str):
+    # returns (header, list of dicts), tolerating a truncated last record
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:len(magic)] != magic:
+        raise Exception(f"{path} isn't a resource sample file")
+
+    headerlength = struct.unpack_from("<I", data, len(magic))[0]
+    offset = len(magic) + 4
+    header = json.loads(data[offset:offset + headerlength].decode("utf-8"))
+    offset += headerlength
+
+    samples = []
+    while offset + record.size <= len(data):
+        samples.append(dict(zip(header["columns"], record.unpack_from(data, offset))))
+        offset += record.size
+    return header, samples
+
+def summary(header: Dict, samples: List[Dict]) -> Dict:
+    if len(samples) == 0:
+        return {"samples": 0}
+
+    def total_gb(column: str) -> float:
+        # each sample's rate covers the time since the one before it
+        total = 0
+        previous = 0
+        for sample in samples:
+            total += sample[column] * (sample["seconds"] - previous)
+            previous = sample["seconds"]
+        return total / 1024
+
+    def fraction(test) -> float:
+        return sum(1 for sample in samples if test(sample)) / len(samples) * 100
+
+    cores = header["cores"]
+    memory = header["memory_gb"]
+    averagecores = sum(sample["cpu_cores"] for sample in samples) / len(samples)
+    return {
+        "samples": len(samples),
+        "seconds": samples[-1]["seconds"],
+        "cpu": {
+            "cores": cores,
+            "average_cores": averagecores,
+            "peak_cores": max(sample["cpu_cores"] for sample in samples),
+            "average_percent": averagecores / cores * 100,
+            "saturated_percent": fraction(lambda sample: sample["cpu_cores"] >= cores * saturation),
+        },
+        "memory": {
+            "total_gb": memory,
+            "peak_gb": max(sample["memory_gb"] for sample in samples),
+            "peak_percent": max(sample["memory_gb"] for sample in samples) / memory * 100,
+            "saturated_percent": fraction(lambda sample: sample["memory_gb"] >= memory * saturation),
+        },
+        "disk": {
+            "read_gb": total_gb("disk_read_mb_s"),
+            "write_gb": total_gb("disk_write_mb_s"),
+            "peak_read_mb_s": max(sample["disk_read_mb_s"] for sample in samples),
+            "peak_write_mb_s": max(sample["disk_write_mb_s"] for sample in samples),
+        },
+        "network": {
+            "recv_gb": total_gb("net_recv_mb_s"),
+            "sent_gb": total_gb("net_sent_mb_s"),
+            "peak_recv_mb_s": max(sample["net_recv_mb_s"] for sample in samples),
+            "peak_sent_mb_s": max(sample["net_sent_mb_s"] for sample in samples),
+        },
+        "free_space": {
+            "start_gb": samples[0]["free_gb"],
+            "end_gb": samples[-1]["free_gb"],
+            "min_gb": min(sample["free_gb"] for sample in samples),
+        },
+    }
+
+def describe(summary: Dict) -> List[str]:
+    if summary["samples"] == 0:
+        return ["no samples"]
+    cpu, memory, disk, network, free = summary["cpu"], summary["memory"], summary["disk"], summary["network"], summary["free_space"]
+    return [
+        f"cpu: {cpu['average_cores']:0.1f} of {cpu['cores']} cores on average ({cpu['average_percent']:0.0f}%), peak {cpu['peak_cores']:0.1f}, saturated {cpu['saturated_percent']:0.0f}% of the time",
+        f"memory: peak {memory['peak_gb']:0.1f} of {memory['total_gb']:0.1f}GB ({memory['peak_percent']:0.0f}%), near the limit {memory['saturated_percent']:0.0f}% of the time",
+        f"disk: {disk['read_gb']:0.1f}GB read (peak {disk['peak_read_mb_s']:0.0f}MB/s), {disk['write_gb']:0.1f}GB written (peak {disk['peak_write_mb_s']:0.0f}MB/s)",
+        f"network: {network['recv_gb']:0.1f}GB in (peak {network['peak_recv_mb_s']:0.0f}MB/s), {network['sent_gb']:0.1f}GB out (peak {network['peak_sent_mb_s']:0.0f}MB/s)",
+        f"free space: {free['start_gb']:0.1f}GB at start, {free['min_gb']:0.1f}GB at lowest, {free['end_gb']:0.1f}GB at end",
+    ]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest = "command", required = True)
+
+    summarycmd = commands.add_parser("summary", help="Print peaks and utilisation")
+    summarycmd.add_argument("path", help="Resource sample file")
+    summarycmd.add_argument("--json", help="Print raw JSON", action="store_true")
+
+    csvcmd = commands.add_parser("csv", help="Dump every sample as CSV")
+    csvcmd.add_argument("path", help="Resource sample file")
+
+    args = parser.parse_args()
+
+    header, samples = read(args.path)
+    if args.command == "summary":
+        result = summary(header, samples)
+        if args.json:
+            print(json.dumps(result, indent = 2))
+        else:
+            for line in describe(result):
+                print(line)
+    elif args.command == "csv":
+        print(",".join(header["columns"]))
+        for sample in samples:
+            print(",".join(f"{sample[column]:g}" for column in header["columns"]))
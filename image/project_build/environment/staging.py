@@ -0,0 +1,187 @@
+
+import concurrent.futures
+import hashlib
+import json
+import os
+import stat
+import time
+
+# SMB staging.
+# Under hyperv isolation the workspace comes in over an SMB share, and UE's thousands of small reads and writes are dramatically slower over that than on the container's own disk.
+# So instead we copy the workspace into the container, run there, and copy back whatever changed.
+# Both directions skip files that haven't changed, using a manifest kept in the stage directory; with `--warm`, the stage survives between runs and only the differences move.
+# Modification times and read-only bits are copied along with the data, since UBT decides what to rebuild by timestamp and p4 won't sync over writable files.
+
+manifest_filename = ".arclight-stage.json"
+
+# small files dominate, and most of the cost of each is SMB round trips, so this can go well past the core count
+default_workers = 16
+
+chunk_size = 1 << 20
+
+def walk(root: str):
+    # relative path -> stat, for every regular file under root; symlinks are left alone, since p4's client root masquerade is one
+    files = {}
+    pending = [root]
+    while len(pending) > 0:
+        directory = pending.pop()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_symlink():
+                    continue
+                if entry.is_dir():
+                    pending.append(entry.path)
+                elif entry.is_file():
+                    rel = os.path.relpath(entry.path, root)
+                    if rel != manifest_filename:
+                        # on Windows this comes from the directory listing, so it doesn't cost a round trip per file
+                        files[rel] = entry.stat()
+    return files
+
+def file_hash(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+def make_writable(path: str) -> None:
+    if os.path.exists(path) and not os.access(path, os.W_OK):
+        os.chmod(path, stat.S_IWRITE | stat.S_IREAD)
+
+def copy_file(src: str, dst: str, st) -> str:
+    # returns the hash of what we copied, which we get for free since we're reading it anyway
+    os.makedirs(os.path.dirname(dst), exist_ok = True)
+    make_writable(dst)
+
+    h = hashlib.sha256()
+    with open(src, "rb") as fin, open(dst, "wb") as fout:
+        while True:
+            chunk = fin.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+            fout.write(chunk)
+
+    # times before mode, so we're not trying to touch a file we just made read-only
+    os.utime(dst, ns = (st.st_atime_ns, st.st_mtime_ns))
+    os.chmod(dst, stat.S_IMODE(st.st_mode))
+    return h.hexdigest()
+
+def remove_file(path: str) -> None:
+    if os.path.exists(path):
+        make_writable(path)
+        os.remove(path)
+
+def matches(entry, st) -> bool:
+    return entry is not None and entry["size"] == st.st_size and entry["mtime"] == st.st_mtime_ns
+
+def load_manifest(stagedir: str):
+    path = os.path.join(stagedir, manifest_filename)
+    if not os.path.isfile(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+def save_manifest(stagedir: str, manifest) -> None:
+    # written via a temp file, since a half-written manifest would make us trust files we shouldn't
+    path = os.path.join(stagedir, manifest_filename)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(path + ".tmp", path)
+
+def parallel_copy(jobs, workers: int):
+    # jobs is a list of (rel, src, dst, stat); returns rel -> hash
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers = workers) as pool:
+        futures = {pool.submit(copy_file, src, dst, st): rel for rel, src, dst, st in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            results[futures[future]] = future.result()
+    return results
+
+def stage_in(sourcedir: str, stagedir: str, workers: int = default_workers):
+    # Brings stagedir up to date with sourcedir; returns stats
+    start = time.perf_counter()
+    os.makedirs(stagedir, exist_ok = True)
+    manifest = load_manifest(stagedir)
+    source = walk(sourcedir)
+    staged = walk(stagedir)
+    walked = time.perf_counter()
+
+    jobs = []
+    skipped = 0
+    for rel, st in source.items():
+        entry = manifest.get(rel)
+        # unchanged on the host since we last copied it, and nobody's touched our copy either
+        if matches(entry, st) and rel in staged and matches(entry, staged[rel]):
+            skipped += 1
+            continue
+        jobs.append((rel, os.path.join(sourcedir, rel), os.path.join(stagedir, rel), st))
+
+    # Anything we have that the host doesn't is either deleted on the host or left over from a failed run; either way, it goes
+    removed = [rel for rel in staged if rel not in source]
+    for rel in removed:
+        remove_file(os.path.join(stagedir, rel))
+        manifest.pop(rel, None)
+
+    for rel, filehash in parallel_copy(jobs, workers).items():
+        st = source[rel]
+        manifest[rel] = {"size": st.st_size, "mtime": st.st_mtime_ns, "sha256": filehash}
+
+    save_manifest(stagedir, manifest)
+    return {
+        "seconds": time.perf_counter() - start,
+        "walk_seconds": walked - start,
+        "files": len(source),
+        "copied": len(jobs),
+        "copied_bytes": sum(st.st_size for _, _, _, st in jobs),
+        "skipped": skipped,
+        "removed": len(removed),
+    }
+
+def stage_out(stagedir: str, sourcedir: str, workers: int = default_workers):
+    # Copies everything that changed during the run back to sourcedir, and deletes what the run deleted; returns stats
+    start = time.perf_counter()
+    manifest = load_manifest(stagedir)
+    staged = walk(stagedir)
+
+    jobs = []
+    skipped = 0
+    for rel, st in staged.items():
+        entry = manifest.get(rel)
+        if matches(entry, st):
+            skipped += 1
+            continue
+
+        # Touched but identical (p4 does this a lot, and so does reverting a patch); local disk is cheap to hash, SMB isn't cheap to write
+        if entry is not None and entry["size"] == st.st_size and file_hash(os.path.join(stagedir, rel)) == entry["sha256"]:
+            os.utime(os.path.join(stagedir, rel), ns = (st.st_atime_ns, entry["mtime"]))
+            skipped += 1
+            continue
+
+        jobs.append((rel, os.path.join(stagedir, rel), os.path.join(sourcedir, rel), st))
+
+    removed = [rel for rel in manifest if rel not in staged]
+    for rel in removed:
+        remove_file(os.path.join(sourcedir, rel))
+        del manifest[rel]
+
+    for rel, filehash in parallel_copy(jobs, workers).items():
+        st = staged[rel]
+        manifest[rel] = {"size": st.st_size, "mtime": st.st_mtime_ns, "sha256": filehash}
+
+    save_manifest(stagedir, manifest)
+    return {
+        "seconds": time.perf_counter() - start,
+        "files": len(staged),
+        "copied": len(jobs),
+        "copied_bytes": sum(st.st_size for _, _, _, st in jobs),
+        "skipped": skipped,
+        "removed": len(removed),
+    }
+
+def describe(stats) -> str:
+    return f"{stats['copied']} files ({stats['copied_bytes'] / (1 << 20):0.1f}MB) copied, {stats['skipped']} unchanged, {stats['removed']} removed, in {stats['seconds']:0.1f} seconds"
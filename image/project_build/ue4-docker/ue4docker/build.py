@@ -93,6 +93,11 @@ def build():
         contextRoot = join(tempDir, "dockerfiles")
         shutil.copytree(contextOrig, contextRoot)
 
+        # Create the build cache, if one was requested
+        cache = None
+        if config.cacheDir is not None or config.cacheRegistry is not None:
+            cache = BuildCache(logger, config.cacheDir, config.cacheRegistry)
+
         # Create the builder instance to build the Docker images
         builder = ImageBuilder(
             contextRoot,
@@ -103,6 +108,8 @@ def build():
             config.layoutDir,
             config.opts,
             config.combine,
+            config.logDir,
+            cache,
         )
 
         # Resolve our main set of tags for the generated images; this is used only for Source and downstream
@@ -162,6 +169,12 @@ def build():
                 logger.info("{}: {}".format(key, json.dumps(value)), False)
             print("", file=sys.stderr, flush=True)
 
+        # Report how many images we will build at once
+        if config.jobs > 1:
+            logger.info("CONCURRENT BUILDS:", False)
+            logger.info("Max concurrent images: {}".format(config.jobs), False)
+            logger.info("Build logs:            {}\n".format(config.logDir), False)
+
         # Determine if we are building Windows or Linux containers
         if config.containerPlatform == "windows":
 
@@ -362,9 +375,32 @@ def build():
                     shutil.rmtree(config.layoutDir)
                 os.makedirs(config.layoutDir)
 
+            # Make sure the build cache is ready to use (this may start a local registry)
+            if (
+                cache is not None
+                and config.dryRun == False
+                and config.layoutDir is None
+            ):
+                cache.start()
+
             # Keep track of the images we've built
             builtImages = []
 
+            # Each image is a task in a dependency graph, so images that only share a parent (e.g. ue4-engine and ue4-minimal) can build at the same time
+            graph = BuildGraph(logger, resourceMonitor)
+
+            def addImage(name, dependencies, tags, args, secrets=None):
+                def action():
+                    builder.build(name, tags, args, secrets)
+                    builtImages.append(name)
+
+                # Dependencies on images we aren't building are satisfied by whatever already exists locally
+                graph.add(
+                    name,
+                    [dependency for dependency in dependencies if dependency in graph],
+                    action,
+                )
+
             commonArgs = [
                 "--build-arg",
                 "NAMESPACE={}".format(GlobalConfiguration.getTagNamespace()),
@@ -383,12 +419,12 @@ def build():
                         "VISUAL_STUDIO_BUILD_NUMBER=" + config.visualStudioBuildNumber,
                     ]
 
-                builder.build(
+                addImage(
                     "ue4-build-prerequisites",
+                    [],
                     [config.prereqsTag],
                     commonArgs + config.platformArgs + prereqsArgs,
                 )
-                builtImages.append("ue4-build-prerequisites")
 
                 prereqConsumerArgs = [
                     "--build-arg",
@@ -418,13 +454,13 @@ def build():
                     "--build-arg",
                     "VERBOSE_OUTPUT={}".format("1" if config.verbose == True else "0"),
                 ]
-                builder.build(
+                addImage(
                     "ue4-source",
+                    ["ue4-build-prerequisites"],
                     mainTags,
                     commonArgs + config.platformArgs + ue4SourceArgs + credentialArgs,
                     secrets,
                 )
-                builtImages.append("ue4-source")
             else:
                 logger.info("Skipping ue4-source image build.")
 
@@ -436,12 +472,12 @@ def build():
 
             # Build the UE4 Engine source build image, unless requested otherwise by the user
             if config.buildTargets["engine"]:
-                builder.build(
+                addImage(
                     "ue4-engine",
+                    ["ue4-source"],
                     mainTags,
                     commonArgs + config.platformArgs + ue4BuildArgs,
                 )
-                builtImages.append("ue4-engine")
             else:
                 logger.info("Skipping ue4-engine image build.")
 
@@ -453,12 +489,12 @@ def build():
                     else []
                 )
 
-                builder.build(
+                addImage(
                     "ue4-minimal",
+                    ["ue4-source"],
                     mainTags,
                     commonArgs + config.platformArgs + ue4BuildArgs + minimalArgs,
                 )
-                builtImages.append("ue4-minimal")
             else:
                 logger.info("Skipping ue4-minimal image build.")
 
@@ -483,18 +519,21 @@ def build():
                     )
 
                 # Build the image
-                builder.build(
+                addImage(
                     "ue4-full",
+                    ["ue4-source", "ue4-minimal"],
                     mainTags,
                     commonArgs
                     + config.platformArgs
                     + ue4BuildArgs
                     + infrastructureFlags,
                 )
-                builtImages.append("ue4-full")
             else:
                 logger.info("Skipping ue4-full image build.")
 
+            # Run the builds
+            graph.run(config.jobs)
+
             # If we are generating Dockerfiles then include information about the options used to generate them
             if config.layoutDir is not None:
 
@@ -0,0 +1,141 @@
+import os, re, subprocess
+from os.path import exists, join
+
+from .DockerUtils import DockerUtils
+
+
+class BuildCache(object):
+
+    # The name of the stand-in registry container we start if the cache registry is on this host and nothing is listening
+    REGISTRY_CONTAINER = "ue4-docker-cache-registry"
+
+    # The Docker volume that the stand-in registry stores its data in, so the cache outlives the container
+    REGISTRY_VOLUME = "ue4-docker-cache"
+
+    def __init__(self, logger, directory=None, registry=None):
+        """
+        Creates a build cache that stores cache images in either a local directory (as `docker save` archives) or a registry
+        """
+        if (directory is None) == (registry is None):
+            raise RuntimeError(
+                "exactly one of a cache directory or a cache registry must be specified"
+            )
+
+        self.logger = logger
+        self.directory = directory
+        self.registry = registry
+
+    def start(self):
+        """
+        Prepares the cache for use, starting a stand-in registry container if the cache registry is a local port that has no registry running
+        """
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+            return
+
+        host, _, port = self.registry.partition(":")
+        if host not in ["localhost", "127.0.0.1"]:
+            return
+
+        container = DockerUtils.getContainer(BuildCache.REGISTRY_CONTAINER)
+        if container is None:
+            self.logger.action(
+                'Starting cache registry "{}" on port {}...'.format(
+                    BuildCache.REGISTRY_CONTAINER, port or "80"
+                ),
+                newline=False,
+            )
+            DockerUtils.start(
+                "registry:2",
+                None,
+                name=BuildCache.REGISTRY_CONTAINER,
+                ports={"5000/tcp": int(port or "80")},
+                volumes={
+                    BuildCache.REGISTRY_VOLUME: {
+                        "bind": "/var/lib/registry",
+                        "mode": "rw",
+                    }
+                },
+                restart_policy={"Name": "always"},
+            )
+        elif container.status != "running":
+            container.start()
+
+    def stages(self, dockerfile):
+        """
+        Returns the names of the intermediate stages in the specified Dockerfile
+        (The final stage is cached along with the image itself, so it is excluded even if it is named)
+        """
+        with open(dockerfile, "r") as f:
+            contents = f.read()
+
+        stages = re.findall(
+            "^FROM\\s+\\S+\\s+AS\\s+(\\S+)\\s*$", contents, re.IGNORECASE | re.MULTILINE
+        )
+        froms = re.findall("^FROM\\s", contents, re.IGNORECASE | re.MULTILINE)
+        if len(stages) > 0 and len(stages) == len(froms):
+            stages = stages[:-1]
+
+        return stages
+
+    def cacheTag(self, image, stage=None):
+        """
+        Returns the tag that the cache for the specified image (or one of its intermediate stages) is stored under
+        """
+        repository, _, tag = image.rpartition(":")
+        prefix = self.registry if self.registry is not None else "ue4-docker-cache"
+        return "{}/{}:{}-cache-{}".format(
+            prefix, repository, tag, stage if stage is not None else "final"
+        )
+
+    def importCache(self, image, stages):
+        """
+        Imports whatever cache exists for the specified image and its stages, and returns the list of images to use with `--cache-from`
+        """
+        cacheFrom = []
+        for stage in stages + [None]:
+            tag = self.cacheTag(image, stage)
+            if self.registry is not None:
+                command = DockerUtils.pull(tag)
+            else:
+                archive = self._archive(tag)
+                if not exists(archive):
+                    continue
+                command = DockerUtils.load(archive)
+
+            # A cache miss isn't an error, it just means we build from scratch
+            if self._run(command):
+                cacheFrom.append(tag)
+
+        self.logger.info(
+            'Imported {} of {} cache images for "{}"'.format(
+                len(cacheFrom), len(stages) + 1, image
+            ),
+            newline=False,
+        )
+        return cacheFrom
+
+    def exportCache(self, image, stage, source):
+        """
+        Exports `source` (the built image, or one of its intermediate stages) as the cache for the specified image and stage
+        """
+        tag = self.cacheTag(image, stage)
+        if tag != source and not self._run(DockerUtils.tag(source, tag)):
+            return False
+
+        if self.registry is not None:
+            return self._run(DockerUtils.push(tag))
+        else:
+            return self._run(DockerUtils.save(tag, self._archive(tag)))
+
+    def _archive(self, tag):
+        return join(self.directory, re.sub("[^a-zA-Z0-9_.-]", "_", tag) + ".tar")
+
+    def _run(self, command):
+        # Cache traffic is noisy and not interesting when it works, and builds may be running concurrently
+        return (
+            subprocess.call(
+                command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+            == 0
+        )
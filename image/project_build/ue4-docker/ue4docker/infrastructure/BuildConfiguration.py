@@ -243,6 +243,27 @@ class BuildConfiguration(object):
             default=20.0,
             help="Sampling interval in seconds when resource monitoring has been enabled using --monitor (default is 20 seconds)",
         )
+        parser.add_argument(
+            "-cache-dir",
+            default=None,
+            help="Import build cache from the specified directory before building each image, and export it there afterwards",
+        )
+        parser.add_argument(
+            "-cache-registry",
+            default=None,
+            help="Import and export build cache via the specified registry (e.g. localhost:5000); a local registry container is started if one isn't already running",
+        )
+        parser.add_argument(
+            "-jobs",
+            type=int,
+            default=1,
+            help="Build up to this many images concurrently when their dependencies allow it (default is 1)",
+        )
+        parser.add_argument(
+            "-logs",
+            default=None,
+            help="Write the output of each image build to its own log file in the specified directory (default is the console, or ./ue4-docker-logs when -jobs is greater than 1)",
+        )
         parser.add_argument(
             "--ignore-blacklist",
             action="store_true",
@@ -458,6 +479,14 @@ class BuildConfiguration(object):
         self.verbose = self.args.verbose
         self.layoutDir = self.args.layout
         self.combine = self.args.combine
+        self.jobs = max(1, self.args.jobs)
+        self.cacheDir = self.args.cache_dir
+        self.cacheRegistry = self.args.cache_registry
+        self.logDir = self.args.logs
+
+        # Concurrent builds writing to the same console would be unreadable, so give each image its own log
+        if self.jobs > 1 and self.logDir is None:
+            self.logDir = os.path.abspath("ue4-docker-logs")
 
         # If the user specified custom version strings for ue4cli and/or conan-ue4cli, process them
         self.ue4cliVersion = self._processPackageVersion("ue4cli", self.args.ue4cli)
@@ -478,10 +507,21 @@ class BuildConfiguration(object):
         if self.layoutDir is not None:
             self.rebuild = True
 
+        # Generated Dockerfiles are written in build order, so don't generate them concurrently
+        if self.layoutDir is not None:
+            self.jobs = 1
+            self.logDir = None
+
         # If we are generating Dockerfiles and combining them then set the corresponding Jinja context value
         if self.layoutDir is not None and self.combine == True:
             self.opts["combine"] = True
 
+        # Build cache can live in a directory or a registry, but not both
+        if self.cacheDir is not None and self.cacheRegistry is not None:
+            raise RuntimeError(
+                "the `-cache-dir` and `-cache-registry` flags cannot be used together"
+            )
+
         # If the user requested an option that is only compatible with generated Dockerfiles then ensure `-layout` was specified
         if self.layoutDir is None and self.opts.get("source_mode", "git") != "git":
             raise RuntimeError(
@@ -0,0 +1,119 @@
+import concurrent.futures, humanfriendly, time
+
+
+class BuildGraph(object):
+    def __init__(self, logger, resourceMonitor=None):
+        """
+        Creates an empty graph of build tasks that will report progress via the supplied logger and resource monitor
+        """
+        self.logger = logger
+        self.resourceMonitor = resourceMonitor
+        self._tasks = {}
+        self._timings = {}
+
+    def __contains__(self, name):
+        return name in self._tasks
+
+    def add(self, name, dependencies, action):
+        """
+        Adds a task that runs `action` once every task named in `dependencies` has completed successfully
+        """
+
+        # Dependencies must already have been added, which also guarantees that the graph is acyclic
+        for dependency in dependencies:
+            if dependency not in self._tasks:
+                raise RuntimeError(
+                    'task "{}" depends on unknown task "{}"'.format(name, dependency)
+                )
+
+        self._tasks[name] = (list(dependencies), action)
+
+    def run(self, maxWorkers=1):
+        """
+        Runs every task in the graph, with at most `maxWorkers` running at once
+        (Ready tasks are started in the order they were added, so a single worker behaves like running them sequentially)
+        """
+        pending = list(self._tasks)
+        running = {}
+        completed = set()
+        failed = {}
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=maxWorkers) as pool:
+            while len(pending) > 0 or len(running) > 0:
+
+                # Start any tasks whose dependencies are satisfied, unless something has already failed
+                # (Tasks that are already running are allowed to finish, since interrupting a `docker build` leaves a mess behind)
+                if len(failed) == 0:
+                    for name in list(pending):
+                        if len(running) >= maxWorkers:
+                            break
+                        dependencies, action = self._tasks[name]
+                        if all(dependency in completed for dependency in dependencies):
+                            pending.remove(name)
+                            self.logger.action(
+                                'Starting task "{}" ({} of {}, {} running)'.format(
+                                    name,
+                                    len(self._tasks) - len(pending),
+                                    len(self._tasks),
+                                    len(running) + 1,
+                                ),
+                                newline=False,
+                            )
+                            running[pool.submit(self._runTask, name, action)] = name
+
+                if len(running) == 0:
+                    break
+
+                # Wait for at least one of the running tasks to complete
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    name = running.pop(future)
+                    if future.exception() is None:
+                        completed.add(name)
+                    else:
+                        failed[name] = future.exception()
+                        self.logger.error(
+                            'Task "{}" failed: {}'.format(name, future.exception())
+                        )
+
+        # Report the timing for each task, in the order they were added
+        self.logger.info("BUILD TASK TIMINGS:", False)
+        for name in self._tasks:
+            if name in self._timings:
+                self.logger.info(
+                    "{}: {} ({})".format(
+                        name,
+                        humanfriendly.format_timespan(self._timings[name]),
+                        "failed" if name in failed else "completed",
+                    ),
+                    False,
+                )
+            else:
+                self.logger.info("{}: not run".format(name), False)
+
+        if len(failed) > 0:
+            raise RuntimeError(
+                "; ".join(
+                    [
+                        'task "{}" failed: {}'.format(name, e)
+                        for name, e in failed.items()
+                    ]
+                )
+            )
+
+    def _runTask(self, name, action):
+        """
+        Runs a single task on a worker thread, recording how long it took
+        """
+        if self.resourceMonitor is not None:
+            self.resourceMonitor.beginActivity(name)
+
+        startTime = time.time()
+        try:
+            action()
+        finally:
+            self._timings[name] = time.time() - startTime
+            if self.resourceMonitor is not None:
+                self.resourceMonitor.endActivity(name)
@@ -45,9 +45,10 @@ class DockerUtils(object):
             return False
 
     @staticmethod
-    def build(tags, context, args):
+    def build(tags, context, args, cacheFrom=None, inlineCache=False):
         """
         Returns the `docker build` command to build an image
+        (`cacheFrom` lists images to reuse layers from; `inlineCache` embeds BuildKit cache metadata so the result can be used that way too)
         """
         tagArgs = [["-t", tag] for tag in tags]
         return (
@@ -55,10 +56,11 @@ class DockerUtils(object):
             + list(itertools.chain.from_iterable(tagArgs))
             + [context]
             + args
+            + DockerUtils._cacheArgs(cacheFrom, inlineCache)
         )
 
     @staticmethod
-    def buildx(tags, context, args, secrets):
+    def buildx(tags, context, args, secrets, cacheFrom=None):
         """
         Returns the `docker buildx` command to build an image with the BuildKit backend
         """
@@ -70,8 +72,19 @@ class DockerUtils(object):
             + ["--progress=plain"]
             + args
             + list(itertools.chain.from_iterable([["--secret", s] for s in secrets]))
+            + DockerUtils._cacheArgs(cacheFrom, True)
         )
 
+    @staticmethod
+    def _cacheArgs(cacheFrom, inlineCache):
+        """
+        Returns the flags for importing build cache from the specified images
+        """
+        cacheFrom = cacheFrom if cacheFrom is not None else []
+        return list(
+            itertools.chain.from_iterable([["--cache-from", c] for c in cacheFrom])
+        ) + (["--build-arg", "BUILDKIT_INLINE_CACHE=1"] if inlineCache else [])
+
     @staticmethod
     def pull(image):
         """
@@ -79,6 +92,45 @@ class DockerUtils(object):
         """
         return ["docker", "pull", image]
 
+    @staticmethod
+    def push(image):
+        """
+        Returns the `docker push` command to push an image to a remote registry
+        """
+        return ["docker", "push", image]
+
+    @staticmethod
+    def tag(source, target):
+        """
+        Returns the `docker tag` command to add a tag to an existing image
+        """
+        return ["docker", "tag", source, target]
+
+    @staticmethod
+    def save(image, path):
+        """
+        Returns the `docker save` command to write an image to an archive file
+        """
+        return ["docker", "save", "-o", path, image]
+
+    @staticmethod
+    def load(path):
+        """
+        Returns the `docker load` command to read an image from an archive file
+        """
+        return ["docker", "load", "-i", path]
+
+    @staticmethod
+    def getContainer(name):
+        """
+        Retrieves the container with the specified name, or None if there is no such container
+        """
+        client = docker.from_env()
+        try:
+            return client.containers.get(name)
+        except docker.errors.NotFound:
+            return None
+
     @staticmethod
     def start(image, command, **kwargs):
         """
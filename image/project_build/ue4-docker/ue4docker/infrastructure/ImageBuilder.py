@@ -19,6 +19,8 @@ class ImageBuilder(object):
         layoutDir=None,
         templateContext=None,
         combine=False,
+        logDir=None,
+        cache=None,
     ):
         """
         Creates an ImageBuilder for the specified build parameters
@@ -31,6 +33,8 @@ class ImageBuilder(object):
         self.layoutDir = layoutDir
         self.templateContext = templateContext if templateContext is not None else {}
         self.combine = combine
+        self.logDir = logDir
+        self.cache = cache
 
     def build(self, name, tags, args, secrets=None):
         """
@@ -70,8 +74,7 @@ class ImageBuilder(object):
 
             # Determine whether we are building using `docker buildx` with build secrets
             imageTags = self._formatTags(name, tags)
-            command = DockerUtils.build(imageTags, self.context(name), args)
-
+            secretFlags = None
             if self.platform == "linux" and secrets is not None and len(secrets) > 0:
 
                 # Create temporary files to store the contents of each of our secrets
@@ -81,10 +84,18 @@ class ImageBuilder(object):
                     FilesystemUtils.writeFile(secretFile, contents)
                     secretFlags.append("id={},src={}".format(secret, secretFile))
 
-                # Generate the `docker buildx` command to use our build secrets
-                command = DockerUtils.buildx(
-                    imageTags, self.context(name), args, secretFlags
-                )
+            # If we have a build cache and are actually going to build, import any cached layers for this image and its intermediate stages
+            # (There's no point when the user has asked for `--no-cache`, since Docker would ignore them anyway)
+            useCache = (
+                self.cache is not None
+                and self.dryRun == False
+                and self.layoutDir is None
+                and "--no-cache" not in args
+                and self._willProcess(imageTags[0])
+            )
+            stages = self.cache.stages(dockerfile) if useCache else []
+            cacheFrom = self.cache.importCache(imageTags[0], stages) if useCache else []
+            command = self._buildCommand(imageTags, name, args, secretFlags, cacheFrom)
 
             env = os.environ.copy()
             if self.platform == "linux":
@@ -100,6 +111,65 @@ class ImageBuilder(object):
                 env=env,
             )
 
+            # Export the build cache for next time
+            if useCache:
+                self._exportCache(
+                    imageTags[0], name, stages, args, secretFlags, cacheFrom, env
+                )
+
+    def _buildCommand(self, imageTags, name, args, secretFlags, cacheFrom):
+        """
+        Generates the command to build the specified image, using `docker buildx` if we have build secrets
+        """
+        if secretFlags is not None:
+            return DockerUtils.buildx(
+                imageTags, self.context(name), args, secretFlags, cacheFrom
+            )
+
+        return DockerUtils.build(
+            imageTags,
+            self.context(name),
+            args,
+            cacheFrom,
+            inlineCache=self.platform == "linux",
+        )
+
+    def _exportCache(self, image, name, stages, args, secretFlags, cacheFrom, env):
+        """
+        Exports the build cache for the specified image and each of its intermediate stages
+        """
+
+        # Intermediate stages aren't tagged by a normal build, so build each of them as a target
+        # (Every layer was just built, so this only takes as long as tagging the result)
+        exported = 0
+        for stage in stages:
+            stageTag = self.cache.cacheTag(image, stage)
+            command = self._buildCommand(
+                [stageTag], name, args + ["--target", stage], secretFlags, cacheFrom
+            )
+            if subprocess.call(
+                command,
+                env=env,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            ) == 0 and self.cache.exportCache(image, stage, stageTag):
+                exported += 1
+
+        if self.cache.exportCache(image, None, image):
+            exported += 1
+
+        # A failure to export the cache only costs time on the next build, so it isn't fatal
+        if exported == len(stages) + 1:
+            self.logger.action(
+                'Exported build cache for image "{}"'.format(image), newline=False
+            )
+        else:
+            self.logger.error(
+                'Warning: only exported {} of {} cache images for image "{}"'.format(
+                    exported, len(stages) + 1, image
+                )
+            )
+
     def context(self, name):
         """
         Resolve the full path to the build context for the specified image
@@ -222,9 +292,24 @@ class ImageBuilder(object):
 
             return
 
-        # Attempt to process the image using the supplied command
+        # Attempt to process the image using the supplied command, sending its output to a log file if requested
         startTime = time.time()
-        exitCode = subprocess.call(command, env=env)
+        logFile = None
+        if self.logDir is not None:
+            os.makedirs(self.logDir, exist_ok=True)
+            logFile = join(
+                self.logDir, "{}.log".format(image.replace("/", "_").replace(":", "_"))
+            )
+            self.logger.info(
+                'Writing output for image "{}" to "{}"'.format(image, logFile),
+                newline=False,
+            )
+            with open(logFile, "wb") as log:
+                exitCode = subprocess.call(
+                    command, env=env, stdout=log, stderr=subprocess.STDOUT
+                )
+        else:
+            exitCode = subprocess.call(command, env=env)
         endTime = time.time()
 
         # Determine if processing succeeded
@@ -240,4 +325,9 @@ class ImageBuilder(object):
         else:
             raise RuntimeError(
                 'failed to {} image "{}".'.format(actionPresentTense, image)
+                + (
+                    " See {} for details.".format(logFile)
+                    if logFile is not None
+                    else ""
+                )
             )
@@ -1,8 +1,12 @@
 from termcolor import colored
-import colorama, sys
+import colorama, sys, threading
 
 
 class Logger(object):
+
+    # Builds can run concurrently, so make sure their messages don't interleave
+    _lock = threading.Lock()
+
     def __init__(self, prefix=""):
         """
         Creates a logger that will print coloured output to stderr
@@ -30,4 +34,8 @@ class Logger(object):
 
     def _print(self, colour, output, newline):
         whitespace = "\n" if newline == True else ""
-        print(colored(whitespace + self.prefix + output, color=colour), file=sys.stderr)
+        with Logger._lock:
+            print(
+                colored(whitespace + self.prefix + output, color=colour),
+                file=sys.stderr,
+            )
@@ -12,6 +12,21 @@ class ResourceMonitor(threading.Thread):
         self._interval = interval
         self._lock = threading.Lock()
         self._shouldStop = False
+        self._activities = {}
+
+    def beginActivity(self, name):
+        """
+        Records that the named activity (such as an image build) has started, so it is included in resource reports
+        """
+        with self._lock:
+            self._activities[name] = time.time()
+
+    def endActivity(self, name):
+        """
+        Records that the named activity has finished
+        """
+        with self._lock:
+            self._activities.pop(name, None)
 
     def stop(self):
         """
@@ -72,10 +87,32 @@ class ResourceMonitor(threading.Thread):
             # Format the current CPU usage levels
             cpu = psutil.cpu_percent()
 
+            # Format the list of activities that are currently in progress, along with how long each has been running
+            with self._lock:
+                activities = ", ".join(
+                    [
+                        "{} ({})".format(
+                            name,
+                            humanfriendly.format_timespan(
+                                time.time() - startTime, max_units=2
+                            ),
+                        )
+                        for name, startTime in self._activities.items()
+                    ]
+                )
+            inProgress = (
+                " [In progress: {}]".format(activities) if len(activities) > 0 else ""
+            )
+
             # Report the current levels of our available resources
             self._logger.info(
-                "[{}] [Available disk: {}] [Available memory: {} physical, {} virtual] [CPU usage: {:.2f}%]".format(
-                    isoTime, diskSpace, physicalMemory, virtualMemory, cpu
+                "[{}] [Available disk: {}] [Available memory: {} physical, {} virtual] [CPU usage: {:.2f}%]{}".format(
+                    isoTime,
+                    diskSpace,
+                    physicalMemory,
+                    virtualMemory,
+                    cpu,
+                    inProgress,
                 ),
                 False,
             )
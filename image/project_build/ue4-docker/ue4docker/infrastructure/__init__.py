@@ -1,4 +1,6 @@
+from .BuildCache import BuildCache
 from .BuildConfiguration import BuildConfiguration
+from .BuildGraph import BuildGraph
 from .CredentialEndpoint import CredentialEndpoint
 from .DarwinUtils import DarwinUtils
 from .DockerUtils import DockerUtils
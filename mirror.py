@@ -0,0 +1,58 @@
+
+# Pull-through registry mirror for base and build images (see util/mirror.py).
+#
+#   pipenv run python mirror.py serve --storage d:\arclight-mirror --max_gb 200
+#   pipenv run python mirror.py stats
+#   pipenv run python mirror.py evict
+#
+# arclight starts one of these itself when given `--mirror localhost:PORT` and nothing's listening there,
+# and `--aws_mirror` runs one on a small instance inside the VPC.
+
+import argparse
+import json
+import urllib.request
+
+import util.mirror
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog = "Arclight mirror")
+    commands = parser.add_subparsers(dest = "command", required = True)
+
+    servecmd = commands.add_parser("serve", help="Run the mirror")
+    servecmd.add_argument("--port", help="Port to listen on", type=int, default=util.mirror.default_port)
+    servecmd.add_argument("--storage", help="Directory to keep cached images in; put it somewhere that survives reboots", required=True)
+    servecmd.add_argument("--max_gb", help="Evict least-recently-used layers once the cache grows past this", type=float, default=200)
+    servecmd.add_argument("--upstream", help="Registry to mirror (may be repeated)", action="append")
+    servecmd.add_argument("--ecr_region", help="Also mirror this account's ECR registry in this region, using the AWS credentials in the environment")
+
+    statscmd = commands.add_parser("stats", help="Show hit rates and cache usage")
+    statscmd.add_argument("--mirror", help="Mirror address", default=f"localhost:{util.mirror.default_port}")
+    statscmd.add_argument("--json", help="Print raw JSON", action="store_true")
+
+    evictcmd = commands.add_parser("evict", help="Empty the blob cache")
+    evictcmd.add_argument("--mirror", help="Mirror address", default=f"localhost:{util.mirror.default_port}")
+
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        upstreams = {host: util.mirror.Upstream(host) for host in (args.upstream or util.mirror.default_upstreams)}
+        if args.ecr_region is not None:
+            import boto3
+            account = boto3.client("sts", region_name = args.ecr_region).get_caller_identity()["Account"]
+            host = f"{account}.dkr.ecr.{args.ecr_region}.amazonaws.com"
+            upstreams[host] = util.mirror.Upstream(host, util.mirror.EcrCredentials(args.ecr_region))
+
+        util.mirror.serve(args.storage, args.port, int(args.max_gb * (1 << 30)), upstreams)
+    elif args.command == "stats":
+        stats = util.mirror.fetch_stats(args.mirror)
+        if args.json:
+            print(json.dumps(stats, indent = 2))
+        else:
+            print(util.mirror.describe_stats(stats))
+    elif args.command == "evict":
+        request = urllib.request.Request(f"http://{args.mirror}{util.mirror.stats_path}", method = "DELETE")
+        with urllib.request.urlopen(request) as response:
+            print(util.mirror.describe_stats(json.load(response)))
+
+if __name__ == "__main__":
+    main()
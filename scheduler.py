@@ -0,0 +1,132 @@
+
+# Local multi-job scheduler.
+# Big build hosts are mostly idle when they run one arclight job at a time, so this runs a small daemon that accepts several and packs them onto the machine.
+#
+#   pipenv run python scheduler.py serve
+#   pipenv run python scheduler.py submit --cpus 16 -- --managed --p4_username ... build --target_platform=Win64 --client_config=Development
+#   pipenv run python scheduler.py status
+#   pipenv run python scheduler.py cancel 3
+
+import argparse
+import http.server
+import json
+import pathlib
+import threading
+import urllib.error
+import urllib.request
+
+import util.scheduler
+
+def find_lock(args):
+    # Two jobs working in the same directory (or the same p4 workspace) would trample each other, so those always run one at a time
+    for flag in ["--working", "--p4_workspace"]:
+        if flag in args and args.index(flag) + 1 < len(args):
+            return f"{flag}={args[args.index(flag) + 1]}"
+        for arg in args:
+            if arg.startswith(f"{flag}="):
+                return arg
+    return None
+
+def serve(port: int, cpus: int, memory: int) -> None:
+    arclightdir = pathlib.Path(__file__).parent
+    runner = util.scheduler.ArclightRunner(str(arclightdir), str(arclightdir.joinpath("arclight_cache/scheduler/logs")))
+    scheduler = util.scheduler.Scheduler(runner, *util.scheduler.host_budget(memory = memory, cpus = cpus))
+    print(f"SCHEDULER: managing {scheduler.cpus} CPUs and {scheduler.memory}GB on port {port}")
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def reply(self, code: int, body) -> None:
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/jobs":
+                self.reply(200, scheduler.status())
+            else:
+                self.reply(404, {"error": "not found"})
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            try:
+                if self.path == "/jobs":
+                    job = scheduler.submit(request["args"], request["cpus"], request.get("memory"), request.get("lock"))
+                elif self.path == "/cancel":
+                    job = scheduler.cancel(request["id"])
+                else:
+                    self.reply(404, {"error": "not found"})
+                    return
+            except Exception as ex:
+                self.reply(400, {"error": str(ex)})
+                return
+            self.reply(200, job.describe())
+
+        def log_message(self, format, *args):
+            pass    # status polling is noisy and we print everything interesting ourselves
+
+    threading.Thread(target = scheduler.run, daemon = True).start()
+
+    # localhost only; this will happily run arbitrary arclight commands for anyone who can reach it
+    http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler).serve_forever()
+
+def request(port: int, path: str, body = None):
+    url = f"http://127.0.0.1:{port}{path}"
+    if body is None:
+        req = urllib.request.Request(url)
+    else:
+        req = urllib.request.Request(url, data = json.dumps(body).encode("utf-8"), headers = {"Content-Type": "application/json"})
+
+    try:
+        with urllib.request.urlopen(req) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as ex:
+        raise Exception(json.loads(ex.read())["error"])
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog = "Arclight scheduler")
+    parser.add_argument("--port", help="Port the scheduler listens on", type=int, default=8473)
+    commands = parser.add_subparsers(dest = "command", required = True)
+
+    servecmd = commands.add_parser("serve", help="Run the scheduler daemon")
+    servecmd.add_argument("--cpus", help="CPUs to hand out (defaults to all of them)", type=int)
+    servecmd.add_argument("--memory", help="Memory to hand out, in gigabytes (defaults to 75%% of the machine)", type=int)
+
+    submitcmd = commands.add_parser("submit", help="Queue an arclight job")
+    submitcmd.add_argument("--cpus", help="CPUs for this job's container", type=int, required=True)
+    submitcmd.add_argument("--memory", help="Memory for this job's container, in gigabytes (defaults to 8 + 2 per CPU)", type=int)
+    submitcmd.add_argument("--lock", help="Jobs with the same lock never run at the same time (defaults to the job's working directory or workspace)")
+    submitcmd.add_argument("arclight_args", help="Arguments to arclight.py, after a `--`", nargs=argparse.REMAINDER)
+
+    commands.add_parser("status", help="List jobs and host usage")
+
+    cancelcmd = commands.add_parser("cancel", help="Cancel a queued or running job")
+    cancelcmd.add_argument("id", type=int)
+
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        serve(args.port, args.cpus, args.memory)
+    elif args.command == "submit":
+        arclight_args = args.arclight_args
+        if len(arclight_args) >= 1 and arclight_args[0] == "--":
+            arclight_args = arclight_args[1:]
+        if "--aws" in arclight_args:
+            raise Exception("AWS jobs don't use local resources; just run them directly")
+
+        job = request(args.port, "/jobs", {
+            "args": arclight_args,
+            "cpus": args.cpus,
+            "memory": args.memory,
+            "lock": args.lock or find_lock(arclight_args),
+        })
+        print(f"Queued job {job['id']} ({job['cpus']} CPUs, {job['memory']}GB)")
+    elif args.command == "status":
+        util.scheduler.print_status(request(args.port, "/jobs"))
+    elif args.command == "cancel":
+        job = request(args.port, "/cancel", {"id": args.id})
+        print(f"Cancelling job {job['id']} ({job['state']})")
+
+if __name__ == "__main__":
+    main()
@@ -24,11 +24,14 @@ args = parser.parse_args()
 if args.validate:
     print(json.dumps({
         "image": "project_build",
+        # extra phases arclight should time from our output, on top of the Unreal ones; see util/logphases.py
+        # "log_phases": {"phases": [{"name": "symbol upload", "start": r"Uploading symbols", "end": r"Symbols uploaded"}]},
     }))
     exit()
 
 root_dir = os.getcwd()
 
 # DO THE ACTUAL BUILD HERE
+# (to see the steps in the job's trace, import `Context` from arclight's util/prof.py once `--validate` is out of the way, and wrap each one in `with Context("cook"):`)
 
 # SORRY, CAN'T MAKE THIS PART PUBLIC
@@ -0,0 +1,115 @@
+
+# Build step for Arclight.
+# Benchmarks the filesystem the build runs on, with a workload shaped like a UE build: lots of small files written, stat'ed, read back and partly rewritten.
+# Run it with and without `--smb_stage`:
+#   * without, it only measures the SMB share;
+#   * with, it measures the stage and the share side by side (bootstrap tells us where the share is), and bootstrap's STAGE: lines and metrics give the cost of copying in and out.
+
+import argparse
+import hashlib
+import json
+import os
+import pathlib
+import random
+import shutil
+import sys
+import time
+
+parser = argparse.ArgumentParser()
+
+mode = parser.add_mutually_exclusive_group(required = True)
+mode.add_argument("--validate", help="Validate settings and return configuration", action="store_true")
+mode.add_argument("--output", help="Output target")
+
+parser.add_argument("--files", help="Number of files in the workload", type=int, default=5000)
+parser.add_argument("--min_kb", help="Smallest file size", type=int, default=1)
+parser.add_argument("--max_kb", help="Largest file size", type=int, default=64)
+parser.add_argument("--rewrite", help="Fraction of files to rewrite, like an incremental build", type=float, default=0.1)
+
+args = parser.parse_args()
+
+if args.validate:
+    print(json.dumps({
+        "image": "project_build",
+        # we don't need anything besides ourselves
+        "view": {
+            "include": ["arclight/..."],
+        },
+    }))
+    exit()
+
+# Spans recorded here show up in the job's trace, under bootstrap's "script" span
+# (imported only now, since the prof dump at exit would garble `--validate`'s output)
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+from util.prof import Context
+
+def workload(root: str):
+    # the same files every time, so runs are comparable
+    rng = random.Random(0)
+    scratch = os.path.join(root, "arclight_smb_benchmark")
+    if os.path.isdir(scratch):
+        shutil.rmtree(scratch)
+
+    # spread across directories like a real intermediate tree
+    paths = [os.path.join(scratch, f"dir{i % 64}", f"file{i}.obj") for i in range(args.files)]
+    contents = [rng.randbytes(rng.randint(args.min_kb, args.max_kb) * 1024) for _ in paths]
+    timings = {}
+
+    start = time.perf_counter()
+    for path, data in zip(paths, contents):
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        with open(path, "wb") as f:
+            f.write(data)
+    timings["write"] = time.perf_counter() - start
+
+    # up-to-date checks are mostly stats
+    start = time.perf_counter()
+    for path in paths:
+        os.stat(path)
+    timings["stat"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for path in paths:
+        with open(path, "rb") as f:
+            hashlib.sha256(f.read())
+    timings["read"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for path in rng.sample(paths, int(len(paths) * args.rewrite)):
+        with open(path, "ab") as f:
+            f.write(b"rewritten")
+    timings["rewrite"] = time.perf_counter() - start
+
+    # cleaned up so it doesn't get staged back out, or left lying around on the share
+    start = time.perf_counter()
+    shutil.rmtree(scratch)
+    timings["delete"] = time.perf_counter() - start
+
+    timings["total"] = sum(timings.values())
+    return {
+        "root": root,
+        "files": len(paths),
+        "bytes": sum(len(data) for data in contents),
+        "seconds": timings,
+    }
+
+results = {}
+smbworkdir = os.environ.get("ARCLIGHT_SMB_WORKDIR")
+if smbworkdir is not None:
+    with Context("staged workload", root = os.getcwd()):
+        results["staged"] = workload(os.getcwd())
+    with Context("smb workload", root = smbworkdir):
+        results["smb"] = workload(smbworkdir)
+else:
+    with Context("smb workload", root = os.getcwd()):
+        results["smb"] = workload(os.getcwd())
+
+for name, result in results.items():
+    phases = ", ".join(f"{phase} {seconds:0.2f}s" for phase, seconds in result["seconds"].items())
+    print(f"{name} ({result['root']}): {phases}")
+if "staged" in results:
+    print(f"Staged is {results['smb']['seconds']['total'] / results['staged']['seconds']['total']:0.1f}x faster, before the cost of copying in and out (see the STAGE: lines)")
+
+os.mkdir(args.output)
+with open(os.path.join(args.output, "smb_benchmark.json"), "w") as f:
+    json.dump(results, f, indent = 2)
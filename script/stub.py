@@ -20,6 +20,10 @@ args = parser.parse_args()
 if args.validate:
     print(json.dumps({
         "image": "project_build",
+        # we don't need anything besides ourselves
+        "view": {
+            "include": ["arclight/..."],
+        },
     }))
     exit()
 
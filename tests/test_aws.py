@@ -0,0 +1,51 @@
+import json
+
+import boto3
+import moto
+import pytest
+
+import util.aws
+
+@pytest.fixture
+def aws(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "test")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "test")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    # (the mirror's role uses one of AWS's own policies, which moto only knows about if asked)
+    with moto.mock_aws(config = {"iam": {"load_aws_managed_policies": True}}):
+        boto3.client("s3").create_bucket(Bucket = "arclight")
+
+        # __init__ logs into docker and sets up the whole VPC; record_build only needs the credentials
+        handle = util.aws.Aws.__new__(util.aws.Aws)
+        handle.region = "us-east-1"
+        handle.aws_access_key_id = "test"
+        handle.aws_secret_access_key = "test"
+        yield handle
+
+def test_record_build(aws):
+    aws.record_build("Project_Mainline", "arclight:project_build_0123abcd", "jenkins-42")
+
+    objects = boto3.client("s3").list_objects_v2(Bucket = "arclight", Prefix = f"{util.aws.builds_prefix}/")["Contents"]
+    assert len(objects) == 1
+
+    # builds/{stream}/{time}/{image tag}, which is what util/ecrgc.py parses
+    prefix, stream, timestamp, tag = objects[0]["Key"].split("/")
+    assert (prefix, stream, tag) == (util.aws.builds_prefix, "Project_Mainline", "project_build_0123abcd")
+    assert len(timestamp) == len("20260101T000000") and timestamp[8] == "T"
+
+    body = json.loads(boto3.client("s3").get_object(Bucket = "arclight", Key = objects[0]["Key"])["Body"].read())
+    assert body == {"build": "jenkins-42", "stream": "Project_Mainline", "image": "arclight:project_build_0123abcd"}
+
+def test_mirror_profile(aws):
+    name = aws.ensure_mirror_profile()
+
+    # the mirror reads ECR through its instance profile, and can't do anything else
+    iam = boto3.client("iam")
+    roles = iam.get_instance_profile(InstanceProfileName = name)["InstanceProfile"]["Roles"]
+    assert [role["RoleName"] for role in roles] == [name]
+    policies = iam.list_attached_role_policies(RoleName = name)["AttachedPolicies"]
+    assert [policy["PolicyArn"] for policy in policies] == [util.aws.mirror_policy]
+
+    # and a second run just finds it
+    assert aws.ensure_mirror_profile() == name
+    assert len(iam.list_instance_profiles()["InstanceProfiles"]) == 1
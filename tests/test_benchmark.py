@@ -0,0 +1,32 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import util.standins
+
+# Runs benchmark.py end to end: every flow against moto and the stand-ins, so no network, Docker, p4 or AWS account is needed
+# The stand-ins' simulated latencies are all zeroed, since only whether the flows get to the end matters here
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.mark.parametrize("flow", ["aws", "managed"])
+def test_flow(flow, tmp_path):
+    reportpath = tmp_path / "reports.json"
+    latencies = sum([["--latency", f"{kind}=0"] for kind in util.standins.default_latency.keys()], [])
+    result = subprocess.run(
+        [sys.executable, os.path.join(root, "benchmark.py"), "--flow", flow, "--save", str(reportpath)] + latencies,
+        cwd = root, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, text = True, timeout = 600)
+    assert result.returncode == 0, result.stdout
+
+    with open(reportpath, "r") as f:
+        report = json.load(f)[flow]
+    assert report["critical_path"][0]["span"] == "main"
+    if flow == "aws":
+        assert report["api_calls"].get("ec2.RunInstances", 0) >= 1
+        assert report["standins"]["calls"].get("ssh docker run", 0) == 1
+    else:
+        assert report["standins"]["calls"].get("docker start -a", 0) == 1
+        # once to make sure the name's free, once to clean up after itself
+        assert report["standins"]["calls"].get("docker rm", 0) == 2
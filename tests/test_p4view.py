@@ -0,0 +1,58 @@
+import util.p4view
+
+def client(view):
+    return {"Client": "ws", "Stream": "//depot/Project_Mainline", "View": list(view)}
+
+stream_view = [
+    "//depot/Project_Mainline/... //ws/...",
+    "-//depot/Project_Mainline/Game/Saved/... //ws/Game/Saved/...",
+    # Engine is imported from another stream
+    "//depot/Engine_Release/Engine/... //ws/Engine/...",
+]
+
+def test_not_narrowed_leaves_the_stream_alone():
+    spec = client(stream_view)
+    assert util.p4view.apply(spec, util.p4view.normalize(None)) == []
+    assert spec["View"] == stream_view
+    assert spec["Stream"] == "//depot/Project_Mainline"
+
+def test_include_keeps_imports():
+    spec = client(stream_view)
+    view = util.p4view.normalize({"include": ["Engine/...", "Game/Content/..."]})
+    assert util.p4view.apply(spec, view) == []
+
+    assert spec["View"] == [
+        # the stream root, cut down to our includes (later lines still win, so Engine comes from the import)
+        "//depot/Project_Mainline/Engine/... //ws/Engine/...",
+        "//depot/Project_Mainline/Game/Content/... //ws/Game/Content/...",
+        "-//depot/Project_Mainline/Game/Saved/... //ws/Game/Saved/...",
+        "//depot/Engine_Release/Engine/... //ws/Engine/...",
+    ]
+    assert "Stream" not in spec
+
+def test_include_narrower_than_an_import():
+    spec = client(stream_view)
+    util.p4view.apply(spec, util.p4view.normalize({"include": ["Engine/Source/..."]}))
+    assert spec["View"] == [
+        "//depot/Project_Mainline/Engine/Source/... //ws/Engine/Source/...",
+        "-//depot/Project_Mainline/Game/Saved/... //ws/Game/Saved/...",
+        "//depot/Engine_Release/Engine/Source/... //ws/Engine/Source/...",
+    ]
+
+def test_exclude_follows_imports():
+    spec = client(stream_view)
+    util.p4view.apply(spec, util.p4view.normalize({"exclude": ["Engine/Binaries/..."]}))
+    assert spec["View"] == stream_view + [
+        "-//depot/Project_Mainline/Engine/Binaries/... //ws/Engine/Binaries/...",
+        "-//depot/Engine_Release/Engine/Binaries/... //ws/Engine/Binaries/...",
+    ]
+
+def test_unmapped_include_is_reported():
+    spec = client(["//depot/Engine_Release/Engine/... //ws/Engine/..."])
+    assert util.p4view.apply(spec, util.p4view.normalize({"include": ["Engine/...", "Game/..."]})) == ["Game/..."]
+    assert spec["View"] == ["//depot/Engine_Release/Engine/... //ws/Engine/..."]
+
+def test_quoted_paths():
+    spec = client(['"//depot/Project_Mainline/My Game/..." "//ws/My Game/..."'])
+    util.p4view.apply(spec, util.p4view.normalize({"include": ["My Game/Content/..."]}))
+    assert spec["View"] == ['"//depot/Project_Mainline/My Game/Content/..." "//ws/My Game/Content/..."']
@@ -0,0 +1,165 @@
+import subprocess
+
+import pytest
+
+import util.scheduler
+
+class StubRunner:
+    # Jobs "run" until the test finishes them (or they're cancelled)
+    def __init__(self):
+        self.started = []
+        self.cancelled = []
+        self.returncodes = {}
+
+    def start(self, job):
+        self.started.append(job.id)
+        return job.id
+
+    def poll(self, handle):
+        return self.returncodes.get(handle)
+
+    def cancel(self, handle):
+        self.cancelled.append(handle)
+        self.returncodes[handle] = 1
+
+    def finish(self, job, returncode = 0):
+        self.returncodes[job.id] = returncode
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def runner():
+    return StubRunner()
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+@pytest.fixture
+def scheduler(runner, clock):
+    return util.scheduler.Scheduler(runner, cpus = 16, memory = 64, clock = clock)
+
+def test_admits_what_fits(scheduler, runner):
+    small = scheduler.submit(["a"], cpus = 8, memory = 24)
+    medium = scheduler.submit(["b"], cpus = 8, memory = 24)
+    big = scheduler.submit(["c"], cpus = 4, memory = 24)
+    scheduler.tick()
+
+    # the third one has the CPUs, but not the memory
+    assert runner.started == [small.id, medium.id]
+    assert (small.state, medium.state, big.state) == ("running", "running", "queued")
+    status = scheduler.status()
+    assert (status["used_cpus"], status["used_memory"]) == (16, 48)
+
+def test_oversized_job_is_rejected(scheduler):
+    with pytest.raises(Exception):
+        scheduler.submit(["a"], cpus = 32)
+    with pytest.raises(Exception):
+        scheduler.submit(["a"], cpus = 4, memory = 128)
+
+def test_finished_job_releases_budget(scheduler, runner, clock):
+    first = scheduler.submit(["a"], cpus = 12, memory = 32)
+    second = scheduler.submit(["b"], cpus = 12, memory = 32)
+    scheduler.tick()
+    assert runner.started == [first.id]
+
+    clock.now += 60
+    runner.finish(first)
+    scheduler.tick()
+    assert first.state == "succeeded"
+    assert first.finished - first.started == 60
+    assert second.state == "running"
+    assert second.started - second.submitted == 60
+
+def test_failed_job(scheduler, runner):
+    job = scheduler.submit(["a"], cpus = 4)
+    scheduler.tick()
+    runner.finish(job, returncode = 3)
+    scheduler.tick()
+    assert (job.state, job.returncode) == ("failed", 3)
+
+def test_smaller_jobs_skip_ahead_until_the_head_starves(scheduler, runner, clock):
+    blocker = scheduler.submit(["a"], cpus = 12, memory = 32)
+    scheduler.tick()
+    big = scheduler.submit(["b"], cpus = 12, memory = 32)
+    small = scheduler.submit(["c"], cpus = 2, memory = 8)
+    scheduler.tick()
+    assert small.state == "running"
+
+    # once the head's been waiting long enough, nothing else gets past it
+    runner.finish(small)
+    clock.now += util.scheduler.starvation_seconds + 1
+    late = scheduler.submit(["d"], cpus = 2, memory = 8)
+    scheduler.tick()
+    assert (big.state, late.state) == ("queued", "queued")
+
+    runner.finish(blocker)
+    scheduler.tick()
+    assert (big.state, late.state) == ("running", "running")
+
+def test_lock_serialises_jobs(scheduler, runner):
+    first = scheduler.submit(["a"], cpus = 2, lock = "workspace")
+    second = scheduler.submit(["b"], cpus = 2, lock = "workspace")
+    other = scheduler.submit(["c"], cpus = 2, lock = "elsewhere")
+    scheduler.tick()
+    assert (first.state, second.state, other.state) == ("running", "queued", "running")
+
+    runner.finish(first)
+    scheduler.tick()
+    assert second.state == "running"
+
+def test_cancel_queued(scheduler, runner):
+    running = scheduler.submit(["a"], cpus = 16, memory = 64)
+    queued = scheduler.submit(["b"], cpus = 4)
+    scheduler.tick()
+
+    scheduler.cancel(queued.id)
+    assert queued.state == "cancelled"
+
+    # it never starts, even once there's room
+    runner.finish(running)
+    scheduler.tick()
+    assert runner.started == [running.id]
+    assert runner.cancelled == []
+
+def test_cancel_running_releases_budget(scheduler, runner):
+    running = scheduler.submit(["a"], cpus = 16, memory = 64)
+    waiting = scheduler.submit(["b"], cpus = 4)
+    scheduler.tick()
+
+    scheduler.cancel(running.id)
+    assert runner.cancelled == [running.id]
+
+    # the budget comes back when the runner says it's gone, and the next job gets it
+    scheduler.tick()
+    assert running.state == "cancelled"
+    assert waiting.state == "running"
+    status = scheduler.status()
+    assert (status["used_cpus"], status["used_memory"]) == (4, util.scheduler.default_memory(4))
+
+def test_describe_masks_passwords():
+    job = util.scheduler.Job(1, ["--p4_username", "me", "--p4_password", "secret", "--smb_password=hunter2", "build"], 4, 16, None)
+    assert job.describe()["args"] == ["--p4_username", "me", "--p4_password", "****", "--smb_password=****", "build"]
+
+def test_arclight_runner_cancel_removes_container(tmp_path, monkeypatch):
+    runner = util.scheduler.ArclightRunner(str(tmp_path), str(tmp_path / "logs"))
+    job = util.scheduler.Job(7, ["build"], 4, 16, None)
+
+    class Process:
+        terminated = False
+
+        def terminate(self):
+            self.terminated = True
+
+    commands = []
+    monkeypatch.setattr(subprocess, "run", lambda command, **kwargs: commands.append(command))
+
+    process = Process()
+    runner.cancel((process, None, runner.container_name(job)))
+    assert process.terminated
+    assert commands == [["docker", "rm", "-f", runner.container_name(job)]]
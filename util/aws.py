@@ -3,6 +3,7 @@ import base64
 import boto3
 import datetime
 import fabric
+import json
 import os
 import pprint
 import re
@@ -14,6 +15,11 @@ from typing import Dict
 from typing import List
 from typing import Optional
 
+import util.awscalls
+import util.bootstrap
+import util.cost
+import util.mirror
+from util.prof import annotate
 from util.prof import prof
 from util.simple_utc import simple_utc
 
@@ -22,6 +28,24 @@ version = 2
 
 label = f"{envname}-v{version}"
 
+# The registry mirror instance (see ensure_mirror): small, because it mostly just moves bytes, with a cache volume that outlives it
+mirror_instance_type = "t3a.medium"
+mirror_storage_gb = 250
+mirror_ami_parameter = "/aws/service/ami-amazon-linux-latest/amzn2-ami-hvm-x86_64-gp2"
+# and all it's allowed to do with AWS is read from ECR
+mirror_policy = "arn:aws:iam::aws:policy/AmazonEC2ContainerRegistryReadOnly"
+
+# Incompressible blob that bootstrap's network preflight downloads a chunk of to measure S3 throughput
+preflight_sample_key = "preflight/sample.bin"
+preflight_sample_size = 16 << 20
+
+# Every AWS run leaves a marker under here naming the image it used, as builds/{stream}/{time}/{image tag}, so ECR cleanup can keep the last few per stream (see util/ecrgc.py)
+builds_prefix = "builds"
+
+def client(service: str, **kwargs):
+    # boto3.client, counted (see util/awscalls.py); everything that talks to AWS from this side should make its clients here
+    return util.awscalls.instrument(boto3.client(service, **kwargs))
+
 class Aws:
     @prof
     def __init__(self, region: str, zone: str, aws_access_key_id: str, aws_secret_access_key: str):
@@ -37,7 +61,7 @@ class Aws:
             self.owner = os.getlogin()
         
         # ECR setup!
-        ecr = boto3.client('ecr',
+        ecr = client('ecr',
             region_name = self.region,
             aws_access_key_id = self.aws_access_key_id,
             aws_secret_access_key = self.aws_secret_access_key)
@@ -67,7 +91,7 @@ class Aws:
         self.repo = self.ecsendpoint.removeprefix("https://")
         
         # EC2 setup!
-        ec2 = boto3.client('ec2',
+        ec2 = client('ec2',
             region_name = self.region,
             aws_access_key_id = self.aws_access_key_id,
             aws_secret_access_key = self.aws_secret_access_key)
@@ -76,6 +100,7 @@ class Aws:
         vpcs = ec2.describe_vpcs(Filters = [{'Name':'tag:Name', 'Values':[label]}])["Vpcs"]
         if len(vpcs) == 1:
             vpc = vpcs[0]["VpcId"]
+            self.vpccidr = vpcs[0]["CidrBlock"]
             print(f"VPC: already exists ({vpc})")
         elif len(vpcs) > 1:
             raise Exception("too many vpcs!")
@@ -89,6 +114,7 @@ class Aws:
                     },
                 ],
             )["Vpc"]["VpcId"]
+            self.vpccidr = "10.42.0.0/16"
             
             # it doesn't start up instantly so we need to wait for it to be ready
             while True:
@@ -182,6 +208,8 @@ class Aws:
                 
             print(f"SUBNET: created ({self.subnet})")
         
+        self.vpc = vpc
+        
         # Need my own IP here
         myip = requests.get('https://checkip.amazonaws.com').content.decode('utf8').strip()
         print(f"IP: {myip}")
@@ -232,7 +260,7 @@ class Aws:
             print(f"SECURITY: created ({self.security})")
         
         # S3 setup
-        s3 = boto3.client("s3",
+        s3 = client("s3",
             aws_access_key_id = self.aws_access_key_id,
             aws_secret_access_key = self.aws_secret_access_key)
         
@@ -249,13 +277,38 @@ class Aws:
                 },
             )
         
+        try:
+            s3.head_object(Bucket = "arclight", Key = preflight_sample_key)
+        except s3.exceptions.ClientError:
+            s3.put_object(Bucket = "arclight", Key = preflight_sample_key, Body = os.urandom(preflight_sample_size))
+            print(f"S3: uploaded preflight sample")
+        
         print(f"S3: initialized")
 
+    def full_container_name(self, containername: str) -> str:
+        return f"{self.repo}/{containername}"
+    
+    @prof
+    def has_container(self, containername: str) -> bool:
+        ecr = client('ecr',
+            region_name = self.region,
+            aws_access_key_id = self.aws_access_key_id,
+            aws_secret_access_key = self.aws_secret_access_key)
+        
+        # containername is `repository:tag`
+        repository, tag = containername.split(":", 1)
+        try:
+            ecr.describe_images(repositoryName = repository, imageIds = [{"imageTag": tag}])
+        except ecr.exceptions.ImageNotFoundException:
+            return False
+        
+        return True
+    
     @prof
     def push_container(self, containername: str) -> str:
     
         # assemble a full container name
-        fullcontainername = f"{self.repo}/{containername}"
+        fullcontainername = self.full_container_name(containername)
         
         # tag our generated image with that name
         # (yes, we could have just generated it with this name to begin with, but doing this is fast and it makes the dataflow easier)
@@ -273,9 +326,257 @@ class Aws:
         
         return fullcontainername
     
+    def record_build(self, stream: str, containername: str, buildid: str) -> None:
+        s3 = client("s3",
+            aws_access_key_id = self.aws_access_key_id,
+            aws_secret_access_key = self.aws_secret_access_key)
+        
+        # everything ECR cleanup needs is in the key, so it never has to read these
+        repository, tag = containername.split(":", 1)
+        timestamp = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%S")
+        s3.put_object(
+            Bucket = "arclight",
+            Key = f"{builds_prefix}/{stream}/{timestamp}/{tag}",
+            Body = json.dumps({"build": buildid, "stream": stream, "image": containername}).encode("utf-8"),
+        )
+    
+    @prof
+    def push_bootstrap(self, bundle: util.bootstrap.Bundle) -> str:
+        # Bundles are stored under their own hash, so if it's already there, it's already right
+        s3 = client("s3",
+            aws_access_key_id = self.aws_access_key_id,
+            aws_secret_access_key = self.aws_secret_access_key)
+        
+        prefix = bundle.s3key()
+        try:
+            s3.head_object(Bucket = "arclight", Key = f"{prefix}/{util.bootstrap.manifest_filename}")
+            print(f"S3: bootstrap {bundle.hash[:12]} already uploaded")
+            return prefix
+        except s3.exceptions.ClientError:
+            pass
+        
+        for filename, path in bundle.files.items():
+            s3.upload_file(path, "arclight", f"{prefix}/{filename}")
+        
+        # manifest last, so a half-uploaded bundle never looks complete
+        s3.put_object(Bucket = "arclight", Key = f"{prefix}/{util.bootstrap.manifest_filename}", Body = bundle.manifest_bytes())
+        print(f"S3: uploaded bootstrap {bundle.hash[:12]}")
+        return prefix
+    
+    @prof
+    def ensure_mirror(self) -> str:
+        # Finds or starts the VPC's registry mirror: a small Linux instance running util/mirror.py, with its cache on a volume that outlives it.
+        # Returns its address as seen from inside the VPC.
+        # It's deliberately long-lived (no timeout tag), since a cold mirror is just a slower way of pulling.
+        ec2 = client('ec2',
+            region_name = self.region,
+            aws_access_key_id = self.aws_access_key_id,
+            aws_secret_access_key = self.aws_secret_access_key)
+        
+        name = f"{label}-mirror"
+        reservations = ec2.describe_instances(Filters = [
+                {'Name': 'tag:Name', 'Values': [name]},
+                {'Name': 'instance-state-name', 'Values': ['pending', 'running']},
+            ])["Reservations"]
+        instances = [instance for reservation in reservations for instance in reservation["Instances"]]
+        if len(instances) > 0:
+            print(f"MIRROR: already running ({instances[0]['InstanceId']})")
+            return f"{instances[0]['PrivateIpAddress']}:{util.mirror.default_port}"
+        
+        # Only other instances in the VPC get to talk to it
+        securitys = ec2.describe_security_groups(Filters = [{'Name':'tag:Name', 'Values':[name]}])["SecurityGroups"]
+        if len(securitys) > 0:
+            security = securitys[0]["GroupId"]
+        else:
+            security = ec2.create_security_group(
+                Description = "Arclight registry mirror, reachable from inside the VPC",
+                GroupName = name,
+                VpcId = self.vpc,
+                TagSpecifications = [
+                    {
+                        "ResourceType": "security-group",
+                        "Tags": self.generate_tags(name = name, owner = "arclight-core"),
+                    },
+                ],
+            )["GroupId"]
+            ec2.authorize_security_group_ingress(
+                GroupId = security,
+                IpPermissions = [{
+                    'FromPort': util.mirror.default_port,
+                    'ToPort': util.mirror.default_port,
+                    'IpProtocol': 'tcp',
+                    'IpRanges': [{
+                        "CidrIp": self.vpccidr,
+                    }],
+                }],
+            )
+            print(f"MIRROR: created security group ({security})")
+        
+        # The cache volume survives the instance, so a replacement mirror starts warm
+        storagename = f"{label}-mirror-storage"
+        volumes = ec2.describe_volumes(Filters = [
+                {'Name': 'tag:Name', 'Values': [storagename]},
+                {'Name': 'availability-zone', 'Values': [self.zone]},
+            ])["Volumes"]
+        if len(volumes) > 0:
+            storage = volumes[0]["VolumeId"]
+            print(f"MIRROR: reusing storage volume ({storage})")
+        else:
+            storage = ec2.create_volume(
+                AvailabilityZone = self.zone,
+                VolumeType = "gp3",
+                Size = mirror_storage_gb,
+                TagSpecifications = [
+                    {
+                        "ResourceType": "volume",
+                        "Tags": self.generate_tags(name = storagename, owner = "arclight-core"),
+                    },
+                ],
+            )["VolumeId"]
+            print(f"MIRROR: created storage volume ({storage})")
+        
+        # The instance fetches the mirror code from S3 through presigned links, so it never needs S3 permissions of its own
+        s3 = client("s3",
+            aws_access_key_id = self.aws_access_key_id,
+            aws_secret_access_key = self.aws_secret_access_key)
+        links = {}
+        for path in ["mirror.py", "util/mirror.py"]:
+            s3.upload_file(path, "arclight", f"mirror/{path}")
+            links[path] = s3.generate_presigned_url("get_object", Params = {"Bucket": "arclight", "Key": f"mirror/{path}"}, ExpiresIn = 24 * 60 * 60)
+        
+        # ECR credentials are the only ones it needs, and those come from its instance profile
+        profile = self.ensure_mirror_profile()
+        userdata = f"""#!/bin/bash
+set -ex
+yum install -y python3
+pip3 install boto3
+while [ ! -e /dev/sdf ]; do sleep 1; done
+blkid /dev/sdf || mkfs -t xfs /dev/sdf
+mkdir -p /mirror
+echo "/dev/sdf /mirror xfs defaults,nofail 0 2" >> /etc/fstab
+mount /mirror
+mkdir -p /opt/arclight/util
+curl -sf -o /opt/arclight/mirror.py "{links['mirror.py']}"
+curl -sf -o /opt/arclight/util/mirror.py "{links['util/mirror.py']}"
+cat > /etc/systemd/system/arclight-mirror.service <<EOF
+[Unit]
+Description=Arclight registry mirror
+After=network-online.target
+[Service]
+WorkingDirectory=/opt/arclight
+ExecStart=/usr/bin/python3 -u mirror.py serve --storage /mirror --max_gb {mirror_storage_gb * 0.9:0.0f} --ecr_region {self.region}
+Restart=always
+[Install]
+WantedBy=multi-user.target
+EOF
+systemctl daemon-reload
+systemctl enable --now arclight-mirror
+"""
+        
+        ssm = client('ssm',
+            region_name = self.region,
+            aws_access_key_id = self.aws_access_key_id,
+            aws_secret_access_key = self.aws_secret_access_key)
+        
+        ami = ssm.get_parameter(Name = mirror_ami_parameter)["Parameter"]["Value"]
+        
+        # A freshly made instance profile takes a few seconds to be usable, and until then EC2 claims it doesn't exist
+        while True:
+            try:
+                instance = ec2.run_instances(
+                    ImageId = ami,
+                    InstanceType = mirror_instance_type,
+                    UserData = userdata,
+                    IamInstanceProfile = {"Name": profile},
+                    
+                    # it needs to reach the upstream registries
+                    NetworkInterfaces = [{
+                        "DeviceIndex": 0,
+                        "AssociatePublicIpAddress": True,
+                        "SubnetId": self.subnet,
+                        "Groups": [security],
+                    }],
+                    
+                    MinCount = 1,
+                    MaxCount = 1,
+                    
+                    TagSpecifications = [
+                        {
+                            "ResourceType": "instance",
+                            "Tags": self.generate_tags(name = name, owner = "arclight-core"),
+                        },
+                    ],
+                )["Instances"][0]
+                break
+            except ec2.exceptions.ClientError as ex:
+                if ex.response["Error"]["Code"] != "InvalidParameterValue" or "iamInstanceProfile" not in ex.response["Error"]["Message"]:
+                    raise
+                print("MIRROR: waiting for the instance profile to propagate")
+                time.sleep(5)
+        print(f"MIRROR: starting instance ({instance['InstanceId']})")
+        
+        ec2.get_waiter('instance_running').wait(InstanceIds = [instance['InstanceId']])
+        
+        # a previous mirror might still be letting go of the volume
+        while True:
+            state = ec2.describe_volumes(VolumeIds = [storage])["Volumes"][0]["State"]
+            if state == "available":
+                break
+            print(f"MIRROR: waiting for storage volume ({state})")
+            time.sleep(5)
+        
+        ec2.attach_volume(
+            InstanceId = instance['InstanceId'],
+            VolumeId = storage,
+            Device = "/dev/sdf",
+        )
+        print(f"MIRROR: started at {instance['PrivateIpAddress']}")
+        
+        # Builds that get there before it's finished booting just pull directly
+        return f"{instance['PrivateIpAddress']}:{util.mirror.default_port}"
+    
     @prof
-    def run_instance_prepped(self, ami: str, instanceType: str, blockDeviceMappings: Dict, workingVolume: Dict = None) -> 'AwsInstance':
-        ec2 = boto3.client('ec2',
+    def ensure_mirror_profile(self) -> str:
+        # Finds or makes the instance profile the mirror runs under, so it can read ECR without us handing it our keys
+        # Returns its name.
+        iam = client('iam',
+            aws_access_key_id = self.aws_access_key_id,
+            aws_secret_access_key = self.aws_secret_access_key)
+        
+        name = f"{label}-mirror"
+        try:
+            iam.get_instance_profile(InstanceProfileName = name)
+            return name
+        except iam.exceptions.NoSuchEntityException:
+            pass
+        
+        try:
+            iam.create_role(
+                RoleName = name,
+                Description = "Arclight registry mirror, reading from ECR",
+                AssumeRolePolicyDocument = json.dumps({
+                    "Version": "2012-10-17",
+                    "Statement": [{
+                        "Effect": "Allow",
+                        "Principal": {"Service": "ec2.amazonaws.com"},
+                        "Action": "sts:AssumeRole",
+                    }],
+                }),
+                Tags = self.generate_tags(name = name, owner = "arclight-core"),
+            )
+            print(f"MIRROR: created role {name}")
+        except iam.exceptions.EntityAlreadyExistsException:
+            pass
+        iam.attach_role_policy(RoleName = name, PolicyArn = mirror_policy)
+        
+        iam.create_instance_profile(InstanceProfileName = name)
+        iam.add_role_to_instance_profile(InstanceProfileName = name, RoleName = name)
+        print(f"MIRROR: created instance profile {name}")
+        return name
+    
+    @prof
+    def run_instance_prepped(self, ami: str, instanceType: str, blockDeviceMappings: Dict, workingVolume: Dict = None, purpose: str = "build") -> 'AwsInstance':
+        ec2 = client('ec2',
             region_name = self.region,
             aws_access_key_id = self.aws_access_key_id,
             aws_secret_access_key = self.aws_secret_access_key)
@@ -306,7 +607,9 @@ class Aws:
                 },
             ],
         )["Instances"][0]["InstanceId"]
+        launched = time.time()  # billing starts about now, and runs until we terminate it
         print(f"INSTANCE: Initializing instance ({instance})")
+        annotate(instance = instance, instance_type = instanceType, ami = ami)
         
         # Now that it's running, we really want to kill that server if something goes wrong.
         try:
@@ -401,6 +704,10 @@ class Aws:
             handle.instanceip = instanceip
             handle.scpcall = scpcall
             handle.ec2 = ec2
+            handle.instancetype = instanceType
+            handle.blockDeviceMappings = blockDeviceMappings
+            handle.launched = launched
+            handle.purpose = purpose
             
             # Extend the primary drive
             # This is subject to the same weird console quality problems that subprocess.run is (see the comment down in AwsInstance.ssh)
@@ -443,6 +750,7 @@ class Aws:
         except:
             ec2.terminate_instances(InstanceIds = [instance])
             print(f"INSTANCE: Terminated {instance} due to failure on startup!")
+            util.cost.ledger.instance(purpose, instance, instanceType, time.time() - launched, blockDeviceMappings)
             raise
         
         return handle
@@ -460,7 +768,7 @@ class Aws:
         return tags
     
     def update_timeout(self, resources: List[str], timeout: datetime.timedelta) -> None:
-        ec2 = boto3.client('ec2',
+        ec2 = client('ec2',
             region_name = self.region,
             aws_access_key_id = self.aws_access_key_id,
             aws_secret_access_key = self.aws_secret_access_key)
@@ -491,6 +799,12 @@ class AwsInstance:
     scpcall = None
     ec2 = None
     
+    # for the cost ledger
+    instancetype = None
+    blockDeviceMappings = None
+    launched = None
+    purpose = None
+    
     connection = None
     
     def __enter__(self):
@@ -506,7 +820,10 @@ class AwsInstance:
         self.ec2.terminate_instances(InstanceIds = [self.instanceid])
         print(f"INSTANCE: Terminated {self.instanceid} during cleanup!")
         
-    def ssh(self, command: List[str]) -> str:
+        # (if it was stopped for a snapshot, the compute stopped costing a little earlier than this)
+        util.cost.ledger.instance(self.purpose, self.instanceid, self.instancetype, time.time() - self.launched, self.blockDeviceMappings)
+        
+    def ssh(self, command: List[str], out_stream = None) -> str:
         # I really shouldn't be using something this heavyweight here
         # Unfortunately, something *really weird* is going on with executing `ssh` via subprocess
         # Almost no matter what I do, it completely breaks the terminal
@@ -524,7 +841,40 @@ class AwsInstance:
             self.connection.open() # needed so we can do the keepalive thing ;.;
             self.connection.transport.set_keepalive(60) # sometimes the SSH connection dies and this helps that not happen
         
-        return self.connection.run(' '.join(cli_quote(c) for c in command)).stdout
+        # out_stream is where the output goes as it arrives (our stdout if None); the return value has all of it regardless
+        return self.connection.run(' '.join(cli_quote(c) for c in command), out_stream = out_stream).stdout
+    
+    def use_mirror(self, mirror: str) -> None:
+        # Docker only talks plain HTTP to registries it's been told to trust, so add the mirror to the daemon config and restart it
+        # (if it's already trusted, we leave docker alone)
+        self.powershell(f"""
+            $path = "C:\\ProgramData\\docker\\config\\daemon.json"
+            $config = [pscustomobject]@{{}}
+            if (Test-Path $path) {{ $config = Get-Content $path -Raw | ConvertFrom-Json }}
+            if (@($config."insecure-registries") -contains "{mirror}") {{ exit 0 }}
+            $config | Add-Member -Force -NotePropertyName "insecure-registries" -NotePropertyValue @("{mirror}")
+            New-Item -ItemType Directory -Force -Path (Split-Path $path) | Out-Null
+            $config | ConvertTo-Json -Depth 10 | Set-Content -Encoding ascii $path
+            Restart-Service docker
+        """)
+    
+    def forget_mirror(self) -> None:
+        # Undoes use_mirror's config change, for instances that are about to become an AMI; the mirror's address can change, and we don't want it baked in
+        # No restart, since the instance is about to be stopped anyway
+        self.powershell("""
+            $path = "C:\\ProgramData\\docker\\config\\daemon.json"
+            if (-not (Test-Path $path)) { exit 0 }
+            $config = Get-Content $path -Raw | ConvertFrom-Json
+            $config.PSObject.Properties.Remove("insecure-registries")
+            $config | ConvertTo-Json -Depth 10 | Set-Content -Encoding ascii $path
+        """)
+    
+    def powershell(self, script: str) -> str:
+        # PowerShell's quoting is much easier to survive when the script is base64'd
+        return self.ssh([
+            'powershell', '-NoProfile', '-EncodedCommand',
+            base64.b64encode(script.encode("utf-16-le")).decode("ascii"),
+        ])
     
     def scpFrom(self, src: str, dst: str) -> None:
         params = self.scpcall.copy()
@@ -537,14 +887,22 @@ class AwsVolume:
     volumeid = None
     preserve = False
     
+    # for the cost ledger; we're charged for the time we hold it, and if we keep it, cleanup.py reports what it costs while it waits to be reused
+    acquired = None
+    volumeInfo = None
+    
     def __init__(self, ec2, volumeid: str):
         self.ec2 = ec2
         self.volumeid = volumeid
       
     def __enter__(self):
+        self.acquired = time.time()
+        self.volumeInfo = self.ec2.describe_volumes(VolumeIds = [self.volumeid])["Volumes"][0]
         return self
   
     def __exit__(self, exception_type, exception_value, exception_traceback):
+        util.cost.ledger.volume("build", self.volumeid, self.volumeInfo["Size"], self.volumeInfo.get("Iops"), self.volumeInfo.get("Throughput"), time.time() - self.acquired)
+        
         if not self.preserve:
             # Wipe the volume
             # This is tricky because it might still be attached to a shutting-down instance
@@ -0,0 +1,123 @@
+import atexit
+import threading
+import time
+
+from typing import Dict
+from typing import List
+
+import util.prof
+
+# AWS API call accounting.
+# util.aws.client() hooks every client it makes into botocore's events, and we count each call against the innermost prof span it was made from.
+# For each call we count retries, throttled responses, errors that got all the way back to us, and latency (including any backoff between retries).
+# The calls also add up on the spans themselves, so they show in the prof dump and the trace.
+# At exit we print a table; arclight also adds it to the run's metrics file.
+
+# What the various services say when they want us to slow down
+throttle_codes = {
+    "Throttling",
+    "ThrottlingException",
+    "ThrottledException",
+    "RequestThrottled",
+    "RequestThrottledException",
+    "RequestLimitExceeded",
+    "TooManyRequestsException",
+    "SlowDown",
+    "ProvisionedThroughputExceededException",
+}
+
+# (span, operation) -> counters
+stats = {}
+lock = threading.Lock()
+
+def span_path() -> str:
+    # where we are, named the same way history.py names phases
+    return "/".join(block.label for block in util.prof.stack()[1:]) or "root"
+
+def entry(span: str, operation: str) -> Dict:
+    return stats.setdefault((span, operation), {"calls": 0, "retries": 0, "throttles": 0, "errors": 0, "seconds": 0, "max_seconds": 0})
+
+def before_call(model, context, **kwargs) -> None:
+    block = util.prof.current()
+    context["arclight_call"] = {
+        "span": span_path(),
+        "operation": f"{model.service_model.service_name}.{model.name}",
+        "start": time.perf_counter(),
+    }
+    with lock:
+        block.attributes["aws_calls"] = block.attributes.get("aws_calls", 0) + 1
+
+def needs_retry(response, request_dict, **kwargs) -> None:
+    # Called once per attempt, before botocore decides whether to retry, so this sees throttles even when a retry then succeeds
+    # (we only ever look; returning None leaves the decision to botocore)
+    call = request_dict.get("context", {}).get("arclight_call")
+    if call is None or response is None:
+        return None
+
+    code = response[1].get("Error", {}).get("Code")
+    if code in throttle_codes:
+        with lock:
+            entry(call["span"], call["operation"])["throttles"] += 1
+    return None
+
+def finish(call: Dict, retries: int, error: bool) -> None:
+    seconds = time.perf_counter() - call["start"]
+    with lock:
+        counters = entry(call["span"], call["operation"])
+        counters["calls"] += 1
+        counters["retries"] += retries
+        counters["errors"] += 1 if error else 0
+        counters["seconds"] += seconds
+        counters["max_seconds"] = max(counters["max_seconds"], seconds)
+
+def after_call(parsed, context, **kwargs) -> None:
+    if "arclight_call" in context:
+        finish(context["arclight_call"], parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0), False)
+
+def after_call_error(exception, context, **kwargs) -> None:
+    if "arclight_call" in context:
+        response = getattr(exception, "response", None) or {}
+        finish(context["arclight_call"], response.get("ResponseMetadata", {}).get("RetryAttempts", 0), True)
+
+def instrument(client):
+    client.meta.events.register("before-call", before_call)
+    client.meta.events.register("needs-retry", needs_retry)
+    client.meta.events.register("after-call", after_call)
+    client.meta.events.register("after-call-error", after_call_error)
+    return client
+
+def summary() -> List[Dict]:
+    # one row per (span, operation), busiest first
+    with lock:
+        rows = [dict(counters, span = span, operation = operation) for (span, operation), counters in stats.items()]
+    return sorted(rows, key = lambda row: -row["calls"])
+
+def by_operation(rows: List[Dict]) -> List[Dict]:
+    totals = {}
+    for row in rows:
+        total = totals.setdefault(row["operation"], {"operation": row["operation"], "calls": 0, "retries": 0, "throttles": 0, "errors": 0, "seconds": 0, "max_seconds": 0})
+        for key in ["calls", "retries", "throttles", "errors", "seconds"]:
+            total[key] += row[key]
+        total["max_seconds"] = max(total["max_seconds"], row["max_seconds"])
+    return sorted(totals.values(), key = lambda row: -row["calls"])
+
+def table(rows: List[Dict], name: str) -> List[str]:
+    width = max([len(name)] + [len(row[name]) for row in rows])
+    lines = [f"{name:<{width}}  calls  retries  throttles  errors  avg ms  max ms"]
+    for row in rows:
+        lines.append(f"{row[name]:<{width}}  {row['calls']:5}  {row['retries']:7}  {row['throttles']:9}  {row['errors']:6}  {row['seconds'] / max(row['calls'], 1) * 1000:6.0f}  {row['max_seconds'] * 1000:6.0f}")
+    return lines
+
+@atexit.register
+def printall() -> None:
+    rows = summary()
+    if len(rows) == 0:
+        return
+
+    print()
+    print("========= AWS API calls")
+    for line in table(by_operation(rows), "operation"):
+        print(line)
+    print()
+    for line in table([dict(row, where = f"{row['span']}: {row['operation']}") for row in rows], "where"):
+        print(line)
@@ -0,0 +1,75 @@
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+
+# bootstrap.py and its helpers change far more often than anything else in the image, so they aren't baked into it.
+# Instead the image's entrypoint (environment/entrypoint.py) is handed a bundle when the container starts:
+#   * locally, we `docker cp` the bundle into the container before starting it;
+#   * on AWS, we upload it to S3 under its own hash and the entrypoint downloads it.
+# Either way the entrypoint checks every file against the bundle's manifest, and the manifest against the hash we give it.
+
+# Files from the image's environment directory that make up the bundle
+# (image/project_build/build.py reads this too, to leave them out of the image's fingerprint)
+runtime_files = ["bootstrap.py", "output_packaging.py", "resource_sampler.py", "staging.py"]
+
+# Files from arclight itself that bootstrap shares with the orchestrator
+shared_files = ["util/delta.py", "util/prof.py"]
+
+# Where the bundle ends up inside the container; entrypoint.py has its own copy of this
+containerdir = "c:\\arclight_bootstrap"
+
+manifest_filename = "manifest.json"
+
+s3prefix = "bootstrap"
+
+# What bootstrap writes next to the output besides the output itself
+report_extensions = [".metrics.json", ".bootstrap.trace.json", ".resources.bin"]
+
+# None of these affect the image anymore, so they shouldn't change its fingerprint
+fingerprint_exclude = [f"environment/{filename}" for filename in runtime_files]
+
+class Bundle:
+    files = None        # filename -> local path
+    manifest = None     # filename -> sha256
+    hash = None
+
+    def __init__(self, imagebuilddir: pathlib.Path, arclightdir: pathlib.Path):
+        self.files = {}
+        for filename in runtime_files:
+            self.files[filename] = str(imagebuilddir.joinpath("environment", filename))
+        for filename in shared_files:
+            self.files[os.path.basename(filename)] = str(arclightdir.joinpath(filename))
+
+        self.manifest = {}
+        for filename, path in self.files.items():
+            with open(path, "rb") as f:
+                self.manifest[filename] = hashlib.sha256(f.read()).hexdigest()
+
+        self.hash = hashlib.sha256(self.manifest_bytes()).hexdigest()
+
+    def manifest_bytes(self) -> bytes:
+        # this exact serialization is what gets hashed, so it's what we ship, too
+        return json.dumps(self.manifest, sort_keys = True).encode("utf-8")
+
+    def stage(self, cachedir: str) -> str:
+        # Lays the bundle out in a directory, ready to be copied into a container
+        stagedir = os.path.join(cachedir, self.hash)
+        if os.path.isfile(os.path.join(stagedir, manifest_filename)):
+            return stagedir
+
+        if os.path.isdir(stagedir):
+            shutil.rmtree(stagedir)
+        os.makedirs(stagedir)
+        for filename, path in self.files.items():
+            shutil.copyfile(path, os.path.join(stagedir, filename))
+
+        # manifest last, so a half-staged bundle never looks complete
+        with open(os.path.join(stagedir, manifest_filename), "wb") as f:
+            f.write(self.manifest_bytes())
+
+        return stagedir
+
+    def s3key(self) -> str:
+        return f"{s3prefix}/{self.hash}"
@@ -0,0 +1,527 @@
+import concurrent.futures
+import datetime
+import dateutil.parser
+import heapq
+import itertools
+import threading
+import time
+
+import botocore.config
+
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+
+import util.aws
+import util.awscalls
+import util.p4view
+
+from util.simple_utc import simple_utc
+
+# Cleanup of everything arclight leaves lying around in EC2.
+# It goes in three steps:
+#   inventory() lists every arclight-* resource of every kind we make, following every page, with the kinds listed concurrently
+#   plan() decides what goes, and works out what each deletion has to wait for (an instance has to be gone before its volume can go, an AMI before its snapshot, everything in a VPC before the VPC)
+#   execute() deletes it all, as many at once as the dependencies allow; with `dry_run` it just says what it would do, in the order it'd do it
+# cleanup.py is the command-line front end.
+# daemon() does the same thing continuously, deleting each thing when its arclight-timeout comes up rather than whenever someone next runs a sweep.
+#
+# AWS throttles us if we go too fast, so clients should be made with `retry_config`, which makes botocore back off and slow itself down when it happens.
+# On top of that we retry the errors that just mean AWS hasn't caught up yet (a volume still "in use" a moment after its instance went away), and treat "not found" as already done.
+
+# Anything with arclight-version at or below this is from before we tagged timeouts, and always goes
+cleanup_version = 1
+current_version = 2
+
+# botocore's adaptive mode backs off on throttles and rate-limits the client afterwards, which is what we want with a lot of threads hitting the same API
+retry_config = botocore.config.Config(retries = {"mode": "adaptive", "max_attempts": 10})
+
+default_workers = 16
+
+# How long we keep retrying a deletion that something we just deleted was blocking
+settle_seconds = 120
+
+settle_codes = {
+    "DependencyViolation",
+    "VolumeInUse",
+    "InvalidSnapshot.InUse",
+    "IncorrectState",
+    "IncorrectInstanceState",
+    "InvalidState",
+}
+
+name_filter = [{'Name': 'tag:Name', 'Values': ['arclight-*']}]
+
+def is_expired(taglist: List) -> bool:
+    version = util.aws.get_tag(taglist, "arclight-version")
+    if version is None:
+        return True
+
+    if int(version) <= cleanup_version:
+        return True
+
+    timestamp = timeout(taglist)
+    if timestamp is None:
+        return False    # never expires
+
+    return timestamp < datetime.datetime.now().replace(tzinfo=simple_utc())
+
+def timeout(taglist: List) -> Optional[datetime.datetime]:
+    timestamp = util.aws.get_tag(taglist, "arclight-timeout")
+    if timestamp is None:
+        return None
+    return dateutil.parser.parse(timestamp)
+
+# What we make, how to list it, and how to get rid of it
+# "args" go to the describe call along with the tag filter; images and snapshots need an owner, or we'd be paging through every public one in the region
+# "filter" is the describe filter that picks them out by id
+kinds = {
+    "instance": {
+        "describe": "describe_instances",
+        "extract": lambda page: itertools.chain.from_iterable([reservation["Instances"] for reservation in page["Reservations"]]),
+        "id": "InstanceId",
+        "filter": "instance-id",
+    },
+    "image": {"describe": "describe_images", "result": "Images", "id": "ImageId", "filter": "image-id", "args": {"Owners": ["self"]}},
+    "snapshot": {"describe": "describe_snapshots", "result": "Snapshots", "id": "SnapshotId", "filter": "snapshot-id", "args": {"OwnerIds": ["self"]}},
+    "volume": {"describe": "describe_volumes", "result": "Volumes", "id": "VolumeId", "filter": "volume-id"},
+    "subnet": {"describe": "describe_subnets", "result": "Subnets", "id": "SubnetId", "filter": "subnet-id"},
+    "security_group": {"describe": "describe_security_groups", "result": "SecurityGroups", "id": "GroupId", "filter": "group-id"},
+    "route_table": {"describe": "describe_route_tables", "result": "RouteTables", "id": "RouteTableId", "filter": "route-table-id"},
+    "internet_gateway": {"describe": "describe_internet_gateways", "result": "InternetGateways", "id": "InternetGatewayId", "filter": "internet-gateway-id"},
+    "vpc": {"describe": "describe_vpcs", "result": "Vpcs", "id": "VpcId", "filter": "vpc-id"},
+}
+
+def paginate(ec2, kind: str, filters: List[Dict] = None) -> List[Dict]:
+    # Every page of it; a single describe call stops at whatever AWS feels like returning
+    info = kinds[kind]
+    extract = info.get("extract") or (lambda page: page[info["result"]])
+    args = dict(info.get("args", {}), Filters = filters if filters is not None else name_filter)
+
+    if not ec2.can_paginate(info["describe"]):
+        return list(extract(getattr(ec2, info["describe"])(**args)))
+
+    items = []
+    for page in ec2.get_paginator(info["describe"]).paginate(**args):
+        items += extract(page)
+    return items
+
+def listing(ec2, kind: str, filters: List[Dict] = None) -> List[Dict]:
+    # paginate(), minus the things that are already on their way out
+    items = paginate(ec2, kind, filters)
+    if kind == "instance":
+        # terminated instances hang around in the listings for a while, but there's nothing left to do with them
+        items = [instance for instance in items if instance["State"]["Name"] not in ["terminated", "shutting-down"]]
+    return items
+
+class Resource:
+    kind = None
+    id = None
+    item = None     # what describe gave us
+
+    state = None    # planned, blocked, deleted, failed, skipped
+    reason = None
+    after = None    # keys of the resources that have to be gone before this one can go
+    before = None   # and the other way around
+    error = None
+
+    def __init__(self, kind: str, item: Dict, reason: str):
+        self.kind = kind
+        self.id = item[kinds[kind]["id"]]
+        self.item = item
+        self.reason = reason
+        self.state = "planned"
+        self.after = set()
+        self.before = set()
+
+    @property
+    def key(self) -> str:
+        return f"{self.kind}:{self.id}"
+
+    @property
+    def name(self) -> str:
+        return describe_name(self.kind, self.item)
+
+def describe_name(kind: str, item: Dict) -> str:
+    name = util.aws.get_tag(item.get("Tags", []), "Name")
+    itemid = item[kinds[kind]["id"]]
+    return itemid if name is None else f"{name} {itemid}"
+
+def inventory(ec2, workers: int = default_workers) -> Dict[str, List[Dict]]:
+    # kind -> everything of that kind that's ours; the kinds don't depend on each other, so they're all listed at once
+    with concurrent.futures.ThreadPoolExecutor(max_workers = workers) as pool:
+        futures = {kind: pool.submit(listing, ec2, kind) for kind in kinds.keys()}
+        return {kind: future.result() for kind, future in futures.items()}
+
+def snapshot_sig(snapshot) -> Optional[str]:
+    # Snapshots from before view tagging were all synced with the full stream view
+    stream = util.aws.get_tag(snapshot["Tags"], "arclight-sig-stream")
+    if stream is None:
+        return None
+
+    view = util.aws.get_tag(snapshot["Tags"], "arclight-sig-view") or util.p4view.full
+    return f"{stream}-{view}"
+
+def obsolete_snapshots(snapshots: List[Dict]) -> Dict[str, str]:
+    # Along with just killing straight-up expired snapshots, we want to wipe all snapshots that are older than the newest complete snapshot in each (version, stream, view)
+    # Returns snapshot id -> why
+    result = {}
+    for v in range(cleanup_version + 1, current_version + 1):
+        groups = {}
+        for snapshot in snapshots:
+            if util.aws.get_tag(snapshot["Tags"], "arclight-version") != str(v):
+                continue
+            stream = snapshot_sig(snapshot)
+            if stream is not None:
+                groups.setdefault(stream, []).append(snapshot)
+
+        for stream, group in groups.items():
+            bestcl = 0
+            bestsnapshotid = None
+            for snapshot in group:
+                thiscl = int(util.aws.get_tag(snapshot["Tags"], "arclight-sig-cl"))
+                if snapshot["State"] == "completed" and thiscl > bestcl:
+                    bestcl = thiscl
+                    bestsnapshotid = snapshot["SnapshotId"]
+
+            for snapshot in group:
+                sid = snapshot["SnapshotId"]
+                thiscl = int(util.aws.get_tag(snapshot["Tags"], "arclight-sig-cl"))
+                if sid == bestsnapshotid or thiscl > bestcl:
+                    continue
+
+                if thiscl == bestcl:
+                    result[sid] = f"v{v}-{stream} @{thiscl} == @{bestcl} but not chosen"
+                else:
+                    result[sid] = f"v{v}-{stream} @{thiscl} <= @{bestcl}"
+    return result
+
+def dependencies(kind: str, item: Dict, found: Dict[str, List[Dict]]) -> List[str]:
+    # Keys of everything in `found` that has to be gone before this can be deleted
+    def ids(otherkind: str, test: Callable[[Dict], bool]) -> List[str]:
+        return [f"{otherkind}:{other[kinds[otherkind]['id']]}" for other in found[otherkind] if test(other)]
+
+    if kind == "volume":
+        attached = [attachment["InstanceId"] for attachment in item.get("Attachments", [])]
+        return ids("instance", lambda instance: instance["InstanceId"] in attached)
+
+    if kind == "snapshot":
+        return ids("image", lambda image: any(mapping.get("Ebs", {}).get("SnapshotId") == item["SnapshotId"] for mapping in image.get("BlockDeviceMappings", [])))
+
+    if kind == "security_group":
+        return ids("instance", lambda instance: any(group["GroupId"] == item["GroupId"] for group in instance.get("SecurityGroups", [])))
+
+    if kind == "subnet":
+        return ids("instance", lambda instance: instance.get("SubnetId") == item["SubnetId"])
+
+    if kind == "internet_gateway":
+        # instances with public addresses keep the gateway attached, and routes through it should go first
+        vpcs = [attachment["VpcId"] for attachment in item.get("Attachments", [])]
+        return (ids("instance", lambda instance: instance.get("VpcId") in vpcs)
+            + ids("route_table", lambda table: table["VpcId"] in vpcs))
+
+    if kind == "vpc":
+        return (ids("instance", lambda instance: instance.get("VpcId") == item["VpcId"])
+            + ids("subnet", lambda subnet: subnet["VpcId"] == item["VpcId"])
+            + ids("security_group", lambda group: group.get("VpcId") == item["VpcId"])
+            + ids("route_table", lambda table: table["VpcId"] == item["VpcId"])
+            + ids("internet_gateway", lambda gateway: any(attachment["VpcId"] == item["VpcId"] for attachment in gateway.get("Attachments", []))))
+
+    return []
+
+def plan(found: Dict[str, List[Dict]], only: Optional[set] = None) -> List[Resource]:
+    # Everything in `found`, as Resources; the "planned" ones are what we'll delete
+    # With `only`, nothing outside it gets planned, though the rest still counts for what depends on what
+    obsolete = obsolete_snapshots(found["snapshot"])
+
+    resources = {}
+    for kind, items in found.items():
+        for item in items:
+            tags = item.get("Tags", [])
+            if util.aws.get_tag(tags, "Name") == "arclight-base":
+                resource = Resource(kind, item, "base image")
+                resource.state = "skipped"
+            elif kind == "route_table" and any(association.get("Main") for association in item.get("Associations", [])):
+                # the VPC's own route table goes with the VPC
+                resource = Resource(kind, item, "main route table")
+                resource.state = "skipped"
+            elif is_expired(tags):
+                resource = Resource(kind, item, "expired")
+            elif kind == "snapshot" and item["SnapshotId"] in obsolete:
+                resource = Resource(kind, item, obsolete[item["SnapshotId"]])
+            else:
+                resource = Resource(kind, item, "not expired")
+                resource.state = "skipped"
+
+            if only is not None and resource.state == "planned" and resource.key not in only:
+                resource.reason = "not due yet"
+                resource.state = "skipped"
+            resources[resource.key] = resource
+
+    for resource in resources.values():
+        for key in dependencies(resource.kind, resource.item, found):
+            resource.after.add(key)
+            resources[key].before.add(resource.key)
+
+    # Anything that has to wait for something we're keeping can't go either, and neither can whatever was waiting on *that*
+    changed = True
+    while changed:
+        changed = False
+        for resource in resources.values():
+            if resource.state != "planned":
+                continue
+            keeping = [key for key in resource.after if resources[key].state in ["skipped", "blocked"]]
+            if len(keeping) > 0:
+                resource.state = "blocked"
+                resource.reason = f"still needed by {', '.join(resources[key].name for key in keeping)}"
+                changed = True
+
+    return list(resources.values())
+
+def waves(resources: List[Resource]) -> List[List[Resource]]:
+    # The planned deletions, in rounds: everything in a round can go at once, once the rounds before it are done
+    planned = {resource.key: resource for resource in resources if resource.state == "planned"}
+    done = set()
+    result = []
+    while len(done) < len(planned):
+        wave = [resource for key, resource in planned.items() if key not in done and resource.after <= done]
+        if len(wave) == 0:
+            raise Exception(f"dependency cycle among {sorted(set(planned.keys()) - done)}")
+        result.append(wave)
+        done.update(resource.key for resource in wave)
+    return result
+
+def error_code(exception: Exception) -> Optional[str]:
+    response = getattr(exception, "response", None) or {}
+    return response.get("Error", {}).get("Code")
+
+def destroy(ec2, resource: Resource) -> None:
+    # Gets rid of one thing; if anything's waiting on it, doesn't return until it's really gone
+    if resource.kind == "instance":
+        ec2.terminate_instances(InstanceIds = [resource.id])
+        if len(resource.before) > 0:
+            ec2.get_waiter("instance_terminated").wait(InstanceIds = [resource.id], WaiterConfig = {"Delay": 5, "MaxAttempts": 120})
+    elif resource.kind == "image":
+        ec2.deregister_image(ImageId = resource.id)
+    elif resource.kind == "snapshot":
+        ec2.delete_snapshot(SnapshotId = resource.id)
+    elif resource.kind == "volume":
+        ec2.delete_volume(VolumeId = resource.id)
+    elif resource.kind == "subnet":
+        ec2.delete_subnet(SubnetId = resource.id)
+    elif resource.kind == "security_group":
+        ec2.delete_security_group(GroupId = resource.id)
+    elif resource.kind == "route_table":
+        for association in resource.item.get("Associations", []):
+            ec2.disassociate_route_table(AssociationId = association["RouteTableAssociationId"])
+        ec2.delete_route_table(RouteTableId = resource.id)
+    elif resource.kind == "internet_gateway":
+        for attachment in resource.item.get("Attachments", []):
+            ec2.detach_internet_gateway(InternetGatewayId = resource.id, VpcId = attachment["VpcId"])
+        ec2.delete_internet_gateway(InternetGatewayId = resource.id)
+    elif resource.kind == "vpc":
+        ec2.delete_vpc(VpcId = resource.id)
+    else:
+        raise Exception(f"don't know how to delete a {resource.kind}")
+
+def destroy_settled(ec2, resource: Resource) -> None:
+    # destroy(), plus the retries for AWS catching up with what we just did
+    deadline = time.time() + settle_seconds
+    delay = 1
+    while True:
+        try:
+            destroy(ec2, resource)
+            return
+        except Exception as e:
+            code = error_code(e)
+            if code is not None and (code.endswith(".NotFound") or code == "InvalidAMIID.Unavailable"):
+                # someone (or DeleteOnTermination) got there first
+                return
+
+            # only worth waiting if we deleted something it depended on; otherwise whatever's in the way isn't going anywhere
+            retryable = (code in settle_codes and len(resource.after) > 0) or code in util.awscalls.throttle_codes
+            if not retryable or time.time() + delay > deadline:
+                raise
+            time.sleep(delay)
+            delay = min(delay * 2, 10)
+
+def execute(ec2, resources: List[Resource], workers: int = default_workers, dry_run: bool = False, log: Callable[[str], None] = print) -> Dict[str, int]:
+    # Deletes the planned resources, each as soon as everything it depends on is gone; returns how many ended up in each state
+    if dry_run:
+        for index, wave in enumerate(waves(resources)):
+            log(f"  round {index + 1}, all at once:")
+            for resource in wave:
+                log(f"    Would clean up {resource.kind} {resource.name} ({resource.reason})")
+    else:
+        planned = {resource.key: resource for resource in resources if resource.state == "planned"}
+        waves(resources)    # just to catch cycles before we start
+
+        lock = threading.Lock()
+        def work(resource: Resource) -> None:
+            destroy_settled(ec2, resource)
+            with lock:
+                log(f"  Cleaned up {resource.kind} {resource.name} ({resource.reason})")
+
+        finished = set()
+        running = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers = workers) as pool:
+            while len(finished) < len(planned):
+                for key, resource in planned.items():
+                    if key in finished or key in running.values():
+                        continue
+
+                    if any(planned[dependency].state in ["failed", "skipped"] for dependency in resource.after):
+                        resource.state = "skipped"
+                        resource.error = "something it depends on couldn't be cleaned up"
+                        finished.add(key)
+                        log(f"  Not cleaning up {resource.kind} {resource.name}: {resource.error}")
+                    elif all(planned[dependency].state == "deleted" for dependency in resource.after):
+                        running[pool.submit(work, resource)] = key
+
+                if len(running) == 0:
+                    continue
+
+                done, _ = concurrent.futures.wait(running.keys(), return_when = concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    resource = planned[running.pop(future)]
+                    try:
+                        future.result()
+                        resource.state = "deleted"
+                    except Exception as e:
+                        resource.state = "failed"
+                        resource.error = str(e)
+                        with lock:
+                            log(f"  Failed to clean up {resource.kind} {resource.name}: {e}")
+                    finished.add(resource.key)
+
+    counts = {}
+    for resource in resources:
+        counts[resource.state] = counts.get(resource.state, 0) + 1
+    return counts
+
+def survivors(found: Dict[str, List[Dict]], resources: List[Resource]) -> Dict[str, List[Dict]]:
+    # `found`, minus what execute() got rid of
+    deleted = {resource.key for resource in resources if resource.state == "deleted"}
+    return {kind: [item for item in items if f"{kind}:{item[kinds[kind]['id']]}" not in deleted] for kind, items in found.items()}
+
+# How often the daemon re-lists one kind of resource; it goes round them in turn, so each kind gets looked at every len(kinds) of these
+default_refresh_seconds = 60
+
+# If something that's due couldn't go (something else still needs it, or AWS said no), try again this much later
+retry_seconds = 5 * 60
+
+class ExpiryQueue:
+    # Everything we know about, and when each of it is due to go, soonest first
+    # Times are epoch seconds; 0 means it's already overdue (old versions, obsolete snapshots)
+
+    def __init__(self):
+        self.known = {kind: {} for kind in kinds.keys()}    # kind -> id -> item
+        self.expiry = {}    # key -> when its tags say it should go
+        self.when = {}      # key -> when we'll actually look at it next, which can be later if it couldn't go the first time
+        self.heap = []      # (when, key); entries that don't match self.when are stale and get skipped
+
+    def expires(self, kind: str, item: Dict, obsolete: Dict[str, str]) -> Optional[float]:
+        tags = item.get("Tags", [])
+        if is_expired(tags) or (kind == "snapshot" and item["SnapshotId"] in obsolete):
+            return 0
+        stamp = timeout(tags)
+        return None if stamp is None else stamp.timestamp()
+
+    def schedule(self, key: str, when: float) -> None:
+        self.when[key] = when
+        heapq.heappush(self.heap, (when, key))
+
+    def forget(self, key: str) -> None:
+        kind, _, itemid = key.partition(":")
+        self.known[kind].pop(itemid, None)
+        self.expiry.pop(key, None)
+        self.when.pop(key, None)
+
+    def update(self, kind: str, items: List[Dict], ids: Optional[List[str]] = None) -> None:
+        # What a fresh listing of `kind` says; with `ids`, the listing only covered those
+        previous = set(self.known[kind].keys()) if ids is None else set(ids)
+        current = {item[kinds[kind]["id"]]: item for item in items}
+        for itemid in previous - set(current.keys()):
+            self.forget(f"{kind}:{itemid}")
+        self.known[kind].update(current)
+
+        obsolete = obsolete_snapshots(list(self.known["snapshot"].values())) if kind == "snapshot" else {}
+        for itemid, item in current.items():
+            key = f"{kind}:{itemid}"
+            expiry = self.expires(kind, item, obsolete)
+            if expiry == self.expiry.get(key):
+                # nothing new; in particular, don't undo a retry we scheduled
+                continue
+            self.expiry[key] = expiry
+            if expiry is None:
+                self.when.pop(key, None)
+            else:
+                self.schedule(key, expiry)
+
+    def next(self) -> Optional[float]:
+        while len(self.heap) > 0 and self.when.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if len(self.heap) > 0 else None
+
+    def pop_due(self, now: float) -> List[str]:
+        due = []
+        while self.next() is not None and self.heap[0][0] <= now:
+            _, key = heapq.heappop(self.heap)
+            self.when.pop(key, None)
+            due.append(key)
+        return due
+
+    def found(self) -> Dict[str, List[Dict]]:
+        # the same shape inventory() returns, for plan()
+        return {kind: list(items.values()) for kind, items in self.known.items()}
+
+def sweep(ec2, queue: ExpiryQueue, due: List[str], workers: int, dry_run: bool, log: Callable[[str], None]) -> None:
+    # Someone may have pushed the timeout back since we last listed it (arclight does that to volumes it reuses), so look again, by id, right before deleting
+    bykind = {}
+    for key in due:
+        kind, _, itemid = key.partition(":")
+        bykind.setdefault(kind, []).append(itemid)
+    for kind, ids in bykind.items():
+        queue.update(kind, listing(ec2, kind, [{"Name": kinds[kind]["filter"], "Values": ids}]), ids)
+
+    resources = [resource for resource in plan(queue.found(), only = set(due)) if resource.key in due]
+    execute(ec2, resources, workers, dry_run, log)
+
+    now = time.time()
+    for resource in resources:
+        if resource.state == "deleted":
+            queue.forget(resource.key)
+        elif resource.state in ["planned", "blocked", "failed"] or (resource.state == "skipped" and resource.error is not None):
+            # still there, still due; blocked things are usually waiting on something with a later timeout, and dry runs didn't do anything
+            if resource.state == "blocked":
+                log(f"  Keeping {resource.kind} {resource.name} for now ({resource.reason})")
+            queue.schedule(resource.key, now + retry_seconds)
+        else:
+            log(f"  Not cleaning up {resource.kind} {resource.name} yet, its timeout got pushed back")
+
+def daemon(ec2, refresh_seconds: float = default_refresh_seconds, workers: int = default_workers, dry_run: bool = False, log: Callable[[str], None] = print) -> None:
+    # Never returns
+    # One full listing to start with, then one kind per `refresh_seconds`, so it's a few API calls a minute plus whatever the deletions take
+    queue = ExpiryQueue()
+    for kind, items in inventory(ec2, workers).items():
+        queue.update(kind, items)
+    log(f"{datetime.datetime.now():%Y-%m-%d %H:%M:%S} watching {sum(len(items) for items in queue.known.values())} resources, {len(queue.when)} with timeouts")
+
+    order = itertools.cycle(kinds.keys())
+    nextrefresh = time.time() + refresh_seconds
+    while True:
+        now = time.time()
+        if now >= nextrefresh:
+            kind = next(order)
+            queue.update(kind, listing(ec2, kind))
+            nextrefresh = now + refresh_seconds
+
+        due = queue.pop_due(now)
+        if len(due) > 0:
+            log(f"{datetime.datetime.now():%Y-%m-%d %H:%M:%S} {len(due)} due:")
+            sweep(ec2, queue, due, workers, dry_run, log)
+
+        soonest = queue.next()
+        wake = nextrefresh if soonest is None else min(nextrefresh, soonest)
+        time.sleep(max(wake - time.time(), 0))
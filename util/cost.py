@@ -0,0 +1,137 @@
+import atexit
+import json
+
+from typing import Dict
+from typing import List
+from typing import Optional
+
+# Cost accounting.
+# Everything an `--aws` run spins up gets charged to `ledger` as it goes away, priced by how long we actually held it.
+# At exit we print the breakdown, and if `path` is set, write it out as JSON next to the output.
+# cleanup.py uses the same prices to work out what the stuff we *keep* (snapshots, AMIs, reusable volumes) costs us just sitting there.
+#
+# Prices are us-east-1 on-demand list prices, as of this writing; they're estimates, not the bill.
+# AWS bills all of these per second, with a one-minute minimum for instances and volumes.
+
+hours_per_month = 730
+
+minimum_seconds = 60
+
+# $/hr, with the Windows license where the AMI is Windows
+# The build instances are priced in arclight's instanceTypes table, which adds them here; these are the other things we launch
+instance_hourly = {
+    "m5a.large": 0.178,     # AMI bakes
+    "t3a.medium": 0.0376,   # the registry mirror, which runs Linux
+}
+
+# every instance gets a public IP so we can SSH in
+public_ipv4_hourly = 0.005
+
+# gp3, $/month; the first 3000 IOPS and 125MB/s come with the storage
+ebs_gb_month = 0.08
+ebs_iops_month = 0.005
+ebs_iops_included = 3000
+ebs_throughput_month = 0.04
+ebs_throughput_included = 125
+
+snapshot_gb_month = 0.05
+
+# Getting the output from S3 to us; uploads, and anything staying inside the region (ECR pulls, the bootstrap bundle), are free
+s3_transfer_out_gb = 0.09
+
+def billed_seconds(seconds: float) -> float:
+    return max(seconds, minimum_seconds)
+
+def instance_cost(instancetype: str, seconds: float) -> float:
+    return (instance_hourly[instancetype] + public_ipv4_hourly) * billed_seconds(seconds) / 3600
+
+def volume_monthly(size: int, iops: Optional[int], throughput: Optional[int]) -> float:
+    return (size * ebs_gb_month
+        + max((iops or 0) - ebs_iops_included, 0) * ebs_iops_month
+        + max((throughput or 0) - ebs_throughput_included, 0) * ebs_throughput_month)
+
+def volume_cost(size: int, iops: Optional[int], throughput: Optional[int], seconds: float) -> float:
+    return volume_monthly(size, iops, throughput) * billed_seconds(seconds) / 3600 / hours_per_month
+
+def snapshot_daily(gb: float) -> float:
+    return gb * snapshot_gb_month / hours_per_month * 24
+
+class Ledger:
+    def __init__(self):
+        self.items = []
+
+    def add(self, purpose: str, category: str, resource: str, detail: str, cost: float) -> None:
+        # purpose is what it was for ("build", "ami bake"), category is what kind of thing it was ("instance", "ebs", "snapshot", "transfer")
+        self.items.append({
+            "purpose": purpose,
+            "category": category,
+            "resource": resource,
+            "detail": detail,
+            "cost": cost,
+        })
+
+    def instance(self, purpose: str, instanceid: str, instancetype: str, seconds: float, blockDeviceMappings: List[Dict]) -> None:
+        # The instance itself, plus the root volumes that go away with it
+        if instancetype in instance_hourly:
+            self.add(purpose, "instance", instanceid, f"{instancetype} for {seconds / 60:0.1f} minutes", instance_cost(instancetype, seconds))
+        else:
+            self.add(purpose, "instance", instanceid, f"{instancetype} for {seconds / 60:0.1f} minutes (no price known, so not counted)", 0)
+        for mapping in blockDeviceMappings:
+            ebs = mapping.get("Ebs", {})
+            if "VolumeSize" in ebs and ebs.get("DeleteOnTermination", True):
+                self.volume(purpose, f"{instanceid} {mapping['DeviceName']}", ebs["VolumeSize"], ebs.get("Iops"), ebs.get("Throughput"), seconds)
+
+    def volume(self, purpose: str, resource: str, size: int, iops: Optional[int], throughput: Optional[int], seconds: float) -> None:
+        self.add(purpose, "ebs", resource, f"{size}GB, {iops or ebs_iops_included} IOPS, {throughput or ebs_throughput_included}MB/s for {seconds / 60:0.1f} minutes", volume_cost(size, iops, throughput, seconds))
+
+    def snapshot(self, purpose: str, resource: str, gb: float, days: float) -> None:
+        # Snapshots outlive the run, so they're charged for how long we plan to keep them
+        self.add(purpose, "snapshot", resource, f"~{gb:0.0f}GB for up to {days:g} days", snapshot_daily(gb) * days)
+
+    def transfer(self, purpose: str, resource: str, size: int) -> None:
+        self.add(purpose, "transfer", resource, f"{size / (1 << 30):0.2f}GB out of S3", size / (1 << 30) * s3_transfer_out_gb)
+
+    def total(self) -> float:
+        return sum(item["cost"] for item in self.items)
+
+    def subtotals(self, key: str) -> Dict:
+        result = {}
+        for item in self.items:
+            result[item[key]] = result.get(item[key], 0) + item["cost"]
+        return result
+
+    def report(self) -> List[str]:
+        lines = [f"{item['purpose']}: {item['category']} {item['resource']}, {item['detail']}: ${item['cost']:0.3f}" for item in self.items]
+        lines.append("by purpose: " + ", ".join(f"{purpose} ${cost:0.2f}" for purpose, cost in self.subtotals("purpose").items()))
+        lines.append("by category: " + ", ".join(f"{category} ${cost:0.2f}" for category, cost in self.subtotals("category").items()))
+        lines.append(f"total: ${self.total():0.2f}")
+        return lines
+
+    def save(self, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump({
+                "items": self.items,
+                "by_purpose": self.subtotals("purpose"),
+                "by_category": self.subtotals("category"),
+                "total": self.total(),
+            }, f, indent = 2)
+
+ledger = Ledger()
+
+# where to write the breakdown at exit; None to skip it
+path = None
+
+@atexit.register
+def printall() -> None:
+    # failed runs cost money too, so this happens however we exit
+    if len(ledger.items) == 0:
+        return
+
+    print()
+    print("========= Cost estimate")
+    for line in ledger.report():
+        print(f"COST: {line}")
+
+    if path is not None:
+        ledger.save(path)
+        print(f"Wrote cost breakdown to {path}")
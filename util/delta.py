@@ -0,0 +1,210 @@
+
+# Binary delta artifacts.
+# Consecutive builds of the same stream and script tend to produce mostly-identical output, so instead of shipping the whole thing every time we ship
+#   * nothing at all for files that exist somewhere in the previous output (copied, possibly from a different path),
+#   * a zstd frame compressed against the previous version of the file for files that changed,
+#   * a plain zstd frame for everything else.
+# The artifact is an uncompressed tar of a manifest plus those frames; the frames are already compressed so there's no point in doing it again.
+#
+# This file is used by both the orchestrator and bootstrap.py; it reaches the container in the bootstrap bundle (see shared_files in util/bootstrap.py).
+
+import hashlib
+import json
+import math
+import os
+import shutil
+import tarfile
+
+from typing import Dict
+from typing import Optional
+
+format_version = 1
+extension = ".delta"
+
+# Compressing against a previous version needs both files in memory and a window big enough to see the whole old file.
+# zstd tops out at a 2GB window, and past ~1GB the memory cost gets silly on small containers; bigger files just get compressed standalone.
+max_delta_size = 1 << 30
+level = 3
+
+manifest_filename = "manifest.json"
+
+def _hash_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(1 << 20)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+def scan(tree: str) -> Dict[str, Dict]:
+    # relative path (always forward slashes) -> size and hash
+    files = {}
+    for root, _, filenames in os.walk(tree):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            rel = os.path.relpath(path, tree).replace("\\", "/")
+            files[rel] = {"size": os.path.getsize(path), "sha256": _hash_file(path)}
+    return files
+
+def tree_id(files: Dict[str, Dict]) -> str:
+    return hashlib.sha256(json.dumps({path: info["sha256"] for path, info in files.items()}, sort_keys = True).encode("utf-8")).hexdigest()
+
+def _window_log(size: int) -> int:
+    import zstandard
+    return min(max(zstandard.WINDOWLOG_MIN, math.ceil(math.log2(max(size, 1))) + 1), 31)
+
+def _compress_against(old: bytes, new: bytes) -> bytes:
+    import zstandard
+
+    # this is zstd's --patch-from: use the old file as a raw-content dictionary
+    # The default hash table is far too small to index a big dictionary, so almost nothing matches; size it to the window instead, capped at half a gigabyte.
+    # (Multithreaded compression also quietly stops using the dictionary, so this is single-threaded; files are done one at a time anyway.)
+    windowlog = _window_log(max(len(old), len(new)))
+    params = zstandard.ZstdCompressionParameters.from_level(level,
+        window_log = windowlog,
+        hash_log = min(windowlog, 27),
+        strategy = zstandard.STRATEGY_FAST)
+    dictionary = zstandard.ZstdCompressionDict(old, dict_type = zstandard.DICT_TYPE_RAWCONTENT)
+    return zstandard.ZstdCompressor(dict_data = dictionary, compression_params = params).compress(new)
+
+def _decompress_against(old: bytes, data: bytes, size: int) -> bytes:
+    import zstandard
+
+    dictionary = zstandard.ZstdCompressionDict(old, dict_type = zstandard.DICT_TYPE_RAWCONTENT)
+    return zstandard.ZstdDecompressor(dict_data = dictionary, max_window_size = 1 << _window_log(max(len(old), size))).decompress(data)
+
+def create(tree: str, dst: str, base: Optional[str], threads: int) -> Dict:
+    import zstandard
+
+    # `base` is a directory previously written by `store_base`, or None for a full artifact
+    files = scan(tree)
+    basefiles = {}
+    baseid = None
+    if base is not None:
+        with open(os.path.join(base, manifest_filename), "r") as f:
+            basefiles = json.load(f)
+        baseid = tree_id(basefiles)
+        basetree = os.path.join(base, "tree")
+
+    # lets us catch renames and duplicated files for free
+    byhash = {}
+    for path, info in basefiles.items():
+        byhash.setdefault(info["sha256"], path)
+
+    manifest = {
+        "version": format_version,
+        "base": baseid,
+        "id": tree_id(files),
+        "files": [],
+    }
+    stats = {"copy": 0, "delta": 0, "full": 0, "raw_size": 0}
+
+    with tarfile.open(dst, mode = "w") as tar:
+        for index, (path, info) in enumerate(sorted(files.items())):
+            entry = {"path": path, "size": info["size"], "sha256": info["sha256"]}
+            source = os.path.join(tree, path)
+            stats["raw_size"] += info["size"]
+
+            if info["sha256"] in byhash:
+                entry["op"] = "copy"
+                entry["from"] = byhash[info["sha256"]]
+            else:
+                member = f"data/{index}"
+                staged = f"{dst}.{index}.zst"
+
+                if path in basefiles and info["size"] <= max_delta_size and basefiles[path]["size"] <= max_delta_size:
+                    entry["op"] = "delta"
+                    entry["from"] = path
+                    with open(os.path.join(basetree, path), "rb") as f:
+                        old = f.read()
+                    with open(source, "rb") as f:
+                        new = f.read()
+                    with open(staged, "wb") as f:
+                        f.write(_compress_against(old, new))
+                else:
+                    entry["op"] = "full"
+                    with open(source, "rb") as src, open(staged, "wb") as f:
+                        zstandard.ZstdCompressor(level = level, threads = threads).copy_stream(src, f)
+
+                entry["data"] = member
+                tar.add(staged, arcname = member)
+                os.remove(staged)
+
+            stats[entry["op"]] += 1
+            manifest["files"] += [entry]
+
+        # manifest goes last so we don't have to know everything up front
+        staged = f"{dst}.manifest"
+        with open(staged, "w") as f:
+            json.dump(manifest, f)
+        tar.add(staged, arcname = manifest_filename)
+        os.remove(staged)
+
+    stats["size"] = os.path.getsize(dst)
+    stats["base"] = baseid
+    return stats
+
+def apply(artifact: str, base: Optional[str], dst: str) -> Dict:
+    with tarfile.open(artifact, mode = "r") as tar:
+        manifest = json.load(tar.extractfile(manifest_filename))
+        if manifest["version"] != format_version:
+            raise Exception(f"delta artifact is format v{manifest['version']}, we only understand v{format_version}")
+
+        basetree = None
+        if manifest["base"] is not None:
+            if base is None:
+                raise Exception(f"delta artifact needs base {manifest['base']} but we don't have one")
+            with open(os.path.join(base, manifest_filename), "r") as f:
+                baseid = tree_id(json.load(f))
+            if baseid != manifest["base"]:
+                raise Exception(f"delta artifact needs base {manifest['base']} but we have {baseid}")
+            basetree = os.path.join(base, "tree")
+
+        for entry in manifest["files"]:
+            target = os.path.join(dst, entry["path"])
+            os.makedirs(os.path.dirname(target), exist_ok = True)
+
+            if entry["op"] == "copy":
+                shutil.copyfile(os.path.join(basetree, entry["from"]), target)
+            elif entry["op"] == "delta":
+                with open(os.path.join(basetree, entry["from"]), "rb") as f:
+                    old = f.read()
+                with open(target, "wb") as f:
+                    f.write(_decompress_against(old, tar.extractfile(entry["data"]).read(), entry["size"]))
+            elif entry["op"] == "full":
+                import zstandard
+                with open(target, "wb") as f:
+                    zstandard.ZstdDecompressor().copy_stream(tar.extractfile(entry["data"]), f)
+            else:
+                raise Exception(f"unknown delta op {entry['op']}")
+
+            if _hash_file(target) != entry["sha256"]:
+                raise Exception(f"delta reconstruction of {entry['path']} doesn't match its hash")
+
+    return manifest
+
+def base_id(base: str) -> Optional[str]:
+    path = os.path.join(base, manifest_filename)
+    if not os.path.isfile(path):
+        return None
+    with open(path, "r") as f:
+        return tree_id(json.load(f))
+
+def store_base(tree: str, base: str, move: bool = False) -> None:
+    # Keeps a copy of `tree` around as the base for the next delta.
+    # `move` is much faster when both are on the same volume, but obviously consumes `tree`.
+    if os.path.isdir(base):
+        shutil.rmtree(base)
+    os.makedirs(base)
+
+    files = scan(tree)
+    if move:
+        os.replace(tree, os.path.join(base, "tree"))
+    else:
+        shutil.copytree(tree, os.path.join(base, "tree"))
+
+    # manifest last, so a half-written base never looks valid
+    with open(os.path.join(base, manifest_filename), "w") as f:
+        json.dump(files, f)
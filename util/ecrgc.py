@@ -0,0 +1,125 @@
+import datetime
+
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+
+import util.aws
+import util.cleanup
+
+# ECR garbage collection.
+# Every distinct image arclight builds gets pushed to the `arclight` repository as `{imagename}_{fingerprint}`, and until now nothing ever took them out again.
+# We keep an image if anything might still pull it:
+#   an AMI built around it (AMIs are named arclight-{fingerprint}, and newer ones also carry an arclight-image tag)
+#   a snapshot or volume we're keeping, from a build that used it (arclight-image tag)
+#   one of the last `keep_builds` AWS runs on each stream (each run leaves a marker in S3; see Aws.record_build)
+#   anything pushed within `grace`, since a run that's only just pushed it might not have left any of the above yet
+# Everything else goes, by digest, so a digest's other tags (and untagged digests) go with it.
+# cleanup.py runs this after the EC2 sweep, with whatever survived that.
+
+keep_builds = 5
+
+grace = datetime.timedelta(days = 2)
+
+# batch_delete_image takes at most this many at once
+batch_size = 100
+
+def repository_images(ecr) -> List[Dict]:
+    images = []
+    for page in ecr.get_paginator("describe_images").paginate(repositoryName = util.aws.envname):
+        images += page["imageDetails"]
+    return images
+
+def build_markers(s3) -> Dict[str, List[Dict]]:
+    # stream -> its markers, newest first; each is {"key", "time", "tag"}
+    streams = {}
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket = "arclight", Prefix = f"{util.aws.builds_prefix}/"):
+        for item in page.get("Contents", []):
+            parts = item["Key"].split("/")
+            if len(parts) < 4:
+                continue
+            stream = "/".join(parts[1:-2])
+            streams.setdefault(stream, []).append({"key": item["Key"], "time": parts[-2], "tag": parts[-1]})
+
+    for markers in streams.values():
+        markers.sort(key = lambda marker: marker["time"], reverse = True)
+    return streams
+
+def references(found: Dict[str, List[Dict]], markers: Dict[str, List[Dict]], keep: int) -> Dict[str, str]:
+    # image tag, or "*_{fingerprint}" for AMIs that only tell us the fingerprint -> why we're keeping it
+    result = {}
+    for image in found["image"]:
+        name = util.aws.get_tag(image.get("Tags", []), "Name") or ""
+        tag = util.aws.get_tag(image.get("Tags", []), "arclight-image")
+        if tag is not None:
+            result[tag] = f"AMI {image['ImageId']}"
+        elif name.startswith("arclight-") and name != "arclight-base":
+            result[f"*_{name.removeprefix('arclight-')}"] = f"AMI {image['ImageId']}"
+
+    for kind in ["snapshot", "volume"]:
+        for item in found[kind]:
+            tag = util.aws.get_tag(item.get("Tags", []), "arclight-image")
+            if tag is not None:
+                result.setdefault(tag, f"{kind} {item[util.cleanup.kinds[kind]['id']]}")
+
+    for stream, streammarkers in markers.items():
+        for marker in streammarkers[:keep]:
+            result.setdefault(marker["tag"], f"recent build on {stream}")
+    return result
+
+def why_keep(image: Dict, referenced: Dict[str, str], cutoff: datetime.datetime) -> Optional[str]:
+    # None if nothing wants it
+    for tag in image.get("imageTags", []):
+        if tag in referenced:
+            return referenced[tag]
+        fingerprint = f"*_{tag.rsplit('_', 1)[-1]}"
+        if fingerprint in referenced:
+            return referenced[fingerprint]
+
+    if image["imagePushedAt"] > cutoff:
+        return "pushed recently"
+    return None
+
+def collect(ecr, s3, found: Dict[str, List[Dict]], keep: int = keep_builds, dry_run: bool = False, log: Callable[[str], None] = print) -> Dict[str, int]:
+    # `found` is what's left in EC2, in the shape util.cleanup.inventory() returns
+    # Deletes every image nothing refers to, and the build markers past the last `keep` per stream; returns what it did
+    markers = build_markers(s3)
+    referenced = references(found, markers, keep)
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - grace
+
+    doomed = []
+    kept = 0
+    for image in sorted(repository_images(ecr), key = lambda image: image["imagePushedAt"]):
+        name = ", ".join(image.get("imageTags", [])) or "(untagged)"
+        size = image.get("imageSizeInBytes", 0) / (1 << 30)
+        reason = why_keep(image, referenced, cutoff)
+        if reason is None:
+            log(f"  Cleaning up {name} {image['imageDigest'][:19]} ({size:0.1f}GB)")
+            doomed.append(image)
+        else:
+            log(f"  Keeping {name} ({reason})")
+            kept += 1
+
+    failed = set()
+    if not dry_run:
+        for start in range(0, len(doomed), batch_size):
+            batch = doomed[start:start + batch_size]
+            result = ecr.batch_delete_image(
+                repositoryName = util.aws.envname,
+                imageIds = [{"imageDigest": image["imageDigest"]} for image in batch],
+            )
+            for failure in result.get("failures", []):
+                log(f"  Failed to clean up {failure['imageId'].get('imageDigest', '')[:19]}: {failure.get('failureReason')}")
+                failed.add(failure["imageId"].get("imageDigest"))
+
+    # The markers are tiny, but they'd pile up forever too
+    stale = [marker["key"] for streammarkers in markers.values() for marker in streammarkers[keep:]]
+    if not dry_run:
+        for start in range(0, len(stale), 1000):
+            s3.delete_objects(Bucket = "arclight", Delete = {"Objects": [{"Key": key} for key in stale[start:start + 1000]], "Quiet": True})
+
+    deleted = [image for image in doomed if image["imageDigest"] not in failed]
+    freed = sum(image.get("imageSizeInBytes", 0) for image in deleted) / (1 << 30)
+    log(f"  {'Would clean up' if dry_run else 'Cleaned up'} {len(deleted)} images ({freed:0.1f}GB) and {len(stale)} old build markers, kept {kept}")
+    return {"deleted": len(deleted), "failed": len(failed), "kept": kept, "markers": len(stale)}
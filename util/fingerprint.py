@@ -0,0 +1,82 @@
+
+import fnmatch
+import hashlib
+import json
+import os
+
+from typing import Dict
+from typing import List
+from typing import Optional
+
+# Content fingerprints for build inputs.
+# Hashing a directory full of installers takes a while, so we remember each file's hash along with its size and mtime and only rehash what's changed.
+
+cachepath = "arclight_cache/fingerprints.json"
+
+# Things that show up in image directories as a side effect of building them, and would otherwise change the fingerprint every time
+generated = [
+    "__pycache__",
+    "*.pyc",
+    "*.egg-info",
+    "ue4-docker-build",
+    ".arclight-stages.json", # build.py's record of which stages it has already built
+    "ue4-docker/build",
+    "ue4-docker/dist",
+]
+
+def _excluded(rel: str, exclude: List[str]) -> bool:
+    for pattern in exclude:
+        if fnmatch.fnmatch(rel, pattern) or fnmatch.fnmatch(os.path.basename(rel), pattern):
+            return True
+    return False
+
+def _file_hash(path: str, cache: Dict) -> str:
+    stat = os.stat(path)
+    key = os.path.realpath(path)
+    cached = cache.get(key)
+    if cached is not None and cached["size"] == stat.st_size and cached["mtime"] == stat.st_mtime_ns:
+        return cached["sha256"]
+
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(1 << 20)
+            if not chunk:
+                break
+            h.update(chunk)
+
+    cache[key] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "sha256": h.hexdigest()}
+    return cache[key]["sha256"]
+
+def compute(root: str, extra_files: Optional[List[str]] = None, extra_data: Optional[Dict] = None, exclude: List[str] = generated) -> str:
+    # Hashes every file under `root` (by relative path and contents), plus any extra files and a blob of extra data like build args
+    cache = {}
+    if os.path.isfile(cachepath):
+        with open(cachepath, "r") as f:
+            cache = json.load(f)
+
+    h = hashlib.sha256()
+    for dirpath, dirnames, filenames in os.walk(root):
+        reldir = os.path.relpath(dirpath, root).replace("\\", "/")
+        reldir = "" if reldir == "." else reldir + "/"
+
+        # prune in place so we don't walk into generated directories at all; sorted so the walk order is stable
+        dirnames[:] = sorted(name for name in dirnames if not _excluded(reldir + name, exclude))
+
+        for filename in sorted(filenames):
+            rel = reldir + filename
+            if _excluded(rel, exclude):
+                continue
+            h.update(rel.encode("utf-8") + b"\0" + _file_hash(os.path.join(dirpath, filename), cache).encode("utf-8") + b"\0")
+
+    for path in extra_files or []:
+        h.update(os.path.basename(path).encode("utf-8") + b"\0" + _file_hash(path, cache).encode("utf-8") + b"\0")
+
+    h.update(json.dumps(extra_data or {}, sort_keys = True).encode("utf-8"))
+
+    os.makedirs(os.path.dirname(cachepath), exist_ok = True)
+    with open(cachepath, "w") as f:
+        json.dump(cache, f)
+
+    # long enough to never collide, short enough to be a sane docker tag
+    return h.hexdigest()[:20]
@@ -0,0 +1,180 @@
+import datetime
+import itertools
+import json
+import math
+import os
+import sqlite3
+import statistics
+import time
+
+from typing import Dict
+from typing import List
+from typing import Optional
+
+# Run history.
+# Every successful run appends its per-phase timings (from the prof tree, plus whatever bootstrap reported from inside the container) to a local SQLite file.
+# `history.py trend` reads it back to show how each phase is doing, and flags phases whose recent runs are significantly slower than the runs before them.
+
+historypath = "arclight_cache/history.sqlite3"
+
+s3prefix = "history"
+
+schema = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    time TEXT NOT NULL,
+    build TEXT,
+    script TEXT,
+    stream TEXT,
+    workspace TEXT,
+    mode TEXT,
+    cl TEXT,
+    instance_type TEXT,
+    image TEXT,
+    seconds REAL
+);
+CREATE TABLE IF NOT EXISTS phases (
+    run INTEGER NOT NULL REFERENCES runs(id),
+    phase TEXT NOT NULL,
+    seconds REAL NOT NULL,
+    bytes INTEGER
+);
+CREATE INDEX IF NOT EXISTS phases_by_run ON phases(run);
+"""
+
+def connect(path: str = historypath) -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    db = sqlite3.connect(path)
+    db.row_factory = sqlite3.Row
+    db.executescript(schema)
+    return db
+
+# `block`s here are util.prof spans; we don't import util.prof for the annotation, since importing it gets history.py a prof dump at exit
+def span_phases(block) -> Dict:
+    # phase name -> {"seconds", "bytes"}, named by their path under `block`; repeated phases (say, two docker pulls) add up
+    phases = {}
+    def visit(child, prefix: str) -> None:
+        if child.end is None:
+            return
+        name = prefix + child.label
+        phase = phases.setdefault(name, {"seconds": 0, "bytes": None})
+        phase["seconds"] += child.end - child.start
+        if "bytes" in child.attributes:
+            phase["bytes"] = (phase["bytes"] or 0) + child.attributes["bytes"]
+        for grandchild in list(child.children):
+            visit(grandchild, name + "/")
+
+    for child in list(block.children):
+        visit(child, "")
+    return phases
+
+def span_attribute(block, key: str):
+    # first one we find, depth-first
+    if key in block.attributes:
+        return block.attributes[key]
+    for child in list(block.children):
+        value = span_attribute(child, key)
+        if value is not None:
+            return value
+    return None
+
+def bootstrap_phases(metrics: Dict) -> Dict:
+    # the same shape as span_phases, from the metrics file bootstrap writes next to the output
+    phases = {}
+    def add(name: str, seconds: float, size: Optional[int] = None) -> None:
+        phases[f"bootstrap/{name}"] = {"seconds": seconds, "bytes": size}
+
+    if "preflight" in metrics:
+        add("preflight", metrics["preflight"]["seconds"])
+    if "staging" in metrics:
+        for direction in ["in", "out"]:
+            if direction in metrics["staging"]:
+                add(f"stage {direction}", metrics["staging"][direction]["seconds"], metrics["staging"][direction]["copied_bytes"])
+    if "script_start" in metrics and "script_end" in metrics:
+        add("script", metrics["script_end"] - metrics["script_start"])
+    if "packaging" in metrics:
+        add("packaging", metrics["packaging"]["seconds"], metrics["packaging"]["size"])
+    if "upload" in metrics:
+        add("upload", metrics["upload"]["seconds"], metrics["upload"]["size"])
+    return phases
+
+def record(block, metricspath: Optional[str], **run) -> int:
+    # Records a finished run; `block` is the span covering it, and `run` fills in the columns of the runs table
+    phases = span_phases(block)
+    if metricspath is not None and os.path.isfile(metricspath):
+        with open(metricspath, "r") as f:
+            phases.update(bootstrap_phases(json.load(f)))
+
+    run.setdefault("cl", span_attribute(block, "cl"))
+    run.setdefault("instance_type", span_attribute(block, "instance_type"))
+
+    db = connect()
+    with db:
+        columns = ["time", "seconds"] + list(run.keys())
+        values = [datetime.datetime.now().isoformat(), time.perf_counter() - block.start] + list(run.values())
+        runid = db.execute(f"INSERT INTO runs ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})", values).lastrowid
+        db.executemany("INSERT INTO phases (run, phase, seconds, bytes) VALUES (?, ?, ?, ?)",
+            [(runid, name, phase["seconds"], phase["bytes"]) for name, phase in phases.items()])
+    db.close()
+
+    print(f"HISTORY: recorded run {runid} with {len(phases)} phases")
+    return runid
+
+def series(db: sqlite3.Connection, group: str, script: Optional[str] = None, stream: Optional[str] = None) -> Dict:
+    # (group value, phase) -> list of seconds, oldest first
+    query = f"SELECT runs.{group} AS grp, phases.phase AS phase, phases.seconds AS seconds FROM phases JOIN runs ON phases.run = runs.id WHERE 1 = 1"
+    params = []
+    if script is not None:
+        query += " AND runs.script = ?"
+        params.append(script)
+    if stream is not None:
+        query += " AND runs.stream = ?"
+        params.append(stream)
+    query += " ORDER BY runs.id"
+
+    result = {}
+    for row in db.execute(query, params):
+        result.setdefault((row["grp"], row["phase"]), []).append(row["seconds"])
+    return result
+
+def slower_p(baseline: List[float], recent: List[float]) -> float:
+    # One-sided Mann-Whitney U test: how likely is it that `recent` would be at least this much slower than `baseline` by chance?
+    # Phase timings are nowhere near normally distributed (a single slow sync is common), so we stick to ranks.
+    # With the handful of runs we usually have, we can just try every way of splitting them and count exactly.
+    combined = baseline + recent
+    def u(indices) -> float:
+        chosen = [combined[i] for i in indices]
+        others = [combined[i] for i in range(len(combined)) if i not in indices]
+        return sum(1 if a > b else 0.5 if a == b else 0 for a in chosen for b in others)
+
+    observed = u(range(len(baseline), len(combined)))
+    if math.comb(len(combined), len(recent)) <= 20000:
+        splits = [u(indices) for indices in itertools.combinations(range(len(combined)), len(recent))]
+        return sum(1 for value in splits if value >= observed) / len(splits)
+
+    # too many to count, so use the normal approximation instead
+    n1, n2 = len(recent), len(baseline)
+    mean = n1 * n2 / 2
+    deviation = math.sqrt(n1 * n2 * (n1 + n2 + 1) / 12)
+    return 1 - statistics.NormalDist(mean, deviation).cdf(observed - 0.5)
+
+def regression(values: List[float], window: int, recent: int, alpha: float, threshold: float) -> Optional[Dict]:
+    # Compares the last `recent` runs against the `window` runs before them; returns None if there isn't enough history yet
+    # (with fewer than five baseline runs, even the most lopsided result isn't significant at the usual levels)
+    if len(values) < recent + min(window, 5):
+        return None
+
+    recentvalues = values[-recent:]
+    baseline = values[-recent - window:-recent]
+    basemedian = statistics.median(baseline)
+    recentmedian = statistics.median(recentvalues)
+    change = (recentmedian - basemedian) / basemedian if basemedian > 0 else 0
+    p = slower_p(baseline, recentvalues)
+    return {
+        "baseline": basemedian,
+        "recent": recentmedian,
+        "change": change,
+        "p": p,
+        # significant *and* big enough to care about; a phase reliably taking 0.1s longer isn't news
+        "regressed": p < alpha and change > threshold,
+    }
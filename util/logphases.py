@@ -0,0 +1,155 @@
+import re
+import subprocess
+import sys
+import time
+
+from typing import Dict
+from typing import List
+
+import util.prof
+
+# Build log analysis.
+# The script's output reaches us as plain text, through `docker start -a` (or `docker exec`) locally and through SSH on AWS.
+# Analyser sits in that stream: it passes every line straight through to our stdout, and watches for lines that mark where a phase starts and ends, or that are worth counting.
+# Phases become spans under the run's span, so they show up in the prof dump, the trace and history.py without anyone hand-grepping a log.
+# It only ever holds on to the line it's in the middle of, so a multi-gigabyte cook log costs nothing to watch.
+#
+# Rules are plain dicts, so scripts can add their own from `--validate`, as "log_phases": {"phases": [...], "counters": [...]}:
+#   phase:   {"name": "cook", "start": regex, "end": regex, "group": optional}
+#            A phase runs from the first line matching `start` to the next one matching `end`; starting a phase ends any other open phase in the same group.
+#            Anything still open when the output ends, ends there.
+#   counter: {"name": "shaders", "pattern": regex, "mode": "count" | "sum" | "max" | "last"}
+#            "count" counts matching lines; the others use the pattern's `count` group (commas are fine).
+#            Phases get the counts and sums from while they were open as attributes, and the run's span gets the totals.
+
+# UAT prints a banner around each BuildCookRun step
+uat_phases = [{
+    "name": f"uat {command.lower()}",
+    "start": rf"\*+ {command} COMMAND STARTED \*+",
+    "end": rf"\*+ {command} COMMAND COMPLETED \*+",
+    "group": "uat",
+} for command in ["BUILD", "COOK", "STAGE", "PACKAGE", "ARCHIVE"]]
+
+default_phases = uat_phases + [
+    {"name": "uht", "start": r"Parsing headers for |Running (Internal )?UnrealHeaderTool", "end": r"Reflection code generated for .* in [\d.]+ seconds|UnrealHeaderTool (failed|succeeded)"},
+    {"name": "ubt compile", "start": r"Building \d+ actions? with \d+ (processes|workers)", "end": r"Total time in .* executor: [\d.]+ seconds|Total execution time: [\d.]+ seconds"},
+    {"name": "shader compilation", "start": r"LogShaderCompilers: .*[Ss]haders left to compile [1-9]", "end": r"LogShaderCompilers: .*[Ss]haders left to compile 0\b"},
+    {"name": "pak", "start": r"Running UnrealPak|Executing \d+ UnrealPak command", "end": r"UnrealPak executed in [\d.]+ ?s"},
+]
+
+default_counters = [
+    {"name": "ubt actions", "pattern": r"^\[\d+/\d+\] ", "mode": "count"},
+    {"name": "ubt compiles", "pattern": r"^\[\d+/\d+\] Compile", "mode": "count"},
+    {"name": "ubt actions planned", "pattern": r"Building (?P<count>\d+) actions? with", "mode": "sum"},
+    {"name": "shaders queued peak", "pattern": r"[Ss]haders left to compile (?P<count>\d+)", "mode": "max"},
+    {"name": "shader jobs", "pattern": r"Total job queries (?P<count>[\d,]+)", "mode": "last"},
+    {"name": "packages cooked", "pattern": r"LogCook: Display: Cooked packages (?P<count>\d+)", "mode": "last"},
+    {"name": "warnings", "pattern": r"(?i)\bwarning\b[ :]", "mode": "count"},
+    {"name": "errors", "pattern": r"(?i)\berror\b[ :]", "mode": "count"},
+]
+
+# most lines match nothing, so don't bother running the rules on lines this long (usually someone dumping a blob)
+max_line = 4096
+
+class Analyser:
+    def __init__(self, phases: List[Dict], counters: List[Dict], parent: 'util.prof.ProfBlock' = None):
+        self.phases = [dict(phase, start = re.compile(phase["start"]), end = re.compile(phase["end"])) for phase in phases]
+        self.counters = [dict(counter, pattern = re.compile(counter["pattern"])) for counter in counters]
+        self.parent = parent or util.prof.current()
+        self.partial = ""
+        self.totals = {}
+        self.open = {}      # phase name -> (start time, totals when it started)
+        self.finished = []  # (name, seconds), in order
+
+    # A file-like object, so it can go anywhere our stdout would
+    def write(self, text: str) -> int:
+        sys.stdout.write(text)
+        lines = (self.partial + text).split("\n")
+        self.partial = lines.pop()
+        if len(self.partial) > max_line:
+            # nobody's going to mark a phase with a line like this; don't keep growing it
+            self.partial = ""
+        for line in lines:
+            self.line(line.rstrip("\r"))
+        return len(text)
+
+    def flush(self) -> None:
+        sys.stdout.flush()
+
+    # `with analyser:` closes it either way, so the phases still get recorded if the run fails partway through
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        self.close()
+
+    def line(self, line: str) -> None:
+        if len(line) > max_line:
+            return
+        now = time.perf_counter()
+
+        for counter in self.counters:
+            match = counter["pattern"].search(line)
+            if match is None:
+                continue
+            name, mode = counter["name"], counter.get("mode", "count")
+            value = 1 if mode == "count" else int(match.group("count").replace(",", ""))
+            if mode in ["count", "sum"]:
+                self.totals[name] = self.totals.get(name, 0) + value
+            elif mode == "max":
+                self.totals[name] = max(self.totals.get(name, value), value)
+            else:
+                self.totals[name] = value
+
+        for phase in self.phases:
+            if phase["name"] in self.open:
+                if phase["end"].search(line):
+                    self.end(phase["name"], now)
+            elif phase["start"].search(line):
+                if "group" in phase:
+                    for other in self.phases:
+                        if other.get("group") == phase["group"] and other["name"] in self.open:
+                            self.end(other["name"], now)
+                self.open[phase["name"]] = (now, dict(self.totals))
+
+    def end(self, name: str, now: float) -> None:
+        start, before = self.open.pop(name)
+        # the counts that happened while it was open; "max" and "last" only make sense for the whole run
+        modes = {counter["name"]: counter.get("mode", "count") for counter in self.counters}
+        during = {key: value - before.get(key, 0) for key, value in self.totals.items() if modes.get(key) in ["count", "sum"] and value != before.get(key, 0)}
+        util.prof.record(name, start, now, self.parent, **during)
+        self.finished.append((name, now - start))
+
+    def close(self) -> None:
+        # End of the output: whatever's left is the last line, and whatever's open ends now
+        if self.partial != "":
+            self.line(self.partial.rstrip("\r"))
+            self.partial = ""
+        now = time.perf_counter()
+        for name in list(self.open.keys()):
+            self.end(name, now)
+        self.parent.attributes.update(self.totals)
+
+    def describe(self) -> List[str]:
+        lines = [f"{name}: {seconds:0.1f}s" for name, seconds in self.finished]
+        if len(self.totals) > 0:
+            lines.append(", ".join(f"{name} {value}" for name, value in self.totals.items()))
+        return lines
+
+def analyser(scriptsettings: Dict, parent: 'util.prof.ProfBlock' = None) -> Analyser:
+    # The Unreal rules plus whatever the script asked for
+    extra = scriptsettings.get("log_phases", {})
+    return Analyser(default_phases + extra.get("phases", []), default_counters + extra.get("counters", []), parent)
+
+def run(command: List[str], analyser: Analyser) -> None:
+    # subprocess.check_call, with the output going through `analyser` on its way to our stdout
+    process = subprocess.Popen(command, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+    try:
+        for line in process.stdout:
+            analyser.write(line.decode("utf-8", errors = "replace"))
+            analyser.flush()
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command)
@@ -0,0 +1,467 @@
+
+# Pull-through registry mirror.
+# Builds and AMI bakes keep pulling the same pinned base images (see wincontainer_version.py) and our own ECR images over the Internet.
+# This serves the read half of the registry v2 API and forwards misses to the real registry, keeping everything it fetches on disk.
+#
+# Images are addressed through it as `<mirror>/<upstream host>/<repository>:<tag>`, e.g. `localhost:5000/mcr.microsoft.com/windows/servercore:ltsc2019`,
+# so one mirror covers every upstream; `pull()` below fetches through it and retags to the real name, so nothing else has to know it exists.
+#
+# Blobs and manifests-by-digest are immutable, so once we have them we never ask upstream again.
+# Tags are rechecked every `tag_ttl`, and if upstream is unreachable we serve whatever we had.
+# When the blob cache outgrows its limit we evict the least recently used blobs.
+#
+# This file is also copied onto the AWS mirror instance (see Aws.ensure_mirror), so it sticks to the standard library plus an optional boto3.
+
+import base64
+import hashlib
+import http.server
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from typing import Dict
+from typing import List
+from typing import Optional
+
+default_port = 5000
+
+default_upstreams = ["mcr.microsoft.com"]
+
+# how long a tag -> digest lookup is trusted before we ask upstream again
+tag_ttl = 60 * 60
+
+# once over the limit, evict down to this fraction of it, so we aren't evicting on every miss
+low_water = 0.9
+
+# how often hit/miss counters get written to disk
+stats_interval = 30
+
+# what we ask for if the client didn't say
+manifest_accept = ", ".join([
+    "application/vnd.docker.distribution.manifest.v2+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.oci.image.index.v1+json",
+])
+
+stats_path = "/arclight/stats"
+
+digest_pattern = re.compile(r"^sha256:[0-9a-f]{64}$")
+request_pattern = re.compile(r"^/v2/(?P<upstream>[^/]+)/(?P<repository>.+)/(?P<kind>manifests|blobs)/(?P<reference>[^/]+)$")
+
+class EcrCredentials:
+    # ECR wants basic auth with a token that expires after 12 hours, so we fetch a fresh one every so often
+    def __init__(self, region: str):
+        self.region = region
+        self.expires = 0
+        self.username = None
+        self.password = None
+
+    def __call__(self):
+        if time.time() > self.expires:
+            import boto3
+            auth = boto3.client("ecr", region_name = self.region).get_authorization_token()["authorizationData"][0]
+            self.username, self.password = base64.b64decode(auth["authorizationToken"]).decode("utf-8").split(":")
+            self.expires = time.time() + 6 * 60 * 60
+        return self.username, self.password
+
+class Upstream:
+    # One real registry, and the auth tokens we've collected for it
+    def __init__(self, host: str, credentials = None):
+        self.host = host
+        self.credentials = credentials
+        self.tokens = {}
+        self.lock = threading.Lock()
+
+    def _basic(self) -> Optional[str]:
+        if self.credentials is None:
+            return None
+        username, password = self.credentials()
+        return "Basic " + base64.b64encode(f"{username}:{password}".encode("utf-8")).decode("utf-8")
+
+    def _authenticate(self, challenge: str, repository: str) -> Optional[str]:
+        scheme, _, params = challenge.partition(" ")
+        if scheme.lower() == "basic":
+            return self._basic()
+
+        # Bearer: trade our credentials (or nothing, for public images) for a token scoped to this repository
+        fields = dict(re.findall(r'(\w+)="([^"]*)"', params))
+        query = {"service": fields.get("service", ""), "scope": fields.get("scope", f"repository:{repository}:pull")}
+        request = urllib.request.Request(f"{fields['realm']}?{urllib.parse.urlencode(query)}")
+        basic = self._basic()
+        if basic is not None:
+            request.add_header("Authorization", basic)
+        with urllib.request.urlopen(request, timeout = 60) as response:
+            token = json.load(response)
+        return "Bearer " + (token.get("token") or token["access_token"])
+
+    def open(self, method: str, repository: str, path: str, headers: Dict[str, str]):
+        # Returns an open response; raises urllib.error.HTTPError for anything that isn't a success
+        url = f"https://{self.host}/v2/{repository}/{path}"
+        for attempt in range(2):
+            request = urllib.request.Request(url, method = method, headers = headers)
+            with self.lock:
+                authorization = self.tokens.get(repository)
+            if authorization is not None:
+                # blob downloads usually redirect to a CDN or S3, which will reject our registry credentials
+                request.add_unredirected_header("Authorization", authorization)
+
+            try:
+                return urllib.request.urlopen(request, timeout = 300)
+            except urllib.error.HTTPError as ex:
+                if ex.code != 401 or attempt > 0 or "WWW-Authenticate" not in ex.headers:
+                    raise
+                authorization = self._authenticate(ex.headers["WWW-Authenticate"], repository)
+                with self.lock:
+                    self.tokens[repository] = authorization
+
+class Mirror:
+    def __init__(self, storage: str, max_bytes: int, upstreams: Dict[str, Upstream]):
+        self.storage = storage
+        self.max_bytes = max_bytes
+        self.upstreams = upstreams
+        self.lock = threading.Lock()
+
+        for subdir in ["blobs", "manifests", "tags", "tmp"]:
+            os.makedirs(os.path.join(storage, subdir), exist_ok = True)
+
+        # anything in tmp is a download that was interrupted
+        for filename in os.listdir(os.path.join(storage, "tmp")):
+            os.remove(os.path.join(storage, "tmp", filename))
+
+        self.size = sum(os.path.getsize(os.path.join(storage, "blobs", filename)) for filename in os.listdir(os.path.join(storage, "blobs")))
+
+        self.stats = {
+            "blob_hits": 0, "blob_misses": 0,
+            "blob_hit_bytes": 0, "blob_miss_bytes": 0,
+            "manifest_hits": 0, "manifest_misses": 0, "manifest_stale": 0,
+            "evictions": 0, "evicted_bytes": 0,
+        }
+        statsfile = os.path.join(storage, "stats.json")
+        if os.path.isfile(statsfile):
+            with open(statsfile, "r") as f:
+                self.stats.update(json.load(f))
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.storage, "blobs", digest.replace(":", "_"))
+
+    def manifest_path(self, digest: str) -> str:
+        return os.path.join(self.storage, "manifests", digest.replace(":", "_"))
+
+    def count(self, **deltas) -> None:
+        with self.lock:
+            for key, delta in deltas.items():
+                self.stats[key] += delta
+
+    def save_stats(self) -> None:
+        with self.lock:
+            stats = dict(self.stats)
+        with open(os.path.join(self.storage, "stats.json.tmp"), "w") as f:
+            json.dump(stats, f)
+        os.replace(os.path.join(self.storage, "stats.json.tmp"), os.path.join(self.storage, "stats.json"))
+
+    def report(self) -> Dict:
+        with self.lock:
+            stats = dict(self.stats)
+            size = self.size
+        blobrequests = stats["blob_hits"] + stats["blob_misses"]
+        blobbytes = stats["blob_hit_bytes"] + stats["blob_miss_bytes"]
+        stats.update({
+            "size": size,
+            "max_size": self.max_bytes,
+            "blob_hit_rate": stats["blob_hits"] / blobrequests if blobrequests > 0 else None,
+            "byte_hit_rate": stats["blob_hit_bytes"] / blobbytes if blobbytes > 0 else None,
+        })
+        return stats
+
+    def evict(self, target: Optional[int] = None) -> None:
+        # Least recently used first; hits touch the blob's mtime, so that's our access time
+        if target is None:
+            target = int(self.max_bytes * low_water)
+        with self.lock:
+            if self.size <= target:
+                return
+            blobdir = os.path.join(self.storage, "blobs")
+            blobs = sorted((os.stat(os.path.join(blobdir, filename)).st_mtime, filename) for filename in os.listdir(blobdir))
+            for _, filename in blobs:
+                if self.size <= target:
+                    break
+                path = os.path.join(blobdir, filename)
+                size = os.path.getsize(path)
+                os.remove(path)
+                self.size -= size
+                self.stats["evictions"] += 1
+                self.stats["evicted_bytes"] += size
+                print(f"MIRROR: evicted {filename} ({size / (1 << 20):0.1f}MB)")
+
+    def manifest(self, upstream: Upstream, repository: str, reference: str, accept: str):
+        # Returns (content type, digest, body)
+        if digest_pattern.match(reference):
+            path = self.manifest_path(reference)
+            if os.path.isfile(path):
+                with open(path, "rb") as f:
+                    entry = json.loads(f.read())
+                self.count(manifest_hits = 1)
+                return entry["content_type"], reference, base64.b64decode(entry["body"])
+            return self._fetch_manifest(upstream, repository, reference, accept, None)
+
+        # tags can move, so only trust them for a while
+        tagkey = hashlib.sha256(json.dumps([upstream.host, repository, reference, accept]).encode("utf-8")).hexdigest()
+        tagpath = os.path.join(self.storage, "tags", tagkey)
+        cached = None
+        if os.path.isfile(tagpath):
+            with open(tagpath, "r") as f:
+                cached = json.load(f)
+            if time.time() - cached["fetched"] < tag_ttl and os.path.isfile(self.manifest_path(cached["digest"])):
+                return self.manifest(upstream, repository, cached["digest"], accept)
+
+        try:
+            return self._fetch_manifest(upstream, repository, reference, accept, tagpath)
+        except (urllib.error.URLError, OSError) as ex:
+            if cached is None or not os.path.isfile(self.manifest_path(cached["digest"])):
+                raise
+            print(f"MIRROR: couldn't refresh {upstream.host}/{repository}:{reference} ({ex}), serving cached copy")
+            self.count(manifest_stale = 1)
+            return self.manifest(upstream, repository, cached["digest"], accept)
+
+    def _fetch_manifest(self, upstream: Upstream, repository: str, reference: str, accept: str, tagpath: Optional[str]):
+        with upstream.open("GET", repository, f"manifests/{reference}", {"Accept": accept}) as response:
+            body = response.read()
+            contenttype = response.headers.get("Content-Type")
+            digest = response.headers.get("Docker-Content-Digest") or f"sha256:{hashlib.sha256(body).hexdigest()}"
+        self.count(manifest_misses = 1)
+
+        with open(self.manifest_path(digest), "w") as f:
+            json.dump({"content_type": contenttype, "body": base64.b64encode(body).decode("utf-8")}, f)
+        if tagpath is not None:
+            with open(tagpath, "w") as f:
+                json.dump({"digest": digest, "fetched": time.time()}, f)
+
+        return contenttype, digest, body
+
+    def serve_blob(self, handler, upstream: Upstream, repository: str, digest: str, head: bool) -> None:
+        path = self.blob_path(digest)
+        if os.path.isfile(path):
+            os.utime(path)  # most recently used
+            size = os.path.getsize(path)
+            handler.send_response(200)
+            handler.send_header("Content-Type", "application/octet-stream")
+            handler.send_header("Content-Length", str(size))
+            handler.send_header("Docker-Content-Digest", digest)
+            handler.end_headers()
+            if not head:
+                with open(path, "rb") as f:
+                    while True:
+                        chunk = f.read(1 << 20)
+                        if not chunk:
+                            break
+                        handler.wfile.write(chunk)
+                self.count(blob_hits = 1, blob_hit_bytes = size)
+            return
+
+        with upstream.open("HEAD" if head else "GET", repository, f"blobs/{digest}", {}) as response:
+            handler.send_response(200)
+            handler.send_header("Content-Type", "application/octet-stream")
+            if response.headers.get("Content-Length") is not None:
+                handler.send_header("Content-Length", response.headers["Content-Length"])
+            else:
+                # no length means the end of the body is the end of the connection
+                handler.send_header("Connection", "close")
+                handler.close_connection = True
+            handler.send_header("Docker-Content-Digest", digest)
+            handler.end_headers()
+            if head:
+                return
+
+            # stream it to the client and to disk at the same time, and only keep it if it's what it claims to be
+            tmppath = os.path.join(self.storage, "tmp", f"{digest.replace(':', '_')}.{threading.get_ident()}")
+            h = hashlib.sha256()
+            size = 0
+            try:
+                with open(tmppath, "wb") as f:
+                    while True:
+                        chunk = response.read(1 << 20)
+                        if not chunk:
+                            break
+                        h.update(chunk)
+                        f.write(chunk)
+                        size += len(chunk)
+                        handler.wfile.write(chunk)
+
+                if f"sha256:{h.hexdigest()}" != digest:
+                    raise Exception(f"upstream sent a blob that doesn't match {digest}")
+
+                os.replace(tmppath, path)
+            finally:
+                if os.path.isfile(tmppath):
+                    os.remove(tmppath)
+
+        with self.lock:
+            self.size += size
+        self.count(blob_misses = 1, blob_miss_bytes = size)
+        if self.size > self.max_bytes:
+            self.evict()
+
+def serve(storage: str, port: int, max_bytes: int, upstreams: Dict[str, Upstream]) -> None:
+    mirror = Mirror(storage, max_bytes, upstreams)
+    mirror.evict()  # the limit might have changed since last time
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def error(self, code: int, errorcode: str, message: str) -> None:
+            body = json.dumps({"errors": [{"code": errorcode, "message": message}]}).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if self.command != "HEAD":
+                self.wfile.write(body)
+
+        def json_reply(self, body) -> None:
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.send_header("Docker-Distribution-API-Version", "registry/2.0")
+            self.end_headers()
+            if self.command != "HEAD":
+                self.wfile.write(data)
+
+        def handle_read(self, head: bool) -> None:
+            if self.path == "/v2/" or self.path == "/v2":
+                self.json_reply({})
+                return
+
+            if self.path == stats_path:
+                self.json_reply(mirror.report())
+                return
+
+            match = request_pattern.match(urllib.parse.urlparse(self.path).path)
+            if match is None:
+                self.error(404, "NAME_UNKNOWN", "not a registry read request")
+                return
+
+            upstream = upstreams.get(match["upstream"])
+            if upstream is None:
+                self.error(404, "NAME_UNKNOWN", f"{match['upstream']} isn't one of this mirror's upstreams")
+                return
+
+            try:
+                if match["kind"] == "manifests":
+                    contenttype, digest, body = mirror.manifest(upstream, match["repository"], match["reference"], self.headers.get("Accept") or manifest_accept)
+                    self.send_response(200)
+                    self.send_header("Content-Type", contenttype)
+                    self.send_header("Content-Length", str(len(body)))
+                    self.send_header("Docker-Content-Digest", digest)
+                    self.end_headers()
+                    if not head:
+                        self.wfile.write(body)
+                else:
+                    if not digest_pattern.match(match["reference"]):
+                        self.error(400, "DIGEST_INVALID", f"unsupported digest {match['reference']}")
+                        return
+                    mirror.serve_blob(self, upstream, match["repository"], match["reference"], head)
+            except urllib.error.HTTPError as ex:
+                self.error(ex.code, "UNKNOWN", f"upstream said {ex.code} {ex.reason}")
+            except (ConnectionError, BrokenPipeError):
+                pass    # client went away
+            except Exception as ex:
+                print(f"MIRROR: failed serving {self.path}: {ex}")
+                self.close_connection = True
+
+        def do_GET(self):
+            self.handle_read(False)
+
+        def do_HEAD(self):
+            self.handle_read(True)
+
+        def do_DELETE(self):
+            # evict everything, for testing; `mirror.py evict` calls this
+            if self.path == stats_path:
+                mirror.evict(0)
+                self.json_reply(mirror.report())
+            else:
+                self.error(405, "UNSUPPORTED", "this mirror is read-only")
+
+        def log_message(self, format, *args):
+            pass    # a single pull is hundreds of requests
+
+    def save_loop():
+        while True:
+            time.sleep(stats_interval)
+            mirror.save_stats()
+
+    threading.Thread(target = save_loop, daemon = True).start()
+
+    print(f"MIRROR: serving {', '.join(upstreams)} on port {port} from {storage} ({mirror.size / (1 << 30):0.1f}GB of {max_bytes / (1 << 30):0.0f}GB used)")
+    try:
+        http.server.ThreadingHTTPServer(("0.0.0.0", port), Handler).serve_forever()
+    finally:
+        mirror.save_stats()
+
+# Client side
+
+def mirrored_name(mirror: str, image: str) -> str:
+    # `image` has to name its registry explicitly; docker hub shorthand isn't supported
+    return f"{mirror}/{image}"
+
+def pull_commands(mirror: str, image: str) -> List[List[str]]:
+    # Pull through the mirror, then tag it with its real name so Dockerfiles and `docker run` find it as usual
+    return [
+        ['docker', 'pull', mirrored_name(mirror, image)],
+        ['docker', 'tag', mirrored_name(mirror, image), image],
+    ]
+
+def pull(mirror: str, image: str) -> None:
+    for command in pull_commands(mirror, image):
+        subprocess.check_call(command)
+
+def fetch_stats(mirror: str, timeout: float = 5) -> Dict:
+    with urllib.request.urlopen(f"http://{mirror}{stats_path}", timeout = timeout) as response:
+        return json.load(response)
+
+def is_running(mirror: str) -> bool:
+    try:
+        fetch_stats(mirror, timeout = 2)
+        return True
+    except (urllib.error.URLError, OSError):
+        return False
+
+def start_local(mirror: str, storage: str, log: str) -> None:
+    # Starts a mirror on this machine in the background, unless one's already answering at `mirror`; it keeps running after we exit
+    if is_running(mirror):
+        return
+
+    port = mirror.rpartition(":")[2]
+    print(f"MIRROR: starting local mirror on port {port}")
+    os.makedirs(os.path.dirname(log), exist_ok = True)
+    with open(log, "a") as logfile:
+        subprocess.Popen([
+                sys.executable, "-u", "mirror.py", "serve",
+                "--port", port,
+                "--storage", storage,
+            ],
+            stdout = logfile,
+            stderr = subprocess.STDOUT,
+            creationflags = getattr(subprocess, "DETACHED_PROCESS", 0) | getattr(subprocess, "CREATE_NEW_PROCESS_GROUP", 0))
+
+    for _ in range(30):
+        if is_running(mirror):
+            return
+        time.sleep(1)
+    raise Exception(f"local mirror didn't start; see {log}")
+
+def describe_stats(stats: Dict) -> str:
+    hitrate = "n/a" if stats["blob_hit_rate"] is None else f"{stats['blob_hit_rate'] * 100:0.0f}%"
+    bytehitrate = "n/a" if stats["byte_hit_rate"] is None else f"{stats['byte_hit_rate'] * 100:0.0f}%"
+    return (f"{hitrate} of blobs and {bytehitrate} of bytes served from cache"
+        f" ({stats['blob_hits']} hits, {stats['blob_misses']} misses, {stats['manifest_stale']} stale manifests);"
+        f" {stats['size'] / (1 << 30):0.1f}GB of {stats['max_size'] / (1 << 30):0.0f}GB used, {stats['evictions']} evictions")
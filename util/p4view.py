@@ -0,0 +1,147 @@
+
+import hashlib
+import json
+import re
+
+from typing import Dict
+from typing import List
+from typing import Optional
+
+# Scripts can narrow the client view they're synced with by returning something like this from `--validate`:
+#   "view": {
+#       "include": ["arclight/...", "Engine/...", "Game/Content/..."],
+#       "exclude": ["Game/Platforms/PS5/..."],
+#   }
+# Paths are relative to the stream root and use normal p4 wildcards.
+# An empty or missing `include` means "the whole stream"; `exclude` is applied on top of it either way.
+
+# Used as the view hash when there's no narrowing at all, so full-stream volumes have a readable tag
+full = "full"
+
+def normalize(settings: Optional[Dict]) -> Dict[str, List[str]]:
+    if settings is None:
+        settings = {}
+
+    result = {}
+    for key in ["include", "exclude"]:
+        paths = settings.get(key) or []
+        if isinstance(paths, str):
+            paths = [paths]
+
+        cleaned = []
+        for path in paths:
+            path = path.strip().replace("\\", "/").lstrip("/")
+            if path == "":
+                continue
+
+            if ".." in path.split("/") or path.startswith("-"):
+                raise Exception(f"invalid view path `{path}`; paths must be relative to the stream root")
+
+            cleaned += [path]
+
+        # order doesn't matter for the hash, and dupes are meaningless
+        result[key] = sorted(set(cleaned))
+
+    return result
+
+def is_narrowed(view: Dict[str, List[str]]) -> bool:
+    return len(view["include"]) > 0 or len(view["exclude"]) > 0
+
+def view_hash(view: Dict[str, List[str]]) -> str:
+    if not is_narrowed(view):
+        return full
+
+    # short enough to be readable in the console, long enough that we won't get collisions between a handful of scripts
+    return hashlib.sha256(json.dumps(view, sort_keys = True).encode("utf-8")).hexdigest()[:12]
+
+def _quote(path: str) -> str:
+    # p4 wants paths with spaces quoted, and is fine with everything else bare
+    if " " in path:
+        return f'"{path}"'
+    return path
+
+# one client view line: an optional +/-/& prefix on the depot side, then the client side, either of which might be quoted
+_line_pattern = re.compile(r'^\s*(?:"(?P<qdepot>[^"]*)"|(?P<depot>\S+))\s+(?:"(?P<qclient>[^"]*)"|(?P<client>\S+))\s*$')
+
+def _parse(line: str):
+    # returns (prefix, depot path, client path relative to the workspace root), or None if it's not something we understand
+    match = _line_pattern.match(line)
+    if match is None:
+        return None
+    depot = match.group("qdepot") if match.group("qdepot") is not None else match.group("depot")
+    clientpath = match.group("qclient") if match.group("qclient") is not None else match.group("client")
+
+    prefix = ""
+    if depot[:1] in ["-", "+", "&"]:
+        prefix, depot = depot[:1], depot[1:]
+
+    parts = clientpath.split("/", 3)
+    if len(parts) < 4 or parts[0] != "" or parts[1] != "":
+        return None
+    return prefix, depot, parts[3]
+
+def _narrow(depot: str, clientpath: str, path: str):
+    # The part of the mapping `depot` -> `clientpath` that lands under the stream-relative `path`, as (depot, clientpath), or None if they don't overlap.
+    # We only reason about trailing `...`, which is what stream views are made of; anything fancier is kept if it's wholly inside `path` and dropped otherwise.
+    if clientpath.endswith("...") and depot.endswith("...") and "*" not in clientpath and "..." not in clientpath[:-3]:
+        mapped = clientpath[:-3]
+        if path.startswith(mapped):
+            # the mapping covers more than we want, so cut it down, keeping its own depot side (it might be an import from somewhere else entirely)
+            return depot[:-3] + path[len(mapped):], path
+
+    if path.endswith("...") and "*" not in path and "..." not in path[:-3]:
+        if clientpath.startswith(path[:-3]):
+            return depot, clientpath
+    elif clientpath == path:
+        return depot, clientpath
+
+    return None
+
+def apply(client: Dict, view: Dict[str, List[str]]) -> List[str]:
+    # Stream clients don't let you edit their view; it's always regenerated from the stream spec.
+    # So we take the view the stream gave us, detach the client from the stream, and edit the view by hand.
+    # This means the client won't follow stream spec changes made mid-build, which is fine for something this short-lived.
+    # Every path is matched against the client side of the stream's view, so imported and remapped paths keep coming from wherever the stream gets them.
+    # Returns the includes that nothing in the stream's view maps, so the caller can say so.
+    if not is_narrowed(view):
+        return []
+
+    workspace = client["Client"]
+    original = list(client.get("View", []))
+    parsed = [(line, _parse(line)) for line in original]
+    mappings = [entry for _, entry in parsed if entry is not None and entry[0] != "-"]
+
+    def line(prefix: str, depot: str, clientpath: str) -> str:
+        return _quote(f"{prefix}{depot}") + " " + _quote(f"//{workspace}/{clientpath}")
+
+    lines = original
+    unmatched = []
+    if len(view["include"]) > 0:
+        # Keep the stream's own exclusions where they were (they're there for a reason, and order matters, later lines win),
+        # and cut each of its mappings down to whatever falls under our includes
+        lines = []
+        matched = set()
+        for text, entry in parsed:
+            if entry is None or entry[0] == "-":
+                lines += [text]
+                continue
+
+            prefix, depot, clientpath = entry
+            for path in view["include"]:
+                narrowed = _narrow(depot, clientpath, path)
+                if narrowed is not None:
+                    lines += [line(prefix, *narrowed)]
+                    matched.add(path)
+        unmatched = [path for path in view["include"] if path not in matched]
+
+    # Exclusions have to come last, and have to name the same depot paths the mappings do, imports included
+    for path in view["exclude"]:
+        for _, depot, clientpath in mappings:
+            narrowed = _narrow(depot, clientpath, path)
+            if narrowed is not None:
+                lines += [line("-", *narrowed)]
+
+    client["View"] = lines
+    client.pop("Stream", None)
+    client.pop("StreamAtChange", None)
+    return unmatched
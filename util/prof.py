@@ -1,32 +1,107 @@
 
 import atexit
 import functools
+import json
+import os
+import sys
+import threading
 import time
 
+# Spans are recorded per thread: each thread has its own stack of open contexts, so concurrent work can't tangle the tree.
+# A thread's outermost spans hang off the root, and the trace viewer shows each thread as its own track.
+# At exit we print the tree and, if `trace_path` is set, write a Chrome trace-event file (load it in chrome://tracing or ui.perfetto.dev).
+#
+# Traces cross process boundaries too. A parent puts `propagate()` in the child's ARCLIGHT_TRACE, and the child's root becomes a child of that span.
+# arclight passes it to bootstrap, and bootstrap to the script, along with ARCLIGHT_TRACE_FILE saying where to write.
+# Then each parent `merge()`s its child's file into its own, so arclight's trace ends up covering the whole job.
+# This file has no dependencies beyond the standard library, since it ships in the bootstrap bundle too.
+
+trace_env = "ARCLIGHT_TRACE"
+trace_file_env = "ARCLIGHT_TRACE_FILE"
+
+def new_id() -> str:
+    return os.urandom(8).hex()
+
+# "trace/span", if we were started as part of someone else's trace
+inherited = os.environ.get(trace_env, "").split("/")
+trace_id = inherited[0] if len(inherited) == 2 else new_id() + new_id()
+parent_span = inherited[1] if len(inherited) == 2 else None
+
+# where to write the trace at exit; None to skip it
+trace_path = os.environ.get(trace_file_env)
+
+# shows up as the process's name in the viewer
+process_name = os.path.splitext(os.path.basename(sys.argv[0]))[0] or "python"
+
 class ProfBlock:
     children = None
     start = None
     end = None
     label = None
-    
+    attributes = None
+    thread = None
+    id = None
+
     def __init__(self):
         self.children = []
-    
+        self.attributes = {}
+        self.id = new_id()
+
     def print(self, indent: int = 0, suppress: bool = False) -> None:
         if not suppress:
             if self.end is None:
-                print(" " * indent + f"{self.label}: {time.perf_counter() - self.start:0.2f}")
+                line = " " * indent + f"{self.label}: {time.perf_counter() - self.start:0.2f} (unfinished)"
             else:
-                print(" " * indent + f"{self.label}: {self.end - self.start:0.2f}")
-            
-        for child in self.children:
+                line = " " * indent + f"{self.label}: {self.end - self.start:0.2f}"
+            if self.thread != "MainThread":
+                line += f" [{self.thread}]"
+            if len(self.attributes) > 0:
+                line += " (" + ", ".join(f"{key}={value}" for key, value in self.attributes.items()) + ")"
+            print(line)
+
+        for child in list(self.children):
             child.print(indent + 2)
 
 root = ProfBlock()
-current_context = root
-
 root.start = time.perf_counter()
 root.label = "root"
+root.thread = "MainThread"
+
+# wall-clock time matching root.start, so traces from different processes can be lined up
+root_walltime = time.time()
+
+# guards the children lists, which are shared between threads where they meet at the root
+lock = threading.Lock()
+
+local = threading.local()
+
+def stack():
+    if not hasattr(local, "stack"):
+        local.stack = [root]
+    return local.stack
+
+def current() -> ProfBlock:
+    return stack()[-1]
+
+def propagate(block: ProfBlock = None) -> str:
+    # The value for a child process's ARCLIGHT_TRACE, making its spans children of `block` (by default, the innermost open span on this thread)
+    return f"{trace_id}/{(block or current()).id}"
+
+def annotate(**attributes) -> None:
+    # Attaches attributes (instance type, bytes transferred, CL, whatever's interesting) to the innermost open span on this thread
+    current().attributes.update(attributes)
+
+def record(label: str, start: float, end: float, parent: ProfBlock = None, **attributes) -> ProfBlock:
+    # Adds a span that's already finished, for things we only find out about as they go by (like phases spotted in a build log); times are perf_counter()s
+    block = ProfBlock()
+    block.label = label
+    block.start = start
+    block.end = end
+    block.thread = threading.current_thread().name
+    block.attributes.update(attributes)
+    with lock:
+        (parent or current()).children.append(block)
+    return block
 
 def prof(func):
     @functools.wraps(func)
@@ -37,32 +112,112 @@ def prof(func):
     return wrapper_timer
 
 class Context:
-    def __init__(self, label):
+    def __init__(self, label, **attributes):
         self.prof = ProfBlock()
         self.prof.label = label
-        
-        self.parent = None
-        
+        self.prof.attributes.update(attributes)
+
+    def set(self, **attributes) -> None:
+        self.prof.attributes.update(attributes)
+
     def __enter__(self):
-        global current_context
-        
+        self.prof.thread = threading.current_thread().name
+
         # add our new context to the parent
-        current_context.children += [self.prof]
-        self.parent = current_context
-        current_context = self.prof
-        
+        with lock:
+            current().children.append(self.prof)
+        stack().append(self.prof)
+
         self.prof.start = time.perf_counter()
-  
+        return self
+
     def __exit__(self, exception_type, exception_value, exception_traceback):
-        global current_context
-    
         self.prof.end = time.perf_counter()
-        current_context = self.parent
-        
+        stack().pop()
+
+        if exception_type is not None:
+            self.prof.attributes["error"] = exception_type.__name__
+
         print(f"Finished {self.prof.label}, {self.prof.end - self.prof.start:0.2f} seconds")
 
+# Events merged in from child processes, already shifted onto our timeline; each child process gets its own pid, since real ones can collide across machines
+merged = []
+next_pid = 2
+
+def merge(path: str) -> bool:
+    # Folds a child process's trace file into ours; returns False if it isn't there (the child may have died before writing it)
+    global next_pid
+    if not os.path.isfile(path):
+        print(f"No trace at {path} to merge")
+        return False
+
+    with open(path, "r") as f:
+        trace = json.load(f)
+
+    # Both sides measure from their own start, so line them up by wall clock; across machines this is only as good as their clocks agree
+    shift = (trace["otherData"]["start"] - root_walltime) * 1e6
+    pids = {}
+    with lock:
+        for event in trace["traceEvents"]:
+            if event["pid"] not in pids:
+                pids[event["pid"]] = next_pid
+                next_pid += 1
+            event["pid"] = pids[event["pid"]]
+            if "ts" in event:
+                event["ts"] += shift
+            merged.append(event)
+    return True
+
+def trace_events():
+    # Chrome trace-event format: one complete ("X") event per span, in microseconds from the root
+    # Our own process is always pid 1
+    events = [{"name": "process_name", "ph": "M", "pid": 1, "tid": 0, "args": {"name": process_name}}]
+    threadids = {}
+    now = time.perf_counter()
+
+    def visit(block: ProfBlock, parent) -> None:
+        if block.thread not in threadids:
+            threadids[block.thread] = len(threadids)
+            events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": threadids[block.thread], "args": {"name": block.thread}})
+
+        end = block.end if block.end is not None else now
+        args = {key: value if isinstance(value, (int, float, bool, str)) or value is None else str(value) for key, value in block.attributes.items()}
+        args["span"] = block.id
+        args["parent"] = parent
+        if block is root:
+            args["trace"] = trace_id
+        elif block.end is None:
+            args["unfinished"] = True
+        events.append({
+            "name": block.label if block is not root else process_name,
+            "ph": "X",
+            "ts": (block.start - root.start) * 1e6,
+            "dur": (end - block.start) * 1e6,
+            "pid": 1,
+            "tid": threadids[block.thread],
+            "args": args,
+        })
+        for child in list(block.children):
+            visit(child, block.id)
+
+    visit(root, parent_span)
+    return events + merged
+
+def write_trace(path: str) -> None:
+    with open(path, "w") as f:
+        json.dump({
+            "traceEvents": trace_events(),
+            "displayTimeUnit": "ms",
+            "otherData": {"start": root_walltime, "trace": trace_id},
+        }, f)
+    print(f"Wrote trace to {path}")
+
 @atexit.register
 def printall() -> None:
     print()
     print("========= Prof dump")
+    root.end = time.perf_counter()
     root.print(suppress = True)
+
+    if trace_path is not None:
+        write_trace(trace_path)
@@ -0,0 +1,163 @@
+
+import datetime
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+
+from typing import Dict
+from typing import List
+from typing import Optional
+
+# Measured resource profiles for local runs.
+# While a container runs we sample its CPU and memory through the docker stats API, and once it finishes successfully we record how much memory it needed per core it was given.
+# The next run of the same script with the same arguments sizes itself from that instead of guessing.
+
+profilepath = "arclight_cache/profiles.json"
+
+# how many recent runs to remember; we size from the worst of them, so one unusually light run doesn't starve the next
+history = 5
+
+# builds don't use memory perfectly evenly, and the sampler can miss short spikes
+headroom = 1.25
+
+# never size a container below this, no matter how light the script looked
+minimum_memory = 4
+
+def profile_key(script: str, script_args: List[str]) -> str:
+    # hashed, because script args sometimes include tokens we don't want sitting around in plain text
+    return hashlib.sha256(json.dumps([script] + script_args).encode("utf-8")).hexdigest()[:16]
+
+def load() -> Dict:
+    if not os.path.isfile(profilepath):
+        return {}
+    with open(profilepath, "r") as f:
+        return json.load(f)
+
+def record(key: str, script: str, cpus: int, memory: int, sampler: 'ContainerSampler') -> None:
+    if sampler.samples == 0:
+        print("PROFILE: no samples collected, not recording")
+        return
+
+    profiles = load()
+    profile = profiles.setdefault(key, {"script": script, "runs": []})
+    profile["runs"] = (profile["runs"] + [{
+        "time": datetime.datetime.now().isoformat(),
+        "cpus": cpus,
+        "memory": memory,
+        "peak_memory": sampler.peak_memory,
+        "peak_cpus": sampler.peak_cpus,
+        "average_cpus": sampler.total_cpus / sampler.samples,
+        "samples": sampler.samples,
+    }])[-history:]
+
+    os.makedirs(os.path.dirname(profilepath), exist_ok = True)
+    with open(profilepath, "w") as f:
+        json.dump(profiles, f, indent = 2)
+
+    print(f"PROFILE: peak {sampler.peak_memory:0.1f}GB ({sampler.peak_memory / cpus:0.2f}GB/core) and {sampler.peak_cpus:0.1f} cores, over {sampler.samples} samples")
+
+def size(key: str, cpus: int, memory: int):
+    # Given the most we're allowed to use, returns (cpus, memory) based on history, or None if we don't have any
+    profile = load().get(key)
+    if profile is None or len(profile["runs"]) == 0:
+        return None
+
+    gbpercore = max(run["peak_memory"] / run["cpus"] for run in profile["runs"]) * headroom
+
+    # don't hand out cores it has never come close to using; but if it ever saturated what it had, it might want more, so leave it uncapped
+    peakcpus = max(run["peak_cpus"] for run in profile["runs"])
+    saturated = any(run["peak_cpus"] >= run["cpus"] * 0.9 for run in profile["runs"])
+    if not saturated:
+        cpus = min(cpus, max(1, math.ceil(peakcpus * headroom)))
+
+    # then fit as many cores as our memory can feed
+    cpus = max(1, min(cpus, math.floor(memory / gbpercore)))
+    memory = min(memory, max(minimum_memory, math.ceil(cpus * gbpercore)))
+    return cpus, memory
+
+class ContainerSampler:
+    # Samples a named container's CPU and memory from the docker stats API until it exits (or we're told to stop)
+    peak_memory = 0     # gigabytes
+    peak_cpus = 0       # cores in use
+    total_cpus = 0
+    samples = 0
+
+    def __init__(self, dockerenv, name: str):
+        self.dockerenv = dockerenv
+        self.name = name
+        self.stop = threading.Event()
+        self.thread = None
+
+    def __enter__(self):
+        self.thread = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        self.stop.set()
+        # the stats stream only checks in once a second or so
+        self.thread.join(timeout = 5)
+
+    def run(self) -> None:
+        import docker
+
+        # `docker run` takes a bit to actually create the thing
+        container = None
+        while container is None and not self.stop.is_set():
+            try:
+                container = self.dockerenv.containers.get(self.name)
+            except docker.errors.NotFound:
+                time.sleep(1)
+
+        if container is None:
+            return
+
+        try:
+            for stats in container.stats(stream = True, decode = True):
+                if self.stop.is_set():
+                    break
+                self.sample(stats)
+        except Exception as ex:
+            # it's just metrics; never take the build down over it
+            print(f"PROFILE: sampling stopped ({ex})")
+
+    def sample(self, stats: Dict) -> None:
+        memory = stats.get("memory_stats", {})
+        cpu = stats.get("cpu_stats", {}).get("cpu_usage", {})
+        precpu = stats.get("precpu_stats", {}).get("cpu_usage", {})
+
+        if "privateworkingset" in memory:
+            # Windows reports CPU time in 100ns ticks
+            workingset = memory["privateworkingset"]
+            tick = 1e-7
+        elif "usage" in memory:
+            # Linux, in nanoseconds; cache isn't really "in use"
+            workingset = memory["usage"] - memory.get("stats", {}).get("cache", 0)
+            tick = 1e-9
+        else:
+            return  # container isn't up yet, or has just gone away
+
+        read = _parse_time(stats.get("read"))
+        preread = _parse_time(stats.get("preread"))
+        cores = None
+        if read is not None and preread is not None and read > preread and "total_usage" in precpu:
+            cores = (cpu.get("total_usage", 0) - precpu["total_usage"]) * tick / (read - preread)
+
+        self.peak_memory = max(self.peak_memory, workingset / (1 << 30))
+        if cores is not None:
+            self.peak_cpus = max(self.peak_cpus, cores)
+            self.total_cpus += cores
+            self.samples += 1
+
+def _parse_time(stamp: Optional[str]) -> Optional[float]:
+    # docker gives us nanosecond-precision RFC3339, which Python won't parse; the zero time means "no previous sample"
+    if stamp is None or stamp.startswith("0001-"):
+        return None
+    stamp = stamp.rstrip("Z")
+    if "." in stamp:
+        whole, fraction = stamp.split(".", 1)
+        stamp = f"{whole}.{fraction[:6].ljust(6, '0')}"
+    return datetime.datetime.fromisoformat(stamp).replace(tzinfo = datetime.timezone.utc).timestamp()
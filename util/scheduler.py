@@ -0,0 +1,241 @@
+
+import datetime
+import itertools
+import math
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from typing import Dict
+from typing import List
+from typing import Optional
+
+# Packs several local arclight jobs onto one build host.
+# Each job asks for a CPU and memory budget; we start whatever fits, in submission order, and queue the rest.
+# The actual launching is done by a runner, so this can be driven by something other than real arclight processes.
+
+# Same "chop off 8gb, then assume 2gb per CPU" rule arclight.py uses when it has the machine to itself
+def default_memory(cpus: int) -> int:
+    return 8 + 2 * cpus
+
+# If the job at the front of the queue has been waiting this long, stop letting smaller jobs jump ahead of it, or a big job might never get a slot
+starvation_seconds = 15 * 60
+
+class Job:
+    id = None
+    args = None
+    cpus = None
+    memory = None
+    lock = None
+
+    state = None    # queued, running, succeeded, failed, cancelled
+    returncode = None
+    submitted = None
+    started = None
+    finished = None
+    log = None
+
+    handle = None
+    cancelling = False   # asked to stop while running; it's still using its budget until the runner says it's gone
+
+    def __init__(self, id: int, args: List[str], cpus: int, memory: int, lock: Optional[str]):
+        self.id = id
+        self.args = args
+        self.cpus = cpus
+        self.memory = memory
+        self.lock = lock
+        self.state = "queued"
+
+    def describe(self) -> Dict:
+        # status gets shown to anyone who asks, so don't hand out everyone's p4 and smb passwords
+        # (they can come as `--p4_password secret` or `--p4_password=secret`)
+        args = list(self.args)
+        for index in range(len(args)):
+            if not args[index].startswith("--"):
+                continue
+            name, equals, _ = args[index].partition("=")
+            if "password" not in name:
+                continue
+            if equals:
+                args[index] = f"{name}=****"
+            elif index + 1 < len(args):
+                args[index + 1] = "****"
+
+        return {
+            "id": self.id,
+            "state": self.state,
+            "cpus": self.cpus,
+            "memory": self.memory,
+            "lock": self.lock,
+            "returncode": self.returncode,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+            "log": self.log,
+            "args": args,
+        }
+
+class ArclightRunner:
+    # Runs each job as its own arclight.py process, with the budget passed in as `--cpus` and `--memory`.
+    # arclight.py turns those into the container's docker limits.
+    # We also pick the container's name, so a cancelled job's container can be found and taken down with it.
+    def __init__(self, arclightdir: str, logdir: str):
+        self.arclightdir = arclightdir
+        self.logdir = logdir
+        os.makedirs(self.logdir, exist_ok = True)
+
+        # job ids start over whenever the scheduler does, so tell this run's containers apart from anything a previous one left behind
+        self.session = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+
+    def container_name(self, job: Job) -> str:
+        return f"arclight-job-{self.session}-{job.id}"
+
+    def start(self, job: Job):
+        job.log = os.path.join(self.logdir, f"{job.id}.log")
+        logfile = open(job.log, "w")
+        process = subprocess.Popen([
+                sys.executable, "-u", "arclight.py",
+                "--cpus", str(job.cpus),
+                "--memory", str(job.memory),
+                "--container_name", self.container_name(job),
+            ] + job.args,
+            cwd = self.arclightdir,
+            stdout = logfile,
+            stderr = subprocess.STDOUT)
+        return (process, logfile, self.container_name(job))
+
+    def poll(self, handle) -> Optional[int]:
+        process, logfile, _ = handle
+        returncode = process.poll()
+        if returncode is not None:
+            logfile.close()
+        return returncode
+
+    def cancel(self, handle) -> None:
+        process, _, container = handle
+        process.terminate()
+
+        # Killing arclight.py doesn't touch the container it started, which would otherwise carry on building (and using its budget) with nobody watching
+        # If it hadn't got as far as making one, there's nothing to remove and docker just says so
+        # (`--warm` jobs run in their workspace's long-lived container instead, which isn't this job's to remove)
+        subprocess.run(["docker", "rm", "-f", container], stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+
+class Scheduler:
+    def __init__(self, runner, cpus: int, memory: int, clock = time.time):
+        self.runner = runner
+        self.cpus = cpus
+        self.memory = memory
+        self.clock = clock
+
+        self.jobs = {}
+        self.ids = itertools.count(1)
+        self.mutex = threading.Lock()
+
+    def submit(self, args: List[str], cpus: int, memory: Optional[int] = None, lock: Optional[str] = None) -> Job:
+        if memory is None:
+            memory = default_memory(cpus)
+
+        if cpus > self.cpus or memory > self.memory:
+            raise Exception(f"job wants {cpus} CPUs and {memory}GB but this host only has {self.cpus} CPUs and {self.memory}GB to hand out")
+
+        with self.mutex:
+            job = Job(next(self.ids), args, cpus, memory, lock)
+            job.submitted = self.clock()
+            self.jobs[job.id] = job
+            print(f"SCHEDULER: queued job {job.id} ({cpus} CPUs, {memory}GB)")
+            return job
+
+    def cancel(self, id: int) -> Job:
+        with self.mutex:
+            job = self.jobs[id]
+            if job.state == "queued":
+                job.state = "cancelled"
+                job.finished = self.clock()
+            elif job.state == "running":
+                # the next tick will notice it's gone and free its resources
+                job.cancelling = True
+                self.runner.cancel(job.handle)
+            return job
+
+    def used(self):
+        running = [job for job in self.jobs.values() if job.state == "running"]
+        return sum(job.cpus for job in running), sum(job.memory for job in running)
+
+    def tick(self) -> None:
+        with self.mutex:
+            # reap anything that's finished
+            for job in self.jobs.values():
+                if job.state != "running":
+                    continue
+
+                returncode = self.runner.poll(job.handle)
+                if returncode is None:
+                    continue
+
+                job.returncode = returncode
+                job.finished = self.clock()
+                if job.cancelling:
+                    job.state = "cancelled"
+                else:
+                    job.state = "succeeded" if returncode == 0 else "failed"
+                job.handle = None
+                print(f"SCHEDULER: job {job.id} {job.state} after {job.finished - job.started:0.0f} seconds")
+
+            # start whatever fits, first-fit in submission order
+            usedcpus, usedmemory = self.used()
+            locks = set(job.lock for job in self.jobs.values() if job.state == "running" and job.lock is not None)
+            queued = sorted([job for job in self.jobs.values() if job.state == "queued"], key = lambda job: job.id)
+            for index, job in enumerate(queued):
+                fits = usedcpus + job.cpus <= self.cpus and usedmemory + job.memory <= self.memory
+                if fits and (job.lock is None or job.lock not in locks):
+                    job.handle = self.runner.start(job)
+                    job.state = "running"
+                    job.started = self.clock()
+                    usedcpus += job.cpus
+                    usedmemory += job.memory
+                    if job.lock is not None:
+                        locks.add(job.lock)
+                    print(f"SCHEDULER: started job {job.id} ({job.cpus} CPUs, {job.memory}GB; host now at {usedcpus}/{self.cpus} CPUs, {usedmemory}/{self.memory}GB)")
+                    continue
+
+                # nobody gets to skip the head of the queue forever
+                if index == 0 and self.clock() - job.submitted > starvation_seconds:
+                    break
+
+    def status(self) -> Dict:
+        with self.mutex:
+            usedcpus, usedmemory = self.used()
+            return {
+                "cpus": self.cpus,
+                "memory": self.memory,
+                "used_cpus": usedcpus,
+                "used_memory": usedmemory,
+                "jobs": [job.describe() for job in sorted(self.jobs.values(), key = lambda job: job.id)],
+            }
+
+    def run(self, interval: float = 1) -> None:
+        while True:
+            self.tick()
+            time.sleep(interval)
+
+def host_budget(memory: Optional[int] = None, cpus: Optional[int] = None):
+    import multiprocessing
+    import psutil
+
+    # same 75%-of-RAM ceiling arclight.py uses for a single local job
+    hostmemory = math.floor(psutil.virtual_memory().total / (1 << 30) / 4 * 3)
+    hostcpus = multiprocessing.cpu_count()
+    return min(hostcpus, cpus or hostcpus), min(hostmemory, memory or hostmemory)
+
+def print_status(status: Dict) -> None:
+    print(f"Host: {status['used_cpus']}/{status['cpus']} CPUs, {status['used_memory']}/{status['memory']}GB in use")
+    print()
+    print(f"{'id':>5}  {'state':<10}{'cpus':>5}{'mem':>6}  {'waited':>8}  {'ran':>8}  args")
+    now = time.time()
+    for job in status["jobs"]:
+        finished = job["finished"] if job["finished"] is not None else now
+        waited = (job["started"] if job["started"] is not None else finished) - job["submitted"]
+        ran = finished - job["started"] if job["started"] is not None else 0
+        print(f"{job['id']:>5}  {job['state']:<10}{job['cpus']:>5}{job['memory']:>5}G  {str(datetime.timedelta(seconds = round(waited))):>8}  {str(datetime.timedelta(seconds = round(ran))):>8}  {' '.join(job['args'])}")
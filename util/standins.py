@@ -0,0 +1,293 @@
+import collections
+import io
+import shlex
+import socket
+import subprocess
+import sys
+import threading
+import time
+import types
+
+from typing import Dict
+from typing import List
+
+# Stand-ins for everything arclight talks to besides AWS, for benchmark.py.
+# Each one pretends to take a configurable amount of time and counts what it was asked to do, so we can see what the orchestration itself costs without a p4 server, a docker daemon or an instance to SSH into.
+# AWS itself is moto's job; benchmark.py sets that up.
+# None of this is used by a real run.
+
+# Simulated seconds per call, by kind; benchmark.py lets you override any of them
+default_latency = {
+    "aws": 0.05,            # every AWS API call, on top of whatever moto takes
+    "p4": 0.02,             # every p4 command
+    "docker": 0.1,          # local docker commands that don't move much data (tag, create, cp, start, login)
+    "docker_build": 2.0,    # build.py, when the image isn't cached
+    "docker_push": 2.0,
+    "ssh": 0.05,            # every command run on an instance
+    "ssh_connect": 0.5,     # the instance's SSH server coming up
+    "pull": 2.0,            # docker pull on an instance
+    "script": 1.0,          # the build script itself, wherever it runs
+}
+
+latency = dict(default_latency)
+
+# kind -> count, and kind -> simulated seconds, for everything the stand-ins were asked to do
+calls = collections.Counter()
+simulated = collections.Counter()
+lock = threading.Lock()
+
+# benchmark.py also counts time.sleep; the stand-ins have to sleep for real without showing up there
+real_sleep = time.sleep
+
+def simulate(kind: str, what: str = None) -> None:
+    with lock:
+        calls[what or kind] += 1
+        simulated[kind] += latency[kind]
+    real_sleep(latency[kind])
+
+# Hooks benchmark.py fills in, so the stand-ins don't need to know about moto
+on_remote_run = None    # called with the `docker run` command line an instance was given
+
+class P4Exception(Exception):
+    pass
+
+class P4:
+    # Just enough of P4Python for arclight's setup: login, trust, `counter change`, and making workspaces
+    head = "1000"
+
+    def __init__(self):
+        self.user = None
+        self.password = None
+        self.port = None
+        self.host = None
+        self.client = None
+        self.exception_level = 2
+        self.clients = {}
+
+    def connect(self):
+        simulate("p4", "p4 connect")
+
+    def run_login(self, *args):
+        simulate("p4", "p4 login")
+        return [{"User": self.user}]
+
+    def run_trust(self, *args):
+        simulate("p4", "p4 trust")
+        return ["10.0.0.1:1666 AA:BB:CC:DD:EE:FF:00:11:22:33:44:55:66:77:88:99:AA:BB:CC:DD"]
+
+    def run(self, command: str, *args):
+        simulate("p4", f"p4 {command}")
+        if command == "counter" and args == ("change",):
+            return [{"counter": "change", "value": self.head}]
+        return []
+
+    def run_client(self, *args):
+        simulate("p4", "p4 client")
+        if "-d" in args:
+            if args[-1] not in self.clients:
+                raise P4Exception(f"Client '{args[-1]}' doesn't exist.")
+            del self.clients[args[-1]]
+            return []
+
+        # `-o [-S stream] name`
+        name = args[-1]
+        if name in self.clients:
+            return [dict(self.clients[name])]
+        stream = args[args.index("-S") + 1] if "-S" in args else "//depot/main"
+        return [{
+            "Client": name,
+            "Root": "c:\\work",
+            "Stream": stream,
+            "View": [f"{stream}/... //{name}/..."],
+        }]
+
+    def save_client(self, client: Dict):
+        simulate("p4", "p4 client -i")
+        self.clients[client["Client"]] = dict(client)
+
+    def run_flush(self, *args):
+        simulate("p4", "p4 flush")
+        return []
+
+class DockerImages:
+    def __init__(self):
+        self.built = set()
+
+    def get(self, name: str):
+        if name not in self.built:
+            raise docker_module.errors.ImageNotFound(name)
+        return name
+
+class DockerContainer:
+    def stats(self, stream: bool = True, decode: bool = True):
+        # no numbers, so ContainerSampler just records nothing
+        return iter([])
+
+class DockerContainers:
+    def get(self, name: str):
+        return DockerContainer()
+
+class DockerClient:
+    # shared, since arclight makes a new client when it switches daemons and the image has to still be there
+    images = DockerImages()
+    containers = DockerContainers()
+
+    def info(self):
+        return {"OSType": "windows"}
+
+def docker_module_build() -> types.ModuleType:
+    module = types.ModuleType("docker")
+    module.errors = types.ModuleType("docker.errors")
+    class DockerException(Exception):
+        pass
+    class NotFound(DockerException):
+        pass
+    class ImageNotFound(NotFound):
+        pass
+    module.errors.DockerException = DockerException
+    module.errors.NotFound = NotFound
+    module.errors.ImageNotFound = ImageNotFound
+    module.from_env = lambda: DockerClient()
+    return module
+
+docker_module = docker_module_build()
+
+class ConnectionResult:
+    def __init__(self, stdout: str):
+        self.stdout = stdout
+
+class Transport:
+    def set_keepalive(self, seconds: int):
+        pass
+
+class Connection:
+    # fabric.Connection, for AwsInstance.ssh
+    def __init__(self, host: str, connect_kwargs: Dict = None):
+        self.host = host
+        self.transport = Transport()
+
+    def open(self):
+        simulate("ssh", "ssh connect")
+
+    def close(self):
+        pass
+
+    def run(self, command: str, **kwargs):
+        return ConnectionResult(remote(shlex.split(command, posix = False)))
+
+def remote(command: List[str]) -> str:
+    # What an instance would do with `command`
+    if command[:2] == ["docker", "pull"]:
+        simulate("pull", "ssh docker pull")
+    elif command[:2] == ["docker", "run"]:
+        simulate("script", "ssh docker run")
+        if on_remote_run is not None:
+            on_remote_run([c.strip('"') for c in command])
+    else:
+        simulate("ssh", f"ssh {' '.join(command[:2])}")
+    return ""
+
+fabric_module = types.ModuleType("fabric")
+fabric_module.Connection = Connection
+
+class Socket(socket.socket):
+    # Only waiting for an instance's SSH server is faked; everything else is a real socket
+    def connect_ex(self, address):
+        if address[1] == 22:
+            simulate("ssh_connect", "ssh wait for server")
+            return 0
+        return super().connect_ex(address)
+
+def local(command: List[str]) -> str:
+    # What the local machine would do with `command`
+    if command[:2] == ["python", "build.py"]:
+        simulate("docker_build", "docker build")
+        DockerClient.images.built.add(command[command.index("--name") + 1])
+    elif command[:2] == ["docker", "push"]:
+        simulate("docker_push", "docker push")
+    elif command[:2] == ["docker", "start"] and "-a" in command:
+        simulate("script", "docker start -a")
+    elif command[0] == "docker":
+        simulate("docker", f"docker {command[1]}")
+    elif command[0] in ["ssh", "scp"]:
+        simulate("ssh", f"{command[0]} diskpart" if command[-1] == "diskpart" else command[0])
+    else:
+        raise Exception(f"no stand-in for {command}")
+    return ""
+
+def install() -> Dict:
+    # Swaps the stand-ins in; returns what it replaced, for uninstall()
+    replaced = {
+        "modules": {name: sys.modules.get(name) for name in ["P4", "docker", "fabric"]},
+        "subprocess": (subprocess.check_call, subprocess.check_output, subprocess.call, subprocess.run, subprocess.Popen),
+        "socket": socket.socket,
+    }
+
+    p4module = types.ModuleType("P4")
+    p4module.P4 = P4
+    p4module.P4Exception = P4Exception
+    sys.modules["P4"] = p4module
+    sys.modules["docker"] = docker_module
+    sys.modules["fabric"] = fabric_module
+
+    # Python scripts (the script's `--validate`) really run; everything else is simulated
+    realcheck_call, realcheck_output, realcall, realrun, realPopen = replaced["subprocess"]
+
+    def check_call(command, **kwargs):
+        if command[0] == sys.executable:
+            return realcheck_call(command, **kwargs)
+        local(command)
+        return 0
+
+    def check_output(command, **kwargs):
+        if command[0] == sys.executable:
+            return realcheck_output(command, **kwargs)
+        return local(command).encode("utf-8")
+
+    def call(command, **kwargs):
+        if command[0] == sys.executable:
+            return realcall(command, **kwargs)
+        local(command)
+        return 0
+
+    def run(command, **kwargs):
+        if command[0] == sys.executable:
+            return realrun(command, **kwargs)
+        stdout = local(command)
+        return subprocess.CompletedProcess(command, 0, stdout = stdout if kwargs.get("text") else stdout.encode("utf-8"), stderr = "")
+
+    class Popen:
+        # for util.logphases.run, which reads the output as it comes; ours all comes at once
+        def __init__(self, command, **kwargs):
+            self.stdout = io.BytesIO(local(command).encode("utf-8"))
+
+        def wait(self):
+            return 0
+
+    def popen(command, **kwargs):
+        if command[0] == sys.executable:
+            return realPopen(command, **kwargs)
+        return Popen(command, **kwargs)
+
+    subprocess.check_call = check_call
+    subprocess.check_output = check_output
+    subprocess.call = call
+    subprocess.run = run
+    subprocess.Popen = popen
+    socket.socket = Socket
+    return replaced
+
+def uninstall(replaced: Dict) -> None:
+    for name, module in replaced["modules"].items():
+        if module is None:
+            sys.modules.pop(name, None)
+        else:
+            sys.modules[name] = module
+    subprocess.check_call, subprocess.check_output, subprocess.call, subprocess.run, subprocess.Popen = replaced["subprocess"]
+    socket.socket = replaced["socket"]
+
+def summary() -> Dict:
+    return {
+        "calls": dict(calls),
+        "simulated_seconds": dict(simulated),
+    }
@@ -0,0 +1,74 @@
+import docker
+import hashlib
+import json
+import re
+import subprocess
+
+from typing import List
+
+# Warm containers, for quick local iteration (`--inplace --warm`).
+# A normal local run boots a fresh container, then bootstrap mounts SMB and connects, trusts and logs into p4 before any work starts; for something like stub.py, that's most of the run.
+# A warm container does all that once (`bootstrap.py --warm_serve`) and then sits idle; later runs `docker exec` just the script phase into it (`bootstrap.py --warm_exec`).
+# bootstrap shuts it down after it's been idle for a while, and since it's created with `--rm`, that's the end of it.
+
+# docker label holding the key the container was set up with
+label = "arclight.warm-key"
+
+# bootstrap prints this once setup is done; bootstrap.py has its own copy
+ready_marker = "WARM: ready"
+
+# the image's entrypoint, which verifies the bootstrap bundle before running it (see the environment's Dockerfile)
+entrypoint = "c:\\bootstrap\\entrypoint.py"
+
+# bootstrap flags that only matter to a single run; everything else is baked into the warm container's setup
+run_flags = ["--script", "--output", "--output_packaging", "--output_delta_key", "--output_delta_base", "--p4_sync", "--p4_patch"]
+
+def container_name(workspace: str) -> str:
+    # one per workspace; two warm containers sharing a workspace would just fight over it
+    return re.sub(r'[^a-zA-Z0-9_.-]', '_', f"arclight-warm-{workspace}")
+
+def setup_key(settings: List, bootstrap_args: List[str]) -> str:
+    # Anything that changes what the container was set up with (image, bundle, size, p4 and SMB settings) needs a new container.
+    # The bundle's in there because hyperv containers can't be `docker cp`ed into while they're running, so we can't just swap it out.
+    setup_args = []
+    skip = False
+    for arg in bootstrap_args:
+        if skip:
+            skip = False
+        elif arg in run_flags:
+            skip = True
+        else:
+            setup_args.append(arg)
+
+    return hashlib.sha256(json.dumps([settings, setup_args]).encode("utf-8")).hexdigest()[:16]
+
+def reuse(dockerenv, name: str, key: str) -> bool:
+    # Returns True if there's a running warm container we can use as-is; anything else by that name is in the way, so it goes
+    try:
+        container = dockerenv.containers.get(name)
+    except docker.errors.NotFound:
+        return False
+
+    if container.status == "running" and container.labels.get(label) == key:
+        print(f"WARM: reusing {name}")
+        return True
+
+    if container.status != "running":
+        print(f"WARM: removing stopped container {name}")
+    else:
+        print(f"WARM: settings changed since {name} was started, replacing it")
+    container.remove(force = True)
+    return False
+
+def wait_ready(name: str) -> None:
+    # Echo the container's setup output until bootstrap says it's ready; if the output ends first, setup failed and the container's gone
+    process = subprocess.Popen(['docker', 'logs', '-f', name], stdout = subprocess.PIPE, stderr = subprocess.STDOUT, text = True)
+    try:
+        for line in process.stdout:
+            print(line, end = "")
+            if line.strip() == ready_marker:
+                return
+    finally:
+        process.kill()
+
+    raise Exception(f"warm container {name} exited during setup")